@@ -1,13 +1,16 @@
 import asyncio
 import discord
 from discord.ext import commands, tasks
-import yt_dlp
 from async_timeout import timeout
-from functools import partial
-from youtube_search import YoutubeSearch
 import os
 from dotenv import load_dotenv
 import concurrent.futures
+from messaging import NOTICE, NowPlaying, message_edits, messages, now_playing_text
+from extractpool import ExtractorPool
+from audiofx import VolumeTransformer
+from ytcache import SearchCache, StreamCache, youtube_search
+from metastore import MetadataStore
+from resolver import StreamResolver
 import json
 import aiohttp
 from datetime import datetime, time, timezone
@@ -42,27 +45,59 @@ ffmpeg_options = {
     'executable': r'C:\ffmpeg\bin\ffmpeg.exe'  # Adjust this path to where you installed ffmpeg
 }
 
-ytdl = yt_dlp.YoutubeDL(ydl_opts)
+ydl_playlist_opts = {
+    'extract_flat': 'in_playlist',
+    'skip_download': True,
+}
+
+# yt-dlp runs in worker processes, each with its own YoutubeDL per profile
+extract_pool = ExtractorPool({'default': ydl_opts, 'playlist': ydl_playlist_opts},
+                             workers=int(os.getenv('EXTRACT_WORKERS', '0')) or None)
 
 # Create a ThreadPoolExecutor
 thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
 
-class YTDLSource(discord.PCMVolumeTransformer):
+search_cache = SearchCache(maxsize=int(os.getenv('SEARCH_CACHE_SIZE', '512')),
+                           ttl=int(os.getenv('SEARCH_CACHE_TTL', '600')))
+
+# Resolved stream info keyed by youtube video id, shared by every guild
+stream_cache = StreamCache(max_bytes=int(os.getenv('STREAM_CACHE_BYTES', 8 * 1024 * 1024)))
+
+# Metadata survives restarts so only expired stream urls have to be re-extracted
+metadata_store = None
+
+# stream cache -> metadata store -> yt-dlp, guilds asking for the same
+# video/playlist at the same time share one extraction
+resolver = None
+
+def setup():
+    # Opens the sqlite store (and its writer thread) once we're really starting
+    global metadata_store, resolver
+    metadata_store = MetadataStore(os.getenv('METADATA_DB', 'metadata.db'))
+    resolver = StreamResolver(extract_pool.extract_info, stream_cache, metadata_store)
+
+class YTDLSource(VolumeTransformer):
     def __init__(self, source, *, data, volume=0.5):
         super().__init__(source, volume)
         self.data = data
         self.title = data.get('title')
         self.url = data.get('url')
+        self._frames = 0
+
+    @property
+    def position(self):
+        # Always played from the start, every read() is 20ms
+        return self._frames * 0.02
+
+    def read(self):
+        data = super().read()
+        if data:
+            self._frames += 1
+        return data
 
     @classmethod
     async def create(cls, url, *, loop=None, stream=False):
-        loop = loop or asyncio.get_event_loop()
-        partial_run = partial(ytdl.extract_info, url, download=not stream)
-        data = await loop.run_in_executor(thread_pool, partial_run)
-        
-        if 'entries' in data:
-            data = data['entries'][0]
-        
+        data = await resolver.resolve(url, stream)
         return cls(discord.FFmpegPCMAudio(data['url'], **ffmpeg_options), data=data)
 
 class Song:
@@ -80,7 +115,7 @@ class MusicPlayer:
         self.queue = asyncio.Queue()
         self.next = asyncio.Event()
 
-        self.np = None
+        self.now_playing = NowPlaying(self._channel, message_edits, self.now_playing_text, dispatcher=messages)
         self.volume = .5
         self.current = None
 
@@ -101,14 +136,14 @@ class MusicPlayer:
             if not self._guild.voice_client:
                 await self.ensure_voice_connected()
                 if not self._guild.voice_client:
-                    await self._channel.send("Failed to connect to voice channel. Skipping song.")
+                    messages.send(self._channel, "Failed to connect to voice channel. Skipping song.")
                     continue
 
             try:
                 source = await YTDLSource.create(song.url, loop=self.bot.loop, stream=True)
             except Exception as e:
-                await self._channel.send(f'There was an error processing your song.\n'
-                                         f'```css\n[{e}]\n```')
+                messages.send(self._channel, f'There was an error processing your song.\n'
+                                             f'```css\n[{e}]\n```')
                 continue
 
             source.volume = self.volume
@@ -116,12 +151,22 @@ class MusicPlayer:
 
             try:
                 self._guild.voice_client.play(source, after=lambda e: self.bot.loop.call_soon_threadsafe(self.play_next_song, e))
-                self.np = await self._channel.send(f'**Now Playing:** `{source.title}`')
+                self.now_playing.set_playing(True)
                 await self.next.wait()
             except Exception as e:
                 logging.error(f"Error during playback: {e}")
-                await self._channel.send(f"An error occurred during playback. Attempting to continue.")
+                messages.send(self._channel, f"An error occurred during playback. Attempting to continue.")
                 self.play_next_song(error=e)
+            finally:
+                self.current = None
+                if self.queue.empty():
+                    self.now_playing.set_playing(False)
+
+    def now_playing_text(self):
+        source = self.current
+        if source is None:
+            return now_playing_text(None, queued=self.queue.qsize())
+        return now_playing_text(source.title, source.position, source.data.get('duration'), self.queue.qsize())
 
     def play_next_song(self, error=None):
         if error:
@@ -131,12 +176,13 @@ class MusicPlayer:
     async def ensure_voice_connected(self):
         if not self._guild.voice_client:
             try:
-                await self._channel.send("Reconnecting to voice channel...")
+                messages.send(self._channel, "Reconnecting to voice channel...", lane=NOTICE)
                 await asyncio.wait_for(self._cog.join(self._channel), timeout=30.0)
             except asyncio.TimeoutError:
-                await self._channel.send("Failed to reconnect to voice channel.")
+                messages.send(self._channel, "Failed to reconnect to voice channel.", lane=NOTICE)
 
     def destroy(self, guild):
+        self.now_playing.close()
         return self.bot.loop.create_task(self._cog.cleanup(guild))
 
 class Music(commands.Cog):
@@ -173,9 +219,9 @@ class Music(commands.Cog):
                 await channel.connect()
             except Exception as e:
                 logging.error(f"Error joining voice channel: {e}")
-                await ctx.send(f"An error occurred while joining the voice channel: {e}")
+                await messages.respond(ctx, f"An error occurred while joining the voice channel: {e}")
         else:
-            await ctx.send("You are not connected to a voice channel.")
+            await messages.respond(ctx, "You are not connected to a voice channel.")
 
     @commands.Cog.listener()
     async def on_voice_state_update(self, member, before, after):
@@ -193,16 +239,15 @@ class Music(commands.Cog):
             self.search_tasks[ctx.author.id].cancel()
 
         try:
-            results = await self.bot.loop.run_in_executor(thread_pool, YoutubeSearch, query, 5)
-            results = results.to_dict()
+            results = await youtube_search(query, 5, search_cache, thread_pool)
             if not results:
-                return await ctx.send('No videos found.')
+                return await messages.respond(ctx, 'No videos found.')
 
             embed = discord.Embed(title="Search Results", description="Choose a song by number:")
             for i, video in enumerate(results, start=1):
                 embed.add_field(name=f"{i}. {video['title']}", value=f"Duration: {video['duration']}", inline=False)
 
-            message = await ctx.send(embed=embed)
+            message = await messages.respond(ctx, embed=embed)
 
             def check(m):
                 return m.author == ctx.author and m.channel == ctx.channel and m.content.isdigit() and 1 <= int(m.content) <= 5
@@ -219,21 +264,24 @@ class Music(commands.Cog):
                 await ctx.invoke(self.play, search=url)
 
             except asyncio.TimeoutError:
-                await message.delete()
-                await ctx.send('Search timed out after 1 minute.')
+                if message:
+                    await message.delete()
+                await messages.respond(ctx, 'Search timed out after 1 minute.')
             except asyncio.CancelledError:
-                await message.delete()
-                await ctx.send('Last search cancelled due to a new search request.')
+                if message:
+                    await message.delete()
+                await messages.respond(ctx, 'Last search cancelled due to a new search request.')
             finally:
                 # Remove the task from the dictionary
                 self.search_tasks.pop(ctx.author.id, None)
 
         except Exception as e:
-            await ctx.send(f'An error occurred: {str(e)}')
+            await messages.respond(ctx, f'An error occurred: {str(e)}')
             print(f"Search error details: {e}")
     @commands.command()
     async def play(self, ctx, *, search: str):
-        await ctx.send(f'Processing your request for: {search}')
+        # Not awaited, it can go out together with whatever follows
+        messages.respond(ctx, f'Processing your request for: {search}')
 
         vc = ctx.voice_client
 
@@ -247,30 +295,25 @@ class Music(commands.Cog):
         else:
             song_title = None
             if not search.startswith('http'):
-                results = await self.bot.loop.run_in_executor(thread_pool, YoutubeSearch, search, 1)
-                results = results.to_dict()
+                results = await youtube_search(search, 1, search_cache, thread_pool)
                 if not results:
-                    return await ctx.send('No video found.')
+                    return await messages.respond(ctx, 'No video found.')
                 search = f"https://youtube.com{results[0]['url_suffix']}"
                 song_title = results[0]['title']
             
             # If we didn't get a title from the search, we'll get it when the song is actually played
             song = Song(search, title=song_title)
             await player.queue.put(song)
-            await ctx.send(f'Song Added to queue')
+            await messages.respond(ctx, f'Song Added to queue')
 
     async def process_playlist(self, ctx, url, player):
-        await ctx.send("Processing playlist. This may take a moment...")
+        # Not awaited, it can go out together with whatever follows
+        messages.respond(ctx, "Processing playlist. This may take a moment...")
         try:
-            ydl_opts_playlist = {
-                'extract_flat': 'in_playlist',
-                'skip_download': True,
-            }
-            with yt_dlp.YoutubeDL(ydl_opts_playlist) as ydl:
-                result = await self.bot.loop.run_in_executor(thread_pool, ydl.extract_info, url, False)
+            result = await resolver.playlist(url)
 
             if 'entries' not in result:
-                await ctx.send('Error: Could not find playlist entries.')
+                await messages.respond(ctx, 'Error: Could not find playlist entries.')
                 return
 
             for entry in result['entries'][:10]:
@@ -278,12 +321,12 @@ class Music(commands.Cog):
                 song = Song(video_url, title=entry.get('title', 'Unknown Title'))
                 await player.queue.put(song)
             
-            await ctx.send(f"Added {min(10, len(result['entries']))} songs from the playlist to the queue.")
+            await messages.respond(ctx, f"Added {min(10, len(result['entries']))} songs from the playlist to the queue.")
             
             if len(result['entries']) > 10:
-                await ctx.send("Note: Only the first 10 songs from the playlist were added to avoid overloading.")
+                await messages.respond(ctx, "Note: Only the first 10 songs from the playlist were added to avoid overloading.")
         except Exception as e:
-            await ctx.send(f'An error occurred while processing the playlist: {str(e)}')
+            await messages.respond(ctx, f'An error occurred while processing the playlist: {str(e)}')
             print(f"Playlist error details: {e}")
 
     @commands.command()
@@ -291,50 +334,50 @@ class Music(commands.Cog):
         vc = ctx.voice_client
         if vc and vc.is_playing():
             vc.pause()
-            await ctx.send("Paused ⏸️")
+            await messages.respond(ctx, "Paused ⏸️")
         else:
-            await ctx.send("Nothing is playing.")
+            await messages.respond(ctx, "Nothing is playing.")
 
     @commands.command()
     async def resume(self, ctx):
         vc = ctx.voice_client
         if vc and vc.is_paused():
             vc.resume()
-            await ctx.send("Resumed ▶️")
+            await messages.respond(ctx, "Resumed ▶️")
         else:
-            await ctx.send("The audio is not paused.")
+            await messages.respond(ctx, "The audio is not paused.")
 
     @commands.command()
     async def skip(self, ctx):
         vc = ctx.voice_client
         if vc and vc.is_playing():
             vc.stop()
-            await ctx.send("Skipped ⏭️")
+            await messages.respond(ctx, "Skipped ⏭️")
         else:
-            await ctx.send("Nothing is playing.")
+            await messages.respond(ctx, "Nothing is playing.")
 
     @commands.command()
     async def queue(self, ctx):
         player = self.get_player(ctx)
         if player.queue.empty():
-            return await ctx.send('There are currently no more queued songs.')
+            return await messages.respond(ctx, 'There are currently no more queued songs.')
 
         upcoming = list(player.queue._queue)
         fmt = '\n'.join(f'`{i+1}.` **{song.title}**' for i, song in enumerate(upcoming))
         embed = discord.Embed(title=f'Upcoming - Next {len(upcoming)}', description=fmt)
-        await ctx.send(embed=embed)
+        await messages.respond(ctx, embed=embed)
 
     @commands.command()
     async def delete(self, ctx, number: int = None):
         if number is None:
-            return await ctx.send('Please provide a number to delete a song from the queue. Usage: `!delete <number>`')
+            return await messages.respond(ctx, 'Please provide a number to delete a song from the queue. Usage: `!delete <number>`')
 
         player = self.get_player(ctx)
         if player.queue.empty():
-            return await ctx.send('The queue is empty.')
+            return await messages.respond(ctx, 'The queue is empty.')
         
         if number < 1 or number > player.queue.qsize():
-            return await ctx.send(f'Please provide a valid number between 1 and {player.queue.qsize()}.')
+            return await messages.respond(ctx, f'Please provide a valid number between 1 and {player.queue.qsize()}.')
         
         # Convert queue to a list, remove the item, and recreate the queue
         queue_list = list(player.queue._queue)
@@ -343,15 +386,15 @@ class Music(commands.Cog):
         for song in queue_list:
             await player.queue.put(song)
         
-        await ctx.send(f'Removed song: **{removed_song.title}**')
+        await messages.respond(ctx, f'Removed song: **{removed_song.title}**')
 
     @commands.command()
     async def now_playing(self, ctx):
         vc = ctx.voice_client
         if vc and vc.is_playing():
-            await ctx.send(f'Now playing: {vc.source.title}')
+            await messages.respond(ctx, f'Now playing: {vc.source.title}')
         else:
-            await ctx.send('Nothing is currently playing.')
+            await messages.respond(ctx, 'Nothing is currently playing.')
 
     @commands.command()
     async def volume(self, ctx, volume: int):
@@ -359,20 +402,20 @@ class Music(commands.Cog):
         if vc:
             if 0 <= volume <= 100:
                 vc.source.volume = volume / 100
-                await ctx.send(f"Changed volume to {volume}%")
+                await messages.respond(ctx, f"Changed volume to {volume}%")
             else:
-                await ctx.send("Please use a value between 0 and 100")
+                await messages.respond(ctx, "Please use a value between 0 and 100")
         else:
-            await ctx.send("Not connected to a voice channel.")
+            await messages.respond(ctx, "Not connected to a voice channel.")
     @commands.command()
     async def clear_queue(self, ctx):
         player = self.get_player(ctx)
         if player.queue.empty():
-            await ctx.send("The queue is already empty.")
+            await messages.respond(ctx, "The queue is already empty.")
         else:
             # Clear the queue
             player.queue._queue.clear()
-            await ctx.send("The queue has been cleared.")
+            await messages.respond(ctx, "The queue has been cleared.")
     @commands.command()
     async def stop(self, ctx):
         vc = ctx.voice_client
@@ -382,9 +425,9 @@ class Music(commands.Cog):
             player.queue._queue.clear()
             # Stop the current song and disconnect
             await self.cleanup(ctx.guild)
-            await ctx.send("Stopped, cleared the queue, and disconnected.")
+            await messages.respond(ctx, "Stopped, cleared the queue, and disconnected.")
         else:
-            await ctx.send("Not connected to a voice channel.")
+            await messages.respond(ctx, "Not connected to a voice channel.")
 
 
 
@@ -403,8 +446,10 @@ async def on_ready():
     await bot.add_cog(Music(bot))
 
 # Load the token from the environment variable
-TOKEN = os.getenv('DISCORD_BOT_TOKEN')
-if not TOKEN:
-    raise ValueError("No token found. Please set the DISCORD_BOT_TOKEN environment variable.")
+if __name__ == '__main__':
+    TOKEN = os.getenv('DISCORD_BOT_TOKEN')
+    if not TOKEN:
+        raise ValueError("No token found. Please set the DISCORD_BOT_TOKEN environment variable.")
 
-bot.run(TOKEN)
\ No newline at end of file
+    setup()
+    bot.run(TOKEN)
@@ -0,0 +1,133 @@
+import atexit
+import json
+import os
+import shutil
+import threading
+import time
+from collections import Counter
+
+
+class AudioCache:
+    # Downloaded tracks live under <root>/<extractor>-<id>.<ext> with an index.json
+    # next to them. The least recently played files are deleted once the
+    # directory grows past max_bytes; files that are queued or playing are pinned.
+    # Cache hits only touch the in-memory index (get runs on the event loop),
+    # it is written out by a timer thread save_delay seconds later.
+    def __init__(self, root='audio_cache', max_bytes=2 * 1024 ** 3, save_delay=30):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.save_delay = save_delay
+        self.index_path = os.path.join(root, 'index.json')
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._pins = Counter()
+        self._save_timer = None
+        os.makedirs(root, exist_ok=True)
+        self._index = self._load()
+        atexit.register(self.flush)
+
+    @staticmethod
+    def key_for(extractor, video_id):
+        return f"{extractor.lower()}-{video_id}"
+
+    @property
+    def size(self):
+        return sum(entry['size'] for entry in self._index.values())
+
+    def _load(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            index = {}
+        # Forget anything that was removed behind our back
+        return {key: entry for key, entry in index.items()
+                if os.path.exists(os.path.join(self.root, entry['file']))}
+
+    def _save(self, index):
+        with self._write_lock:
+            tmp = self.index_path + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(index)
+            os.replace(tmp, self.index_path)
+
+    def _save_later(self):
+        # Called with _lock held
+        if self._save_timer is None:
+            self._save_timer = threading.Timer(self.save_delay, self.flush)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def flush(self):
+        with self._lock:
+            if self._save_timer is None:
+                return
+            self._save_timer.cancel()
+            self._save_timer = None
+            index = json.dumps(self._index)
+        self._save(index)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+            path = os.path.join(self.root, entry['file'])
+            if not os.path.exists(path):
+                del self._index[key]
+                self._save_later()
+                return None
+            entry['last_used'] = time.time()
+            self._save_later()
+            return path, entry.get('title')
+
+    def put(self, key, src_path, title=None):
+        filename = key + os.path.splitext(src_path)[1]
+        path = os.path.join(self.root, filename)
+        tmp = path + '.tmp'
+        # Move next to the final name first so the rename itself is atomic
+        shutil.move(src_path, tmp)
+        os.replace(tmp, path)
+
+        with self._lock:
+            self._index[key] = {
+                'file': filename,
+                'size': os.path.getsize(path),
+                'title': title,
+                'last_used': time.time(),
+            }
+            self._evict()
+            # put runs on a worker thread anyway, write now and drop any pending save
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            index = json.dumps(self._index)
+        self._save(index)
+        return path
+
+    def pin(self, key):
+        with self._lock:
+            self._pins[key] += 1
+
+    def unpin(self, key):
+        with self._lock:
+            self._pins[key] -= 1
+            if self._pins[key] <= 0:
+                del self._pins[key]
+
+    def _evict(self):
+        total = self.size
+        for key, entry in sorted(self._index.items(), key=lambda item: item[1]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if self._pins[key]:
+                continue
+            try:
+                os.remove(os.path.join(self.root, entry['file']))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # Still open somewhere (windows), try again next time
+                continue
+            total -= entry['size']
+            del self._index[key]
@@ -0,0 +1,283 @@
+import functools
+import math
+import threading
+
+import discord
+import numpy as np
+
+try:
+    from scipy.signal import lfilter
+except ImportError:
+    lfilter = None
+
+# The bots fall back to ffmpeg -af filters when scipy isn't installed
+DSP_AVAILABLE = lfilter is not None
+
+# discord.py PCM frames: 20ms of 48kHz 16-bit stereo
+SAMPLES_PER_FRAME = discord.opus.Encoder.SAMPLES_PER_FRAME
+CHANNELS = discord.opus.Encoder.CHANNELS
+FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+
+# Above this (as a fraction of full scale) samples are bent towards the
+# ceiling with tanh instead of being hard clipped
+SOFT_CLIP_THRESHOLD = 0.8
+
+SAMPLE_RATE = 48000
+
+
+def soft_clip(samples, threshold=SOFT_CLIP_THRESHOLD):
+    # samples: float32 array scaled to [-1, 1], modified in place
+    over = np.abs(samples) > threshold
+    if over.any():
+        loud = samples[over]
+        headroom = np.float32(1.0 - threshold)
+        bent = threshold + headroom * np.tanh((np.abs(loud) - threshold) / headroom)
+        samples[over] = np.copysign(bent, loud)
+    return samples
+
+
+class VolumeTransformer(discord.AudioSource):
+    # Drop-in replacement for discord.PCMVolumeTransformer (which relies on the
+    # deprecated audioop module). Gain is applied with NumPy on a zero-copy view
+    # of the frame, volume changes ramp over ramp_ms instead of jumping, and
+    # anything pushed past full scale is soft clipped.
+    def __init__(self, original, volume=1.0, ramp_ms=60):
+        if not isinstance(original, discord.AudioSource):
+            raise TypeError(f'expected AudioSource not {original.__class__.__name__}.')
+        if original.is_opus():
+            raise discord.ClientException('AudioSource must not be Opus encoded.')
+
+        self.original = original
+        self._gain = max(float(volume), 0.0)
+        self._target = self._gain
+        self._step = 0.0
+        self.ramp_frames = max(1, ramp_ms // 20)
+        self._ramp = np.linspace(0.0, 1.0, SAMPLES_PER_FRAME, endpoint=False, dtype=np.float32)
+        self._work = np.empty(SAMPLES_PER_FRAME * CHANNELS, dtype=np.float32)
+        self._out = np.empty(SAMPLES_PER_FRAME * CHANNELS, dtype=np.int16)
+
+    @property
+    def volume(self):
+        return self._target
+
+    @volume.setter
+    def volume(self, value):
+        self._target = max(float(value), 0.0)
+        self._step = abs(self._target - self._gain) / self.ramp_frames
+
+    def cleanup(self):
+        self.original.cleanup()
+
+    def _next_gain(self):
+        start = self._gain
+        if start < self._target:
+            self._gain = min(start + self._step, self._target)
+        elif start > self._target:
+            self._gain = max(start - self._step, self._target)
+        return start, self._gain
+
+    def read(self):
+        data = self.original.read()
+        if not data:
+            return data
+
+        start, end = self._next_gain()
+        if start == end == 1.0:
+            return data
+        return self._finish(np.frombuffer(data, dtype=np.int16), start, end)
+
+    def _finish(self, samples, start, end, clip=False):
+        # samples: interleaved stereo in int16 scale (int16 or float32)
+        if len(samples) != len(self._work):
+            self._work = np.empty(len(samples), dtype=np.float32)
+            self._out = np.empty(len(samples), dtype=np.int16)
+        work = self._work
+
+        if start == end:
+            # Steady volume: one float32 multiply straight into the work buffer
+            np.multiply(samples, np.float32(start), out=work)
+        else:
+            # Linear ramp across the frame, same gain for both channels of a sample
+            ramp = self._ramp[:len(samples) // CHANNELS] * np.float32(end - start) + np.float32(start)
+            np.multiply(samples.reshape(-1, CHANNELS), ramp[:, None], out=work.reshape(-1, CHANNELS))
+
+        # Plain input is within full scale, so only gains above 1 can clip
+        if clip or max(start, end) > 1.0:
+            work *= np.float32(1 / 32768)
+            soft_clip(work)
+            work *= np.float32(32767)
+
+        np.copyto(self._out, work, casting='unsafe')
+        return self._out.tobytes()
+
+
+@functools.lru_cache(maxsize=64)
+def low_shelf_coefficients(gain_db, freq=100.0, q=0.707, rate=SAMPLE_RATE):
+    # RBJ audio EQ cookbook low shelf, normalised so a[0] == 1
+    A = 10 ** (gain_db / 40)
+    w0 = 2 * math.pi * freq / rate
+    alpha = math.sin(w0) / (2 * q)
+    cos_w0 = math.cos(w0)
+    sqrt_a = 2 * math.sqrt(A) * alpha
+
+    b = np.array([
+        A * ((A + 1) - (A - 1) * cos_w0 + sqrt_a),
+        2 * A * ((A - 1) - (A + 1) * cos_w0),
+        A * ((A + 1) - (A - 1) * cos_w0 - sqrt_a),
+    ])
+    a = np.array([
+        (A + 1) + (A - 1) * cos_w0 + sqrt_a,
+        -2 * ((A - 1) + (A + 1) * cos_w0),
+        (A + 1) + (A - 1) * cos_w0 - sqrt_a,
+    ])
+    return b / a[0], a / a[0]
+
+
+def _interpolate(buf, positions):
+    # Linear interpolation of each channel at fractional sample positions
+    grid = np.arange(len(buf), dtype=np.float64)
+    out = np.empty((len(positions), buf.shape[1]), dtype=np.float32)
+    for channel in range(buf.shape[1]):
+        out[:, channel] = np.interp(positions, grid, buf[:, channel])
+    return out
+
+
+# Effects work on float32 (samples, channels) blocks in int16 scale and may
+# return a different number of samples than they were given. set() changes
+# the parameter without throwing away filter state, so there's no click.
+
+class BassBoost:
+    tempo = 1.0
+
+    def __init__(self, gain_db):
+        self._zi = np.zeros((2, CHANNELS))
+        self.set(gain_db)
+
+    def set(self, gain_db):
+        self.gain_db = float(gain_db)
+        self._b, self._a = low_shelf_coefficients(self.gain_db)
+
+    def process(self, x):
+        y, self._zi = lfilter(self._b, self._a, x, axis=0, zi=self._zi)
+        return y.astype(np.float32, copy=False)
+
+
+class SpeedChange:
+    # Resamples with linear interpolation, so pitch follows speed like a turntable
+    def __init__(self, factor):
+        self._tail = np.zeros((1, CHANNELS), dtype=np.float32)
+        self._phase = 0.0
+        self.set(factor)
+
+    def set(self, factor):
+        self.tempo = float(factor)
+
+    def process(self, x):
+        buf = np.concatenate((self._tail, x))
+        last = len(buf) - 1
+        count = max(0, math.ceil((last - self._phase) / self.tempo))
+        y = _interpolate(buf, self._phase + np.arange(count) * self.tempo)
+
+        # Carry the last input sample and where the next output lands relative to it
+        self._phase = self._phase + count * self.tempo - last
+        self._tail = buf[last:]
+        return y
+
+
+class PitchShift:
+    # Two read taps sweeping through a delay line half a window apart, each
+    # faded out (sin^2) as it wraps around. Keeps duration, shifts pitch by ratio.
+    tempo = 1.0
+
+    def __init__(self, ratio, window=2048):
+        self.window = window
+        self._history = np.zeros((window + 2, CHANNELS), dtype=np.float32)
+        self._phase = 0.0
+        self.set(ratio)
+
+    def set(self, ratio):
+        self.ratio = float(ratio)
+        # Delay changes by (1 - ratio) samples per sample -> taps read at ratio speed
+        self._rate = (1.0 - self.ratio) / self.window
+
+    def process(self, x):
+        n = len(x)
+        buf = np.concatenate((self._history, x))
+        base = np.arange(len(self._history), len(buf)) - 1.0
+        phases = (self._phase + np.arange(n) * self._rate) % 1.0
+
+        # sin^2 and its complement: the second tap is half a window along
+        fade = (np.sin(np.pi * phases) ** 2).astype(np.float32)[:, None]
+        first = _interpolate(buf, base - phases * self.window)
+        second = _interpolate(buf, base - (phases + 0.5) % 1.0 * self.window)
+        y = second + (first - second) * fade
+
+        self._phase = (self._phase + n * self._rate) % 1.0
+        self._history = buf[-len(self._history):]
+        return y
+
+
+class EffectsTransformer(VolumeTransformer):
+    # VolumeTransformer with an in-process effects chain in front of the gain.
+    # Effects are keyed by class and can be added, changed or removed while
+    # playing; output is re-cut into exact 20ms frames since speed changes
+    # alter how many samples come out of each input frame.
+    def __init__(self, original, volume=1.0, ramp_ms=60):
+        super().__init__(original, volume, ramp_ms)
+        self.chain = {}
+        self._chain_lock = threading.Lock()
+        self._buffered = []
+        self._buffered_len = 0
+
+    @property
+    def tempo(self):
+        tempo = 1.0
+        for effect in self.chain.values():
+            tempo *= effect.tempo
+        return tempo
+
+    def set_effect(self, effect_cls, value):
+        with self._chain_lock:
+            effect = self.chain.get(effect_cls)
+            if effect is None:
+                self.chain[effect_cls] = effect_cls(value)
+            else:
+                effect.set(value)
+
+    def remove_effect(self, effect_cls):
+        with self._chain_lock:
+            self.chain.pop(effect_cls, None)
+
+    def clear_effects(self):
+        with self._chain_lock:
+            self.chain.clear()
+
+    def read(self):
+        with self._chain_lock:
+            if not self.chain and not self._buffered_len:
+                return super().read()
+
+            while self._buffered_len < SAMPLES_PER_FRAME:
+                data = self.original.read()
+                if not data:
+                    break
+                block = np.frombuffer(data, dtype=np.int16).reshape(-1, CHANNELS).astype(np.float32)
+                for effect in self.chain.values():
+                    block = effect.process(block)
+                if len(block):
+                    self._buffered.append(block)
+                    self._buffered_len += len(block)
+
+        if not self._buffered_len:
+            return b''
+
+        pending = np.concatenate(self._buffered) if len(self._buffered) > 1 else self._buffered[0]
+        frame, rest = pending[:SAMPLES_PER_FRAME], pending[SAMPLES_PER_FRAME:]
+        if len(frame) < SAMPLES_PER_FRAME:
+            # Source ran out mid frame, pad the tail with silence
+            frame = np.concatenate((frame, np.zeros((SAMPLES_PER_FRAME - len(frame), CHANNELS), dtype=np.float32)))
+        self._buffered = [rest] if len(rest) else []
+        self._buffered_len = len(rest)
+
+        start, end = self._next_gain()
+        return self._finish(np.ascontiguousarray(frame).reshape(-1), start, end, clip=True)
@@ -0,0 +1,43 @@
+# Per-frame cost of each in-process effect in audiofx.EffectsTransformer, on
+# its own and all chained together. A frame is 20ms of audio, so anything
+# under 20000us keeps one guild real time; streams/core is the headroom.
+#
+#   python benchmarks/bench_effects.py [seconds-per-case]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from audiofx import BassBoost, EffectsTransformer, PitchShift, SpeedChange
+from bench_volume import NoiseSource
+
+
+def run(name, effects, duration):
+    source = EffectsTransformer(NoiseSource(), 0.5)
+    for effect_cls, value in effects:
+        source.set_effect(effect_cls, value)
+
+    frames = 0
+    start = time.process_time()
+    while time.process_time() - start < duration:
+        for _ in range(200):
+            source.read()
+            frames += 1
+    elapsed = time.process_time() - start
+    per_frame = elapsed / frames * 1e6
+    print(f'{name:<32} {per_frame:>8.1f} us/frame  {20000 / per_frame:>8,.0f} streams/core')
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+    run('volume only', [], duration)
+    run('bass_boost 10dB', [(BassBoost, 10)], duration)
+    run('speed 1.25x', [(SpeedChange, 1.25)], duration)
+    run('speed 0.75x', [(SpeedChange, 0.75)], duration)
+    run('pitch 1.5x', [(PitchShift, 1.5)], duration)
+    run('bass + speed + pitch', [(BassBoost, 10), (SpeedChange, 1.25), (PitchShift, 1.5)], duration)
+
+
+if __name__ == '__main__':
+    main()
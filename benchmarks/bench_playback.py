@@ -0,0 +1,138 @@
+# End to end playback through the real Music cog and MusicPlayer, with fake
+# guilds and voice clients and a stub extractor serving local audio (see
+# fakes.py). Every guild /plays `--tracks` links at once and listens until
+# the last one ends. Reports:
+#
+#   time to first audio  /play until the voice client reads the first packet
+#   track switch gap     one track running dry until the next one's first packet
+#   CPU per stream       CPU seconds per second of audio, as % of one core;
+#                        ffmpeg is counted separately once its processes exit
+#   memory per guild     peak RSS growth while everything plays, / guilds
+#
+#   python benchmarks/bench_playback.py [--guilds 20] [--tracks 3] [--speed 10]
+#                                       [--latency 0.3] [--audio FILE ...]
+#
+# Needs ffmpeg (on PATH or FFMPEG=...); without --audio a test tone is generated.
+# PLAYBACK_MODE=pcm|opus picks the playback path as it does for the bot.
+import argparse
+import asyncio
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakes
+
+
+def ms(value):
+    return '-' if value is None else f'{value * 1000:.0f}'
+
+
+async def run(args):
+    main = fakes.import_main()
+    files = args.audio or [fakes.make_tone(main.ffmpeg_options['executable'], args.seconds,
+                                           os.path.join(tempfile.mkdtemp(), 'tone.webm'))]
+    main.extract_pool = fakes.StubExtractor(files, latency=args.latency, jitter=args.jitter, workers=args.workers)
+
+    bot = fakes.FakeBot(speed=args.speed, encode=not args.no_encode)
+    music = main.Music(bot)
+    guilds = [fakes.FakeGuild(bot, i + 1, rest_latency=args.rest_latency) for i in range(args.guilds)]
+
+    gc.collect()
+    rss_before = peak = fakes.rss()
+    cpu_before = os.times()
+    started = {}
+
+    async def drive(guild):
+        for n in range(args.tracks):
+            interaction = fakes.FakeInteraction(guild, command='play')
+            started.setdefault(guild.id, time.perf_counter())
+            await music.play.callback(music, interaction, main.watch_url(f'b{guild.id:05d}t{n:04d}'))
+
+    def done(guild):
+        vc = guild.voice_client
+        return vc is not None and len(vc.tracks) >= args.tracks and vc.tracks[-1][2] is not None
+
+    begin = time.perf_counter()
+    await asyncio.gather(*(drive(guild) for guild in guilds))
+    while not all(done(guild) for guild in guilds):
+        if time.perf_counter() - begin > args.timeout:
+            print(f'Timed out with {sum(map(done, guilds))}/{len(guilds)} guilds finished')
+            break
+        peak = max(peak, fakes.rss())
+        await asyncio.sleep(0.05)
+    wall = time.perf_counter() - begin
+    cpu_after = os.times()
+
+    first_audio, gaps, packets = [], [], 0
+    for guild in guilds:
+        tracks = guild.voice_client.tracks if guild.voice_client else []
+        packets += sum(track[3] for track in tracks)
+        if tracks and tracks[0][1] is not None:
+            first_audio.append(tracks[0][1] - started[guild.id])
+        for previous, track in zip(tracks, tracks[1:]):
+            if previous[2] is not None and track[1] is not None:
+                gaps.append(track[1] - previous[2])
+
+    for guild in guilds:
+        await music.cleanup(guild)
+    main.player_state.close()
+    main.tracer.close()
+
+    audio = packets * fakes.FRAME_LENGTH or float('nan')
+    bot_cpu = (cpu_after.user - cpu_before.user) + (cpu_after.system - cpu_before.system)
+    ffmpeg_cpu = (cpu_after.children_user - cpu_before.children_user) + \
+                 (cpu_after.children_system - cpu_before.children_system)
+    result = {
+        'guilds': args.guilds,
+        'tracks': args.tracks,
+        'speed': args.speed,
+        'mode': main.PLAYBACK_MODE,
+        'wall_seconds': round(wall, 2),
+        'audio_seconds': round(audio, 1),
+        'first_audio': fakes.percentiles(first_audio),
+        'switch_gap': fakes.percentiles(gaps),
+        'bot_cpu_per_stream': bot_cpu / audio,
+        'ffmpeg_cpu_per_stream': ffmpeg_cpu / audio,
+        'memory_per_guild': (peak - rss_before) / args.guilds,
+        'extract_calls': main.extract_pool.calls,
+    }
+
+    print(f"{args.guilds} guilds x {args.tracks} tracks, {main.PLAYBACK_MODE} mode, "
+          f"{f'{args.speed:g}x' if args.speed else 'unthrottled'} speed, {args.latency * 1000:.0f}ms extract latency")
+    print(f"{audio:.0f}s of audio in {wall:.1f}s")
+    for name, key in (('time to first audio', 'first_audio'), ('track switch gap', 'switch_gap')):
+        values = result[key]
+        print(f"{name:<22}" + '  '.join(f'p{p} {ms(v):>6}ms' for p, v in values.items()))
+    print(f"{'bot CPU':<22}{result['bot_cpu_per_stream'] * 100:.2f}% of a core per stream")
+    print(f"{'ffmpeg CPU':<22}{result['ffmpeg_cpu_per_stream'] * 100:.2f}% of a core per stream")
+    print(f"{'memory':<22}{result['memory_per_guild'] / 1024:.0f} KiB per guild "
+          f"(peak RSS +{(peak - rss_before) / 2 ** 20:.1f} MiB)")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--guilds', type=int, default=20)
+    parser.add_argument('--tracks', type=int, default=3, help='tracks per guild')
+    parser.add_argument('--speed', type=float, default=10, help='playback clock multiplier, 0 = unthrottled')
+    parser.add_argument('--latency', type=float, default=0.3, help='stub extract latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.1, help='random extra extract latency')
+    parser.add_argument('--workers', type=int, default=4, help='concurrent stub extractions')
+    parser.add_argument('--rest-latency', type=float, default=0.05, help='fake Discord REST round trip')
+    parser.add_argument('--seconds', type=float, default=10, help='length of the generated test tone')
+    parser.add_argument('--audio', nargs='*', help='local audio files to serve instead of the test tone')
+    parser.add_argument('--no-encode', action='store_true', help="don't Opus-encode PCM frames")
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--json', help='also write the results here, for comparing runs')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+# Frames per second (per core) of the NumPy VolumeTransformer versus
+# discord.PCMVolumeTransformer, which scales every frame with audioop.mul.
+#
+#   python benchmarks/bench_volume.py [seconds-per-case]
+import os
+import sys
+import time
+
+import discord
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from audiofx import FRAME_SIZE, VolumeTransformer
+
+
+class NoiseSource(discord.AudioSource):
+    # Endless pre-generated PCM so the benchmark measures only the scaling
+    def __init__(self, frames=250):
+        rng = np.random.default_rng(0)
+        pcm = rng.integers(-20000, 20000, size=frames * FRAME_SIZE // 2, dtype=np.int16).tobytes()
+        self.frames = [pcm[i:i + FRAME_SIZE] for i in range(0, len(pcm), FRAME_SIZE)]
+        self.index = 0
+
+    def read(self):
+        self.index += 1
+        return self.frames[self.index % len(self.frames)]
+
+
+def run(name, make, duration, each_frame=None):
+    source = make()
+    frames = 0
+    start = time.process_time()
+    while time.process_time() - start < duration:
+        for _ in range(500):
+            if each_frame:
+                each_frame(source, frames)
+            source.read()
+            frames += 1
+    elapsed = time.process_time() - start
+    fps = frames / elapsed
+    # A guild needs 50 frames/s to play in real time
+    print(f'{name:<40} {fps:>12,.0f} frames/s  {fps / 50:>8,.0f} streams/core')
+
+
+def ramping(source, frame):
+    # Flip the volume every 25 frames so a ramp is almost always in progress
+    if frame % 25 == 0:
+        source.volume = 0.3 if source.volume > 0.5 else 0.8
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+    try:
+        run('PCMVolumeTransformer (audioop) @ 50%', lambda: discord.PCMVolumeTransformer(NoiseSource(), 0.5), duration)
+    except Exception as e:
+        print(f'PCMVolumeTransformer unavailable here: {e}')
+    run('VolumeTransformer (numpy) @ 50%', lambda: VolumeTransformer(NoiseSource(), 0.5), duration)
+    run('VolumeTransformer (numpy) ramping', lambda: VolumeTransformer(NoiseSource(), 0.5), duration, ramping)
+    run('VolumeTransformer (numpy) @ 150% + clip', lambda: VolumeTransformer(NoiseSource(), 1.5), duration)
+    run('VolumeTransformer (numpy) @ 100%', lambda: VolumeTransformer(NoiseSource(), 1.0), duration)
+
+
+if __name__ == '__main__':
+    main()
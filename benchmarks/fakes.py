@@ -0,0 +1,390 @@
+# In-process stand-ins for everything main.py talks to outside the process:
+# guilds, channels, interactions and voice connections on the Discord side,
+# and yt-dlp (extract_pool) for stream urls. Lets the benchmarks drive the
+# real Music cog and MusicPlayer without a token or network.
+import asyncio
+import itertools
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+
+import discord
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+FRAME_LENGTH = 0.02
+
+
+def import_main(ffmpeg=None):
+    # Point main.py's sqlite db, state log and trace file at a scratch
+    # directory before setup() opens them, so a run never touches the real ones
+    scratch = tempfile.mkdtemp(prefix='music-bench-')
+    os.environ['METADATA_DB'] = os.path.join(scratch, 'metadata.db')
+    os.environ['PLAYER_STATE_PATH'] = os.path.join(scratch, 'player_state.jsonl')
+    os.environ['TRACE_PATH'] = os.path.join(scratch, 'traces.jsonl')
+    os.environ['METRICS_PORT'] = '0'
+    sys.path.insert(0, ROOT)
+    import main
+
+    main.setup()
+    main.ffmpeg_options['executable'] = ffmpeg or os.getenv('FFMPEG', 'ffmpeg')
+    return main
+
+
+def opus_available():
+    try:
+        return discord.opus.is_loaded() or discord.opus._load_default()
+    except Exception:
+        return False
+
+
+def make_tone(ffmpeg, seconds, path):
+    # A few seconds of sine wave in the format youtube usually hands us (Opus in WebM)
+    import subprocess
+
+    subprocess.run([ffmpeg, '-loglevel', 'error', '-y', '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+                    '-ac', '2', '-ar', '48000', '-c:a', 'libopus', '-b:a', '128k', path], check=True)
+    return path
+
+
+def percentiles(values, points=(50, 90, 99)):
+    if not values:
+        return {p: None for p in points}
+    ordered = sorted(values)
+    return {p: ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] for p in points}
+
+
+def rss():
+    # Resident memory in bytes, /proc where we have it and peak RSS elsewhere
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class StubExtractor:
+    # Replaces main.extract_pool. extract_info answers with one of `files`
+    # after latency (+ up to jitter) seconds, at most `workers` at a time
+    # like the real process pool; iter_entries makes up playlist pages.
+    def __init__(self, files, latency=0.0, jitter=0.0, workers=4, playlist_size=50, seed=0):
+        self.files = files
+        self.latency = latency
+        self.jitter = jitter
+        self.size = workers
+        self.playlist_size = playlist_size
+        self.busy = 0
+        self.waiting = 0
+        self.calls = 0
+        self._slots = None
+        self._rng = random.Random(seed)
+
+    async def _work(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.size)
+        self.waiting += 1
+        async with self._slots:
+            self.waiting -= 1
+            self.busy += 1
+            try:
+                await asyncio.sleep(self.latency + self._rng.uniform(0, self.jitter))
+            finally:
+                self.busy -= 1
+
+    def info(self, vid):
+        path = self.files[zlib.crc32(vid.encode()) % len(self.files)]
+        return {
+            'id': vid,
+            'title': f'Track {vid}',
+            'url': path,
+            'webpage_url': f'https://www.youtube.com/watch?v={vid}',
+            'acodec': 'opus' if path.endswith(('.webm', '.opus', '.ogg')) else 'mp3',
+            'extractor_key': 'Youtube',
+        }
+
+    async def extract_info(self, url, download=False, profile='default'):
+        self.calls += 1
+        await self._work()
+        vid = url.rsplit('=', 1)[-1][-11:]
+        return self.info(vid)
+
+    async def iter_entries(self, url, page_size=50, profile='playlist'):
+        prefix = url.rsplit('=', 1)[-1][-5:].rjust(5, '0')
+        for start in range(0, self.playlist_size, page_size):
+            await self._work()
+            yield [{'id': f'{prefix}{i:06d}', 'title': f'Track {prefix}{i:06d}', 'duration': None, 'url': None}
+                   for i in range(start, min(start + page_size, self.playlist_size))]
+
+    def close(self):
+        pass
+
+
+class StubSearch:
+    # Replaces ytcache.YoutubeSearch: blocks for `latency` seconds on main's thread
+    # pool like the real scrape, then makes up results for the query
+    latency = 0.0
+
+    def __init__(self, query, max_results=10):
+        time.sleep(self.latency)
+        prefix = f's{zlib.crc32(query.encode()) % 10 ** 6:06d}'
+        self.videos = [{'id': f'{prefix}{i:04d}', 'title': f'{query} ({i + 1})', 'duration': '3:00',
+                        'channel': 'bench', 'url_suffix': f'/watch?v={prefix}{i:04d}'}
+                       for i in range(max_results)]
+
+    def to_dict(self):
+        return self.videos
+
+
+class FakeVoiceClient:
+    # Plays like discord.VoiceClient: a thread per stream pulls 20ms frames from
+    # source.read(), Opus-encodes PCM the way discord.py would (when libopus is
+    # around) and calls after() once the source runs dry or is stopped. speed
+    # scales the frame clock, 10 is ten times real time and 0 as fast as possible.
+    # Every track is logged as [play() called, first packet, ended, packets].
+    def __init__(self, channel, speed=1.0, encode=True):
+        self.channel = channel
+        self.guild = channel.guild
+        self.speed = speed
+        self.source = None
+        self.tracks = []
+        self._encoder = discord.opus.Encoder() if encode and opus_available() else None
+        self._end = threading.Event()
+        self._resumed = threading.Event()
+        self._thread = None
+
+    def is_connected(self):
+        return self.guild.voice_client is self
+
+    def is_playing(self):
+        return self._thread is not None and not self._end.is_set() and self._resumed.is_set()
+
+    def is_paused(self):
+        return self._thread is not None and not self._end.is_set() and not self._resumed.is_set()
+
+    def play(self, source, *, after=None):
+        # Like discord.py, a track that just ended can be replaced from its after()
+        if self.is_playing():
+            raise discord.ClientException('Already playing audio.')
+        self.source = source
+        self._end = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+        track = [time.perf_counter(), None, None, 0]
+        self.tracks.append(track)
+        self._thread = threading.Thread(target=self._run, args=(source, after, track, self._end, self._resumed),
+                                        daemon=True)
+        self._thread.start()
+
+    def _run(self, source, after, track, end, resumed):
+        error = None
+        delay = FRAME_LENGTH / self.speed if self.speed else 0
+        next_at = time.perf_counter()
+        try:
+            while not end.is_set():
+                if not resumed.is_set():
+                    resumed.wait()
+                    next_at = time.perf_counter()
+                    continue
+                data = source.read()
+                if not data:
+                    break
+                if self._encoder is not None and not source.is_opus():
+                    self._encoder.encode(data, self._encoder.SAMPLES_PER_FRAME)
+                if track[1] is None:
+                    track[1] = time.perf_counter()
+                track[3] += 1
+                if delay:
+                    next_at += delay
+                    wait = next_at - time.perf_counter()
+                    if wait > 0:
+                        time.sleep(wait)
+        except Exception as e:
+            error = e
+        finally:
+            end.set()
+            track[2] = time.perf_counter()
+            if self.source is source:
+                self.source = None
+            if after is not None:
+                after(error)
+            source.cleanup()
+
+    def stop(self):
+        self._end.set()
+        self._resumed.set()
+
+    def pause(self):
+        self._resumed.clear()
+
+    def resume(self):
+        self._resumed.set()
+
+    async def disconnect(self, *, force=False):
+        self.stop()
+        # Let after() reach the loop before anyone closes it
+        if self._thread is not None:
+            await asyncio.to_thread(self._thread.join)
+        if self.guild.voice_client is self:
+            self.guild.voice_client = None
+        if self in self.guild.bot.voice_clients:
+            self.guild.bot.voice_clients.remove(self)
+
+
+class FakeMessage:
+    ids = itertools.count(1)
+
+    def __init__(self, channel, content=None, embed=None):
+        self.id = next(self.ids)
+        self.channel = channel
+        self.content = content
+        self.embed = embed
+
+    async def edit(self, *, content=discord.utils.MISSING, embed=discord.utils.MISSING, **kwargs):
+        await self.channel.rest()
+        self.channel.edits += 1
+        if content is not discord.utils.MISSING:
+            self.content = content
+        if embed is not discord.utils.MISSING:
+            self.embed = embed
+        return self
+
+    async def delete(self, *, delay=None):
+        await self.channel.rest()
+        self.channel.deletes += 1
+
+
+class FakeTextChannel:
+    # Counts the REST calls it gets; rest_latency is the round trip to Discord
+    def __init__(self, guild, channel_id, rest_latency=0.0):
+        self.guild = guild
+        self.id = channel_id
+        self.rest_latency = rest_latency
+        self.sends = 0
+        self.edits = 0
+        self.deletes = 0
+        self.last_message = None
+
+    async def rest(self):
+        await asyncio.sleep(self.rest_latency)
+
+    async def send(self, content=None, *, embed=None, view=None, **kwargs):
+        await self.rest()
+        self.sends += 1
+        self.last_message = FakeMessage(self, content, embed)
+        if view is not None:
+            self.guild.bot.on_view(view, self.last_message)
+        return self.last_message
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild, channel_id):
+        self.guild = guild
+        self.id = channel_id
+
+    async def connect(self, **kwargs):
+        bot = self.guild.bot
+        await asyncio.sleep(bot.connect_latency)
+        if self.guild.voice_client is not None:
+            raise discord.ClientException('Already connected to a voice channel.')
+        vc = FakeVoiceClient(self, speed=bot.speed, encode=bot.encode)
+        self.guild.voice_client = vc
+        bot.voice_clients.append(vc)
+        return vc
+
+
+class FakeMember:
+    def __init__(self, guild, member_id):
+        self.guild = guild
+        self.id = member_id
+        self.bot = False
+        self.name = self.display_name = f'user{member_id}'
+        self.mention = f'<@{member_id}>'
+        self.voice = SimpleNamespace(channel=guild.voice_channel)
+
+
+class FakeGuild:
+    def __init__(self, bot, guild_id, rest_latency=0.0):
+        self.bot = bot
+        self.id = guild_id
+        self.name = f'guild{guild_id}'
+        self.voice_client = None
+        self.text_channel = FakeTextChannel(self, guild_id * 10 + 1, rest_latency)
+        self.voice_channel = FakeVoiceChannel(self, guild_id * 10 + 2)
+        self.system_channel = self.text_channel
+        self.member = FakeMember(self, guild_id * 10 + 3)
+
+    def get_channel(self, channel_id):
+        for channel in (self.text_channel, self.voice_channel):
+            if channel.id == channel_id:
+                return channel
+        return None
+
+
+class FakeBot:
+    # Just what Music and MusicPlayer reach for on self.bot. on_view is called
+    # with every view (search results, volume picker) a command sends.
+    def __init__(self, speed=1.0, encode=True, connect_latency=0.0):
+        self.loop = asyncio.get_running_loop()
+        self.user = SimpleNamespace(id=1, name='bench')
+        self.voice_clients = []
+        self.speed = speed
+        self.encode = encode
+        self.connect_latency = connect_latency
+
+    def on_view(self, view, message):
+        pass
+
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        # perf_counter() when the interaction was answered, Discord wants that within 3s
+        self.done_at = None
+
+    def is_done(self):
+        return self.done_at is not None
+
+    async def defer(self, **kwargs):
+        await self.interaction.channel.rest()
+        self.done_at = time.perf_counter()
+
+    async def send_message(self, content=None, *, embed=None, view=None, **kwargs):
+        self.interaction.original = await self.interaction.channel.send(content, embed=embed, view=view)
+        self.done_at = time.perf_counter()
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, *, embed=None, view=None, **kwargs):
+        return await self.interaction.channel.send(content, embed=embed, view=view)
+
+
+class FakeInteraction:
+    ids = itertools.count(1)
+
+    def __init__(self, guild, user=None, command=None, data=None):
+        self.id = next(self.ids)
+        self.guild = guild
+        self.guild_id = guild.id
+        self.channel = guild.text_channel
+        self.channel_id = self.channel.id
+        self.user = user or guild.member
+        self.created_at = discord.utils.utcnow()
+        self.command = SimpleNamespace(qualified_name=command) if command else None
+        self.data = data or {}
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.original = None
+
+    async def edit_original_response(self, *, content=discord.utils.MISSING, **kwargs):
+        if self.original is not None:
+            await self.original.edit(content=content, **kwargs)
@@ -0,0 +1,230 @@
+# Synthetic multi-guild load on the Music cog's slash command handlers. Fake
+# guilds (fakes.py) fire /play, /playnext, /queue, /delete, /skip and /volume
+# as Poisson arrivals, so a bot that falls behind gets no breather, against a
+# stub extractor and search. The guild count steps up through --guilds, and
+# every --interval seconds a line is printed:
+#
+#   ack     interaction created until it was deferred/answered (Discord allows 3s)
+#   done    whole handler; menus (search results, volume) include --think
+#   lag     event loop lag, how late a 50ms sleep woke up
+#   pool    searches queued on main.thread_pool / stub extractions waiting
+#   rss     resident memory
+#
+# A per-command summary follows each step. The step where ack p99 or lag
+# runs away is where main.py tips over.
+#
+#   python benchmarks/loadgen.py [--guilds 100,250,500,1000] [--rate 0.2] [--step 30]
+#
+# --rate is commands per second per guild. Playback goes through the fake voice
+# clients and ffmpeg like bench_playback.py; --audio and --speed work the same.
+import argparse
+import asyncio
+import collections
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+import discord
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakes
+
+COMMANDS = ('play', 'playnext', 'queue', 'delete', 'skip', 'volume')
+LAG_PROBE = 0.05
+
+
+def ms(value):
+    return '-' if value is None else f'{value * 1000:.0f}'
+
+
+class LoadBot(fakes.FakeBot):
+    # Users click a random button/option on every menu a command sends, `think` seconds later
+    def __init__(self, think, rng, **kwargs):
+        super().__init__(**kwargs)
+        self.think = think
+        self.rng = rng
+
+    def on_view(self, view, message):
+        self.loop.call_later(self.think, lambda: self.loop.create_task(self.pick(view, message.channel.guild)))
+
+    async def pick(self, view, guild):
+        if view.is_finished():
+            return
+        item = self.rng.choice(view.children)
+        data = {'values': [self.rng.choice(item.options).value]} if isinstance(item, discord.ui.Select) else {}
+        await item.callback(fakes.FakeInteraction(guild, data=data))
+
+
+class LoadGen:
+    def __init__(self, main, music, args, rng):
+        self.main = main
+        self.music = music
+        self.args = args
+        self.rng = rng
+        self.weights = [args.mix.get(command, 0) for command in COMMANDS]
+        self.ids = itertools.count()
+        self.tasks = set()
+        self.reset()
+
+    def reset(self):
+        self.acks = collections.defaultdict(list)
+        self.done = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.lags = []
+        self.issued = 0
+
+    def arguments(self, guild, command):
+        if command in ('play', 'playnext'):
+            if self.rng.random() < self.args.search_ratio:
+                return [f'song {self.rng.randrange(self.args.search_space)}']
+            return [self.main.watch_url(f'L{next(self.ids):010d}')]
+        if command == 'delete':
+            player = self.music.players.get(guild.id)
+            size = len(player.queue) if player else 0
+            return [self.rng.randint(1, size) if size else 1]
+        return []
+
+    async def issue(self, command, interaction, args, start):
+        handler = getattr(self.music, command)
+        try:
+            await handler.callback(self.music, interaction, *args)
+        except Exception as e:
+            self.errors[command] += 1
+            if self.args.verbose:
+                print(f'/{command} failed: {e!r}')
+            return
+        if interaction.response.done_at is not None:
+            self.acks[command].append(interaction.response.done_at - start)
+        self.done[command].append(time.perf_counter() - start)
+
+    async def arrivals(self, guilds, until):
+        rate = self.args.rate * len(guilds)
+        next_at = time.perf_counter()
+        while True:
+            next_at += self.rng.expovariate(rate)
+            if next_at >= until:
+                return
+            # Open loop: when we're behind, the backlog fires straight away
+            await asyncio.sleep(max(0, next_at - time.perf_counter()))
+            guild = self.rng.choice(guilds)
+            command = self.rng.choices(COMMANDS, self.weights)[0]
+            interaction = fakes.FakeInteraction(guild, command=command)
+            task = asyncio.create_task(self.issue(command, interaction, self.arguments(guild, command),
+                                                  time.perf_counter()))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            self.issued += 1
+
+    async def probe_lag(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(LAG_PROBE)
+            self.lags.append(time.perf_counter() - start - LAG_PROBE)
+
+    def line(self, elapsed, guilds, interval):
+        acks = [v for values in self.acks.values() for v in values]
+        done = [v for values in self.done.values() for v in values]
+        ack, total, lag = fakes.percentiles(acks), fakes.percentiles(done), fakes.percentiles(self.lags)
+        queued = sum(len(player.queue) for player in self.music.players.values())
+        print(f'{elapsed:>6.0f}s {len(guilds):>6} {self.issued / interval:>7.1f}/s '
+              f'ack {ms(ack[50]):>5}/{ms(ack[99]):>5}ms  done {ms(total[50]):>5}/{ms(total[99]):>5}ms  '
+              f'err {sum(self.errors.values()):>4}  lag {ms(lag[99]):>4}/{ms(max(self.lags, default=None)):>4}ms  '
+              f'pool {self.main.thread_pool._work_queue.qsize():>4}/{self.main.extract_pool.waiting:<4} '
+              f'vc {len(self.music.bot.voice_clients):>5}  queued {queued:>7}  rss {fakes.rss() / 2 ** 20:>6.0f}MiB')
+
+
+def summary(step_acks, step_done, step_errors):
+    print(f"{'command':<10}{'count':>8}{'ack p50':>10}{'ack p99':>10}{'done p50':>10}{'done p99':>10}{'errors':>8}")
+    for command in COMMANDS:
+        if not step_done[command] and not step_errors[command]:
+            continue
+        ack, done = fakes.percentiles(step_acks[command]), fakes.percentiles(step_done[command])
+        print(f'{command:<10}{len(step_done[command]):>8}{ms(ack[50]):>8}ms{ms(ack[99]):>8}ms'
+              f'{ms(done[50]):>8}ms{ms(done[99]):>8}ms{step_errors[command]:>8}')
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    main = fakes.import_main()
+    files = args.audio or [fakes.make_tone(main.ffmpeg_options['executable'], args.seconds,
+                                           os.path.join(tempfile.mkdtemp(), 'tone.webm'))]
+    main.extract_pool = fakes.StubExtractor(files, latency=args.latency, jitter=args.jitter,
+                                            workers=args.workers, seed=args.seed)
+    import ytcache  # on the path once main is imported
+
+    fakes.StubSearch.latency = args.search_latency
+    ytcache.YoutubeSearch = fakes.StubSearch
+
+    bot = LoadBot(args.think, rng, speed=args.speed, encode=not args.no_encode)
+    music = main.Music(bot)
+    load = LoadGen(main, music, args, rng)
+    guilds = []
+    begin = time.perf_counter()
+    rss_start = fakes.rss()
+    probe = asyncio.create_task(load.probe_lag())
+
+    for count in args.guilds:
+        guilds.extend(fakes.FakeGuild(bot, len(guilds) + 1, rest_latency=args.rest_latency)
+                      for _ in range(count - len(guilds)))
+        rss_before = fakes.rss()
+        print(f'--- {len(guilds)} guilds, {args.rate * len(guilds):.0f} commands/s ---')
+        step_acks, step_done, step_errors = collections.defaultdict(list), collections.defaultdict(list), collections.Counter()
+
+        step_end = time.perf_counter() + args.step
+        arrivals = asyncio.create_task(load.arrivals(guilds, step_end))
+        while time.perf_counter() < step_end:
+            await asyncio.sleep(min(args.interval, step_end - time.perf_counter()))
+            load.line(time.perf_counter() - begin, guilds, args.interval)
+            for command in COMMANDS:
+                step_acks[command] += load.acks[command]
+                step_done[command] += load.done[command]
+            step_errors += load.errors
+            load.reset()
+        await arrivals
+
+        summary(step_acks, step_done, step_errors)
+        print(f'rss {(fakes.rss() - rss_before) / 2 ** 20:+.1f}MiB over the step, '
+              f'{(fakes.rss() - rss_start) / len(guilds) / 1024:.0f}KiB per guild since the start')
+
+    probe.cancel()
+    # Menus still waiting on a click would otherwise hold us up for their timeout
+    for task in list(load.tasks):
+        task.cancel()
+    for guild in guilds:
+        await music.cleanup(guild)
+    main.player_state.close()
+    main.tracer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--guilds', type=lambda v: [int(n) for n in v.split(',')], default=[100, 250, 500, 1000],
+                        help='guild counts to step through, comma separated')
+    parser.add_argument('--rate', type=float, default=0.2, help='commands per second per guild')
+    parser.add_argument('--step', type=float, default=30, help='seconds per guild count')
+    parser.add_argument('--interval', type=float, default=5, help='seconds between report lines')
+    parser.add_argument('--mix', type=lambda v: {k: float(w) for k, w in (p.split('=') for p in v.split(','))},
+                        default={'play': 4, 'playnext': 1, 'queue': 3, 'delete': 1, 'skip': 1, 'volume': 1},
+                        help='command weights, e.g. play=4,queue=3,skip=1')
+    parser.add_argument('--search-ratio', type=float, default=0.5, help='share of /play and /playnext that search')
+    parser.add_argument('--search-space', type=int, default=5000, help='distinct search queries (cache hit rate)')
+    parser.add_argument('--search-latency', type=float, default=0.5, help='stub YoutubeSearch latency')
+    parser.add_argument('--think', type=float, default=1.0, help='seconds before a user clicks a menu')
+    parser.add_argument('--latency', type=float, default=0.3, help='stub extract latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.1, help='random extra extract latency')
+    parser.add_argument('--workers', type=int, default=4, help='concurrent stub extractions')
+    parser.add_argument('--rest-latency', type=float, default=0.05, help='fake Discord REST round trip')
+    parser.add_argument('--speed', type=float, default=1, help='playback clock multiplier, 0 = unthrottled')
+    parser.add_argument('--seconds', type=float, default=10, help='length of the generated test tone')
+    parser.add_argument('--audio', nargs='*', help='local audio files to serve instead of the test tone')
+    parser.add_argument('--no-encode', action='store_true', help="don't Opus-encode PCM frames")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help='print every failed command')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
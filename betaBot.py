@@ -1,13 +1,17 @@
 import asyncio
 import discord
 from discord.ext import commands
-import yt_dlp
 from async_timeout import timeout
-from functools import partial
-from youtube_search import YoutubeSearch
 import os
 from dotenv import load_dotenv
 import concurrent.futures
+from messaging import NowPlaying, message_edits, messages, now_playing_text
+import threading
+from extractpool import ExtractorPool
+from audiofx import DSP_AVAILABLE, BassBoost, EffectsTransformer, PitchShift, SpeedChange
+from ytcache import SearchCache, StreamCache, youtube_search
+from metastore import MetadataStore
+from resolver import StreamResolver
 
 load_dotenv()
 
@@ -35,10 +39,41 @@ ffmpeg_options = {
     'executable': r'C:\ffmpeg\bin\ffmpeg.exe'
 }
 
-ytdl = yt_dlp.YoutubeDL(ydl_opts)
+ydl_playlist_opts = {
+    'extract_flat': 'in_playlist',
+    'skip_download': True,
+}
+
+# yt-dlp runs in worker processes, each with its own YoutubeDL per profile
+extract_pool = ExtractorPool({'default': ydl_opts, 'playlist': ydl_playlist_opts},
+                             workers=int(os.getenv('EXTRACT_WORKERS', '0')) or None)
 
 thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
 
+search_cache = SearchCache(maxsize=int(os.getenv('SEARCH_CACHE_SIZE', '512')),
+                           ttl=int(os.getenv('SEARCH_CACHE_TTL', '600')))
+
+# Resolved stream info keyed by youtube video id, shared by every guild
+stream_cache = StreamCache(max_bytes=int(os.getenv('STREAM_CACHE_BYTES', 8 * 1024 * 1024)))
+
+# Metadata survives restarts so only expired stream urls have to be re-extracted
+metadata_store = None
+
+# stream cache -> metadata store -> yt-dlp, guilds asking for the same
+# video/playlist at the same time share one extraction
+resolver = None
+
+# bass_boost/speed/pitch run in-process on the PCM frames (changed live, no ffmpeg
+# restart); EFFECTS_ENGINE=ffmpeg or a missing scipy falls back to -af filters
+USE_DSP = DSP_AVAILABLE and os.getenv('EFFECTS_ENGINE', 'dsp').lower() != 'ffmpeg'
+DSP_EFFECTS = {'bass': BassBoost, 'atempo': SpeedChange, 'rubberband': PitchShift}
+
+def setup():
+    # Opens the sqlite store (and its writer thread) once we're really starting
+    global metadata_store, resolver
+    metadata_store = MetadataStore(os.getenv('METADATA_DB', 'metadata.db'))
+    resolver = StreamResolver(extract_pool.extract_info, stream_cache, metadata_store)
+
 class AudioEffect:
     def __init__(self, filter_name, params=None):
         self.filter_name = filter_name
@@ -48,7 +83,27 @@ class AudioEffect:
         params_str = ':'.join(f'{k}={v}' for k, v in self.params.items())
         return f"{self.filter_name}={params_str}" if params_str else self.filter_name
 
-class YTDLSource(discord.PCMVolumeTransformer):
+    @property
+    def tempo(self):
+        # How much faster than the original the filter plays the audio
+        return float(self.params.get('tempo', 1)) if self.filter_name == 'atempo' else 1.0
+
+class PrimedSource(discord.AudioSource):
+    # A freshly spawned pipeline whose first frame was already read ahead of the swap
+    def __init__(self, original, first_frame):
+        self.original = original
+        self.first_frame = first_frame
+
+    def read(self):
+        if self.first_frame is not None:
+            frame, self.first_frame = self.first_frame, None
+            return frame
+        return self.original.read()
+
+    def cleanup(self):
+        self.original.cleanup()
+
+class YTDLSource(EffectsTransformer):
     def __init__(self, source, *, data, volume=0.5):
         super().__init__(source, volume)
         self.data = data
@@ -56,29 +111,102 @@ class YTDLSource(discord.PCMVolumeTransformer):
         self.url = data.get('url')
         self.effects = []
 
+        # Playback position bookkeeping: where (in the original track) the current
+        # pipeline started, how many 20ms frames it produced and at what tempo
+        self._offset = 0.0
+        self._frames = 0
+        self._tempo = 1.0
+        self._pending = None
+        self._swap_lock = threading.Lock()
+
     @classmethod
     async def create(cls, url, *, loop=None, stream=False):
-        loop = loop or asyncio.get_event_loop()
-        partial_run = partial(ytdl.extract_info, url, download=not stream)
-        data = await loop.run_in_executor(thread_pool, partial_run)
-        
-        if 'entries' in data:
-            data = data['entries'][0]
-        
+        data = await resolver.resolve(url, stream)
         return cls(await cls.create_source(data['url'], data), data=data)
 
     @staticmethod
-    async def create_source(url, data, effects=None):
+    async def create_source(url, data, effects=None, start=0):
         ffmpeg_options = {
             'options': '-vn',
             'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
         }
+        if start:
+            # Input seeking, ffmpeg jumps straight to the byte range instead of decoding up to it
+            ffmpeg_options['before_options'] += f' -ss {start:.3f}'
         if effects:
             ffmpeg_options['options'] += f" -af {','.join(str(e) for e in effects)}"
         return discord.FFmpegPCMAudio(url, **ffmpeg_options)
 
-    async def recreate_source(self):
-        return await self.create_source(self.url, self.data, self.effects)
+    @property
+    def position(self):
+        return self._offset + self._frames * 0.02 * self._tempo
+
+    async def apply_effects(self):
+        # Spawn the new pipeline at the current position and read its first frame
+        # off the player thread; read() swaps it in on the next frame boundary so
+        # the old pipeline keeps playing until then.
+        loop = asyncio.get_running_loop()
+        start = self.position
+        tempo = 1.0
+        for effect in self.effects:
+            tempo *= effect.tempo
+
+        source = await self.create_source(self.url, self.data, self.effects, start=start)
+        first_frame = await loop.run_in_executor(thread_pool, source.read)
+
+        with self._swap_lock:
+            stale, self._pending = self._pending, (source, first_frame, start, tempo)
+        if stale is not None:
+            stale[0].cleanup()
+
+    def _swap_in(self):
+        source, first_frame, start, tempo = self._pending
+        self._pending = None
+
+        # The old pipeline kept playing while the new one started up, skip
+        # ahead by the same amount so nothing is heard twice
+        skip = int((self.position - start) / (0.02 * tempo))
+        primed = PrimedSource(source, first_frame if skip == 0 else None)
+        for _ in range(skip - 1):
+            source.read()
+
+        old, self.original = self.original, primed
+        self._offset = start + skip * 0.02 * tempo
+        self._frames = 0
+        self._tempo = tempo * self.tempo
+        # Killing ffmpeg can block for a bit, keep it off the player thread
+        threading.Thread(target=old.cleanup, daemon=True).start()
+
+    def set_dsp_effect(self, effect):
+        self._retime(self.set_effect, DSP_EFFECTS[effect.filter_name], next(iter(effect.params.values())))
+
+    def clear_dsp_effects(self):
+        self._retime(self.clear_effects)
+
+    def _retime(self, change, *args):
+        # Rebase the position first, frames played from here on run at the new tempo
+        with self._swap_lock:
+            self._offset, self._frames = self.position, 0
+            change(*args)
+            self._tempo = self.tempo
+            for effect in self.effects:
+                self._tempo *= effect.tempo
+
+    def read(self):
+        with self._swap_lock:
+            if self._pending is not None:
+                self._swap_in()
+        data = super().read()
+        if data:
+            self._frames += 1
+        return data
+
+    def cleanup(self):
+        with self._swap_lock:
+            pending, self._pending = self._pending, None
+        if pending is not None:
+            pending[0].cleanup()
+        super().cleanup()
 
 class Song:
     def __init__(self, url, title=None):
@@ -95,7 +223,7 @@ class MusicPlayer:
         self.queue = asyncio.Queue()
         self.next = asyncio.Event()
 
-        self.np = None
+        self.now_playing = NowPlaying(self._channel, message_edits, self.now_playing_text, dispatcher=messages)
         self.volume = .5
         self.current = None
 
@@ -116,26 +244,30 @@ class MusicPlayer:
             try:
                 source = await YTDLSource.create(song.url, loop=self.bot.loop, stream=True)
             except Exception as e:
-                await self._channel.send(f'There was an error processing your song.\n'
-                                         f'```css\n[{e}]\n```')
+                messages.send(self._channel, f'There was an error processing your song.\n'
+                                             f'```css\n[{e}]\n```')
                 continue
 
             source.volume = self.volume
             self.current = source
 
             self._guild.voice_client.play(source, after=lambda _: self.bot.loop.call_soon_threadsafe(self.next.set))
-            self.np = await self._channel.send(f'**Now Playing:** `{source.title}`')
+            self.now_playing.set_playing(True)
             await self.next.wait()
 
             source.cleanup()
             self.current = None
+            if self.queue.empty():
+                self.now_playing.set_playing(False)
 
-            try:
-                await self.np.delete()
-            except discord.HTTPException:
-                pass
+    def now_playing_text(self):
+        source = self.current
+        if source is None:
+            return now_playing_text(None, queued=self.queue.qsize())
+        return now_playing_text(source.title, source.position, source.data.get('duration'), self.queue.qsize())
 
     def destroy(self, guild):
+        self.now_playing.close()
         return self.bot.loop.create_task(self._cog.cleanup(guild))
 
 class Music(commands.Cog):
@@ -170,7 +302,7 @@ class Music(commands.Cog):
             channel = ctx.author.voice.channel
             await channel.connect()
         else:
-            await ctx.send("You are not connected to a voice channel.")
+            await messages.respond(ctx, "You are not connected to a voice channel.")
 
     @commands.command()
     async def search(self, ctx, *, query: str):
@@ -178,16 +310,15 @@ class Music(commands.Cog):
             self.search_tasks[ctx.author.id].cancel()
 
         try:
-            results = await self.bot.loop.run_in_executor(thread_pool, YoutubeSearch, query, 5)
-            results = results.to_dict()
+            results = await youtube_search(query, 5, search_cache, thread_pool)
             if not results:
-                return await ctx.send('No videos found.')
+                return await messages.respond(ctx, 'No videos found.')
 
             embed = discord.Embed(title="Search Results", description="Choose a song by number:")
             for i, video in enumerate(results, start=1):
                 embed.add_field(name=f"{i}. {video['title']}", value=f"Duration: {video['duration']}", inline=False)
 
-            message = await ctx.send(embed=embed)
+            message = await messages.respond(ctx, embed=embed)
 
             def check(m):
                 return m.author == ctx.author and m.channel == ctx.channel and m.content.isdigit() and 1 <= int(m.content) <= 5
@@ -203,21 +334,24 @@ class Music(commands.Cog):
                 await ctx.invoke(self.play, search=url)
 
             except asyncio.TimeoutError:
-                await message.delete()
-                await ctx.send('Search timed out after 1 minute.')
+                if message:
+                    await message.delete()
+                await messages.respond(ctx, 'Search timed out after 1 minute.')
             except asyncio.CancelledError:
-                await message.delete()
-                await ctx.send('Last search cancelled due to a new search request.')
+                if message:
+                    await message.delete()
+                await messages.respond(ctx, 'Last search cancelled due to a new search request.')
             finally:
                 self.search_tasks.pop(ctx.author.id, None)
 
         except Exception as e:
-            await ctx.send(f'An error occurred: {str(e)}')
+            await messages.respond(ctx, f'An error occurred: {str(e)}')
             print(f"Search error details: {e}")
 
     @commands.command()
     async def play(self, ctx, *, search: str):
-        await ctx.send(f'Processing your request for: {search}')
+        # Not awaited, it can go out together with whatever follows
+        messages.respond(ctx, f'Processing your request for: {search}')
 
         vc = ctx.voice_client
 
@@ -231,29 +365,24 @@ class Music(commands.Cog):
         else:
             song_title = None
             if not search.startswith('http'):
-                results = await self.bot.loop.run_in_executor(thread_pool, YoutubeSearch, search, 1)
-                results = results.to_dict()
+                results = await youtube_search(search, 1, search_cache, thread_pool)
                 if not results:
-                    return await ctx.send('No video found.')
+                    return await messages.respond(ctx, 'No video found.')
                 search = f"https://youtube.com{results[0]['url_suffix']}"
                 song_title = results[0]['title']
             
             song = Song(search, title=song_title)
             await player.queue.put(song)
-            await ctx.send(f'Song Added to queue')
+            await messages.respond(ctx, f'Song Added to queue')
 
     async def process_playlist(self, ctx, url, player):
-        await ctx.send("Processing playlist. This may take a moment...")
+        # Not awaited, it can go out together with whatever follows
+        messages.respond(ctx, "Processing playlist. This may take a moment...")
         try:
-            ydl_opts_playlist = {
-                'extract_flat': 'in_playlist',
-                'skip_download': True,
-            }
-            with yt_dlp.YoutubeDL(ydl_opts_playlist) as ydl:
-                result = await self.bot.loop.run_in_executor(thread_pool, ydl.extract_info, url, False)
+            result = await resolver.playlist(url)
 
             if 'entries' not in result:
-                await ctx.send('Error: Could not find playlist entries.')
+                await messages.respond(ctx, 'Error: Could not find playlist entries.')
                 return
 
             for entry in result['entries'][:10]:
@@ -261,12 +390,12 @@ class Music(commands.Cog):
                 song = Song(video_url, title=entry.get('title', 'Unknown Title'))
                 await player.queue.put(song)
             
-            await ctx.send(f"Added {min(10, len(result['entries']))} songs from the playlist to the queue.")
+            await messages.respond(ctx, f"Added {min(10, len(result['entries']))} songs from the playlist to the queue.")
             
             if len(result['entries']) > 10:
-                await ctx.send("Note: Only the first 10 songs from the playlist were added to avoid overloading.")
+                await messages.respond(ctx, "Note: Only the first 10 songs from the playlist were added to avoid overloading.")
         except Exception as e:
-            await ctx.send(f'An error occurred while processing the playlist: {str(e)}')
+            await messages.respond(ctx, f'An error occurred while processing the playlist: {str(e)}')
             print(f"Playlist error details: {e}")
 
     @commands.command()
@@ -274,50 +403,50 @@ class Music(commands.Cog):
         vc = ctx.voice_client
         if vc and vc.is_playing():
             vc.pause()
-            await ctx.send("Paused ⏸️")
+            await messages.respond(ctx, "Paused ⏸️")
         else:
-            await ctx.send("Nothing is playing.")
+            await messages.respond(ctx, "Nothing is playing.")
 
     @commands.command()
     async def resume(self, ctx):
         vc = ctx.voice_client
         if vc and vc.is_paused():
             vc.resume()
-            await ctx.send("Resumed ▶️")
+            await messages.respond(ctx, "Resumed ▶️")
         else:
-            await ctx.send("The audio is not paused.")
+            await messages.respond(ctx, "The audio is not paused.")
 
     @commands.command()
     async def skip(self, ctx):
         vc = ctx.voice_client
         if vc and vc.is_playing():
             vc.stop()
-            await ctx.send("Skipped ⏭️")
+            await messages.respond(ctx, "Skipped ⏭️")
         else:
-            await ctx.send("Nothing is playing.")
+            await messages.respond(ctx, "Nothing is playing.")
 
     @commands.command()
     async def queue(self, ctx):
         player = self.get_player(ctx)
         if player.queue.empty():
-            return await ctx.send('There are currently no more queued songs.')
+            return await messages.respond(ctx, 'There are currently no more queued songs.')
 
         upcoming = list(player.queue._queue)
         fmt = '\n'.join(f'`{i+1}.` **{song.title}**' for i, song in enumerate(upcoming))
         embed = discord.Embed(title=f'Upcoming - Next {len(upcoming)}', description=fmt)
-        await ctx.send(embed=embed)
+        await messages.respond(ctx, embed=embed)
 
     @commands.command()
     async def delete(self, ctx, number: int = None):
         if number is None:
-            return await ctx.send('Please provide a number to delete a song from the queue. Usage: `!delete <number>`')
+            return await messages.respond(ctx, 'Please provide a number to delete a song from the queue. Usage: `!delete <number>`')
 
         player = self.get_player(ctx)
         if player.queue.empty():
-            return await ctx.send('The queue is empty.')
+            return await messages.respond(ctx, 'The queue is empty.')
         
         if number < 1 or number > player.queue.qsize():
-            return await ctx.send(f'Please provide a valid number between 1 and {player.queue.qsize()}.')
+            return await messages.respond(ctx, f'Please provide a valid number between 1 and {player.queue.qsize()}.')
         
         queue_list = list(player.queue._queue)
         removed_song = queue_list.pop(number - 1)
@@ -325,15 +454,15 @@ class Music(commands.Cog):
         for song in queue_list:
             await player.queue.put(song)
         
-        await ctx.send(f'Removed song: **{removed_song.title}**')
+        await messages.respond(ctx, f'Removed song: **{removed_song.title}**')
 
     @commands.command()
     async def now_playing(self, ctx):
         vc = ctx.voice_client
         if vc and vc.is_playing():
-            await ctx.send(f'Now playing: {vc.source.title}')
+            await messages.respond(ctx, f'Now playing: {vc.source.title}')
         else:
-            await ctx.send('Nothing is currently playing.')
+            await messages.respond(ctx, 'Nothing is currently playing.')
 
     @commands.command()
     async def volume(self, ctx, volume: int):
@@ -341,20 +470,20 @@ class Music(commands.Cog):
         if vc:
             if 0 <= volume <= 100:
                 vc.source.volume = volume / 100
-                await ctx.send(f"Changed volume to {volume}%")
+                await messages.respond(ctx, f"Changed volume to {volume}%")
             else:
-                await ctx.send("Please use a value between 0 and 100")
+                await messages.respond(ctx, "Please use a value between 0 and 100")
         else:
-            await ctx.send("Not connected to a voice channel.")
+            await messages.respond(ctx, "Not connected to a voice channel.")
 
     @commands.command()
     async def clear_queue(self, ctx):
         player = self.get_player(ctx)
         if player.queue.empty():
-            await ctx.send("The queue is already empty.")
+            await messages.respond(ctx, "The queue is already empty.")
         else:
             player.queue._queue.clear()
-            await ctx.send("The queue has been cleared.")
+            await messages.respond(ctx, "The queue has been cleared.")
 
     @commands.command()
     async def stop(self, ctx):
@@ -363,28 +492,28 @@ class Music(commands.Cog):
             player = self.get_player(ctx)
             player.queue._queue.clear()
             await self.cleanup(ctx.guild)
-            await ctx.send("Stopped, cleared the queue, and disconnected.")
+            await messages.respond(ctx, "Stopped, cleared the queue, and disconnected.")
         else:
-            await ctx.send("Not connected to a voice channel.")
+            await messages.respond(ctx, "Not connected to a voice channel.")
 
     @commands.command()
     async def bass_boost(self, ctx, level: int = 5):
         if not 1 <= level <= 10:
-            return await ctx.send('Bass boost level must be between 1 and 10.')
+            return await messages.respond(ctx, 'Bass boost level must be between 1 and 10.')
         effect = AudioEffect('bass', {'g': level})
         await self._apply_effect(ctx, effect)
 
     @commands.command()
     async def speed(self, ctx, value: float):
         if not 0.5 <= value <= 2:
-            return await ctx.send('Speed must be between 0.5 and 2.')
+            return await messages.respond(ctx, 'Speed must be between 0.5 and 2.')
         effect = AudioEffect('atempo', {'tempo': value})
         await self._apply_effect(ctx, effect)
 
     @commands.command()
     async def pitch(self, ctx, value: float):
         if not 0.5 <= value <= 2:
-            return await ctx.send('Pitch must be between 0.5 and 2.')
+            return await messages.respond(ctx, 'Pitch must be between 0.5 and 2.')
         effect = AudioEffect('rubberband', {'pitch': value})
         await self._apply_effect(ctx, effect)
 
@@ -392,30 +521,35 @@ class Music(commands.Cog):
     async def reset_effects(self, ctx):
         vc = ctx.voice_client
         if not vc or not vc.is_playing():
-            return await ctx.send('Nothing is currently playing.')
+            return await messages.respond(ctx, 'Nothing is currently playing.')
         
         source = vc.source
         if isinstance(source, YTDLSource):
-            source.effects.clear()
-            new_source = await source.recreate_source()
-            vc.source = new_source
-            await ctx.send('Reset all audio effects.')
+            source.clear_dsp_effects()
+            if source.effects:
+                source.effects.clear()
+                await source.apply_effects()
+            await messages.respond(ctx, 'Reset all audio effects.')
         else:
-            await ctx.send('Cannot reset effects for this audio source.')
+            await messages.respond(ctx, 'Cannot reset effects for this audio source.')
 
     async def _apply_effect(self, ctx, effect):
         vc = ctx.voice_client
         if not vc or not vc.is_playing():
-            return await ctx.send('Nothing is currently playing.')
+            return await messages.respond(ctx, 'Nothing is currently playing.')
         
         source = vc.source
         if isinstance(source, YTDLSource):
+            if USE_DSP and effect.filter_name in DSP_EFFECTS:
+                source.set_dsp_effect(effect)
+                return await messages.respond(ctx, f'Applied {effect.filter_name} effect.')
+            # A new value for an effect replaces the old one instead of stacking on it
+            source.effects = [e for e in source.effects if e.filter_name != effect.filter_name]
             source.effects.append(effect)
-            new_source = await source.recreate_source()
-            vc.source = new_source
-            await ctx.send(f'Applied {effect.filter_name} effect.')
+            await source.apply_effects()
+            await messages.respond(ctx, f'Applied {effect.filter_name} effect.')
         else:
-            await ctx.send('Cannot apply effects to this audio source.')
+            await messages.respond(ctx, 'Cannot apply effects to this audio source.')
 
 intents = discord.Intents.default()
 intents.message_content = True
@@ -428,8 +562,10 @@ async def on_ready():
     print('------')
     await bot.add_cog(Music(bot))
 
-TOKEN = os.getenv('DISCORD_BOT_TOKEN')
-if not TOKEN:
-    raise ValueError("No token found. Please set the DISCORD_BOT_TOKEN environment variable.")
+if __name__ == '__main__':
+    TOKEN = os.getenv('DISCORD_BOT_TOKEN')
+    if not TOKEN:
+        raise ValueError("No token found. Please set the DISCORD_BOT_TOKEN environment variable.")
 
-bot.run(TOKEN)
\ No newline at end of file
+    setup()
+    bot.run(TOKEN)
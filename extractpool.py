@@ -0,0 +1,240 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import multiprocessing
+import os
+import sys
+import types
+
+# Big parts of the info dict nobody here looks at, not worth pickling back
+_DROP_KEYS = ('automatic_captions', 'subtitles', 'thumbnails', 'heatmap', 'chapters')
+
+# All we keep per entry when streaming a playlist
+_ENTRY_KEYS = ('id', 'title', 'duration', 'url')
+
+
+class ExtractionError(Exception):
+    pass
+
+
+def _iter_entries(ydl, url):
+    # process=False hands back the extractor's lazy entry generator, so pages
+    # are only fetched from youtube as we walk it
+    info = ydl.extract_info(url, download=False, process=False)
+    while info.get('_type') in ('url', 'url_transparent') and not info.get('entries'):
+        info = ydl.extract_info(info['url'], download=False, ie_key=info.get('ie_key'), process=False)
+
+    if info.get('entries') is None:
+        yield {k: info.get(k) for k in _ENTRY_KEYS}
+        return
+    for entry in info['entries']:
+        if entry:
+            yield {k: entry.get(k) for k in _ENTRY_KEYS}
+
+
+def _stream_entries(conn, ydl, url, page_size):
+    page = []
+    for entry in _iter_entries(ydl, url):
+        page.append(entry)
+        if len(page) >= page_size:
+            conn.send(('page', page))
+            page = []
+            # Wait for the caller to ask for more, it may already have enough
+            if conn.recv()[0] != 'more':
+                return
+    if page:
+        conn.send(('page', page))
+        if conn.recv()[0] != 'more':
+            return
+
+
+def _worker_main(conn, profiles):
+    import yt_dlp
+
+    # One long lived YoutubeDL per profile, only ever used by this process
+    instances = {name: yt_dlp.YoutubeDL(opts) for name, opts in profiles.items()}
+
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if request is None:
+            break
+
+        op, profile, url, arg = request
+        ydl = instances[profile]
+        if op == 'iter':
+            try:
+                _stream_entries(conn, ydl, url, arg)
+                response = ('done', None)
+            except Exception as e:
+                response = ('error', str(e))
+            try:
+                conn.send(response)
+            except (BrokenPipeError, OSError):
+                break
+            continue
+
+        download = arg
+        try:
+            info = ydl.extract_info(url, download=download)
+            if download:
+                downloads = info.get('requested_downloads') or [{}]
+                info['filepath'] = downloads[0].get('filepath') or ydl.prepare_filename(info)
+            info = ydl.sanitize_info(info)
+            for key in _DROP_KEYS:
+                info.pop(key, None)
+            for entry in info.get('entries') or ():
+                for key in _DROP_KEYS:
+                    entry and entry.pop(key, None)
+            response = ('ok', info)
+        except Exception as e:
+            response = ('error', str(e))
+
+        try:
+            conn.send(response)
+        except (BrokenPipeError, OSError):
+            break
+
+
+@contextlib.contextmanager
+def _hidden_main():
+    # spawn runs the parent's __main__ script again in every child (as
+    # __mp_main__), which for the bots means discord, numpy, their stores
+    # and the bot itself. A worker only needs this module, so while it starts
+    # there is no script to find.
+    main = sys.modules['__main__']
+    sys.modules['__main__'] = types.ModuleType('__main__')
+    try:
+        yield
+    finally:
+        sys.modules['__main__'] = main
+
+
+class _Worker:
+    def __init__(self, context, profiles):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, profiles), daemon=True)
+        with _hidden_main():
+            self.process.start()
+        child_conn.close()
+
+    def call(self, request):
+        self.conn.send(request)
+        return self.conn.recv()
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=2)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+
+class ExtractorPool:
+    # Runs yt-dlp in worker processes so parsing doesn't hold our GIL.
+    # Each worker handles one request at a time, callers queue for an idle one.
+    def __init__(self, profiles, workers=None):
+        self.profiles = profiles
+        self.size = workers or os.cpu_count() or 2
+        self.busy = 0
+        self.waiting = 0
+        self._context = multiprocessing.get_context('spawn')
+        self._idle = None
+        self._workers = []
+        # Blocking pipe reads happen here, one thread per worker is enough
+        self._io = concurrent.futures.ThreadPoolExecutor(max_workers=self.size, thread_name_prefix='extract-io')
+
+    def _start(self):
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            worker = _Worker(self._context, self.profiles)
+            self._workers.append(worker)
+            self._idle.put_nowait(worker)
+
+    async def _acquire(self):
+        if self._idle is None:
+            self._start()
+
+        self.waiting += 1
+        try:
+            worker = await self._idle.get()
+        finally:
+            self.waiting -= 1
+        self.busy += 1
+        return worker
+
+    def _release(self, worker, broken=False):
+        self.busy -= 1
+        if broken:
+            # The process died, the pipe broke or we lost track of the protocol: replace it
+            self._workers.remove(worker)
+            worker.close()
+            worker = _Worker(self._context, self.profiles)
+            self._workers.append(worker)
+        self._idle.put_nowait(worker)
+
+    async def extract_info(self, url, download=False, profile='default'):
+        worker = await self._acquire()
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._io, worker.call, ('extract', profile, url, download))
+        future.add_done_callback(lambda f: self._release(worker, f.exception() is not None))
+
+        try:
+            # shielded so a cancelled caller can't hand the worker back mid-request
+            status, result = await asyncio.shield(future)
+        except (EOFError, OSError) as e:
+            raise ExtractionError(f'Extractor process failed: {e}') from e
+
+        if status == 'error':
+            raise ExtractionError(result)
+        return result
+
+    async def iter_entries(self, url, page_size=50, profile='playlist'):
+        # Yields lists of flat playlist entries as the worker walks the playlist.
+        # Stopping early (break/aclose) tells the worker to stop fetching pages.
+        worker = await self._acquire()
+        loop = asyncio.get_running_loop()
+        finished = False
+        receiving = False
+        try:
+            worker.conn.send(('iter', profile, url, page_size))
+            while True:
+                receiving = True
+                kind, payload = await loop.run_in_executor(self._io, worker.conn.recv)
+                receiving = False
+                if kind == 'page':
+                    yield payload
+                    worker.conn.send(('more',))
+                    continue
+                finished = True
+                if kind == 'error':
+                    raise ExtractionError(payload)
+                return
+        except (EOFError, OSError) as e:
+            raise ExtractionError(f'Extractor process failed: {e}') from e
+        finally:
+            if finished:
+                self._release(worker)
+            elif receiving:
+                # Cancelled while a read was outstanding, we can't resync the pipe
+                self._release(worker, broken=True)
+            else:
+                future = loop.run_in_executor(self._io, self._stop_iteration, worker)
+                future.add_done_callback(lambda f: self._release(worker, f.exception() is not None))
+
+    @staticmethod
+    def _stop_iteration(worker):
+        worker.conn.send(('stop',))
+        while worker.conn.recv()[0] not in ('done', 'error'):
+            pass
+
+    def close(self):
+        for worker in self._workers:
+            worker.close()
+        self._workers.clear()
+        self._io.shutdown(wait=False)
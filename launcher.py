@@ -0,0 +1,266 @@
+# Runs the Music bot from main.py as an AutoShardedBot split over several
+# processes, each owning a contiguous range of shards, so voice encoding and
+# event handling scale with cores instead of sharing one interpreter.
+#
+#   python launcher.py
+#
+# SHARD_COUNT      total shards (default: what Discord recommends)
+# SHARD_PROCESSES  worker processes (default: cpu count, never more than shards)
+import asyncio
+import glob
+import json
+import math
+import multiprocessing
+import os
+import queue
+import time
+
+import aiohttp
+from dotenv import load_dotenv
+
+from playerstate import load_states, write_states
+
+load_dotenv()
+
+HEARTBEAT_INTERVAL = float(os.getenv('SHARD_HEARTBEAT_INTERVAL', '10'))
+# A worker that hasn't reported for this long is considered hung and restarted
+HEARTBEAT_TIMEOUT = float(os.getenv('SHARD_HEARTBEAT_TIMEOUT', '90'))
+STATUS_PATH = os.getenv('SHARD_STATUS_PATH', 'shard_status.json')
+MAX_RESTART_DELAY = 60
+# Discord allows one IDENTIFY per 5 seconds per concurrency bucket
+IDENTIFY_INTERVAL = 5
+
+
+def shard_ranges(shard_count, processes):
+    processes = max(1, min(processes, shard_count))
+    per_process, extra = divmod(shard_count, processes)
+    ranges, start = [], 0
+    for i in range(processes):
+        size = per_process + (1 if i < extra else 0)
+        ranges.append(list(range(start, start + size)))
+        start += size
+    return ranges
+
+
+def state_path(index):
+    root, ext = os.path.splitext(os.getenv('PLAYER_STATE_PATH', 'player_state.jsonl'))
+    return f'{root}.{index}{ext}'
+
+
+def partition_player_state(ranges, shard_count):
+    # Each worker keeps its guilds' player state in its own log (the logs are
+    # append-only, one writer each). Which worker owns a guild depends on
+    # SHARD_COUNT and SHARD_PROCESSES, so before the workers start every log
+    # (and a plain main.py one) is split again by the current layout.
+    plain = os.getenv('PLAYER_STATE_PATH', 'player_state.jsonl')
+    root, ext = os.path.splitext(plain)
+    paths = [path for path in glob.glob(f'{glob.escape(root)}.*{ext}')
+             if path[len(root) + 1:len(path) - len(ext)].isdigit()]
+    if os.path.exists(plain):
+        paths.append(plain)
+    if not paths:
+        return
+
+    owner = {shard_id: index for index, shard_ids in enumerate(ranges) for shard_id in shard_ids}
+    split = [{} for _ in ranges]
+    # Oldest first, so if a guild somehow ended up in two logs the newer one wins
+    for path in sorted(paths, key=os.path.getmtime):
+        for guild_id, state in load_states(path)[0].items():
+            split[owner[(guild_id >> 22) % shard_count]][guild_id] = state
+
+    keep = set()
+    for index, states in enumerate(split):
+        if states:
+            write_states(state_path(index), states)
+            keep.add(state_path(index))
+    for path in paths:
+        if path not in keep:
+            os.remove(path)
+    print(f"[launcher] {sum(map(len, split))} saved guild queue(s) split over {len(ranges)} workers")
+
+
+async def fetch_gateway(token):
+    async with aiohttp.ClientSession() as session:
+        async with session.get('https://discord.com/api/v10/gateway/bot',
+                               headers={'Authorization': f'Bot {token}'}) as response:
+            response.raise_for_status()
+            return await response.json()
+
+
+def _worker_main(index, shard_ids, shard_count, token, heartbeats):
+    # The player state log is append-only per process, give every worker its own
+    # (see partition_player_state). metadata.db is shared, sqlite copes with several writers.
+    os.environ['PLAYER_STATE_PATH'] = state_path(index)
+    # Each worker serves its own /metrics on METRICS_PORT + worker index
+    if int(os.getenv('METRICS_PORT', '0')):
+        os.environ['METRICS_PORT'] = str(int(os.environ['METRICS_PORT']) + index)
+    import main
+
+    bot = main.create_bot(shard_ids=shard_ids, shard_count=shard_count, sync_commands=0 in shard_ids)
+
+    async def report_health():
+        await bot.wait_until_ready()
+        while not bot.is_closed():
+            music = bot.get_cog('Music')
+            heartbeats.put({
+                'worker': index,
+                'pid': os.getpid(),
+                'time': time.time(),
+                'shards': {
+                    shard_id: {
+                        'latency': None if math.isinf(latency) else round(latency * 1000),
+                        'closed': bot.get_shard(shard_id).is_closed(),
+                    } for shard_id, latency in bot.latencies
+                },
+                'guilds': len(bot.guilds),
+                'voice_clients': len(bot.voice_clients),
+                'players': len(music.players) if music else 0,
+                'queued': sum(len(p.queue) for p in music.players.values()) if music else 0,
+            })
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    async def run():
+        async with bot:
+            bot.loop.create_task(report_health())
+            await bot.start(token)
+
+    asyncio.run(run())
+
+
+class Worker:
+    def __init__(self, context, index, shard_ids, shard_count, token, heartbeats):
+        self.context = context
+        self.index = index
+        self.shard_ids = shard_ids
+        self.args = (index, shard_ids, shard_count, token, heartbeats)
+        self.process = None
+        self.started_at = 0
+        self.last_report = None
+        self.restarts = 0
+        self.restart_at = 0
+
+    def start(self):
+        self.process = self.context.Process(target=_worker_main, args=self.args,
+                                            name=f'shards-{self.shard_ids[0]}-{self.shard_ids[-1]}')
+        self.process.start()
+        self.started_at = time.time()
+        self.last_report = None
+
+    def stop(self):
+        if self.process and self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout=10)
+            if self.process.is_alive():
+                self.process.kill()
+
+    @property
+    def last_seen(self):
+        return self.last_report['time'] if self.last_report else self.started_at
+
+    def hung(self, now):
+        if self.last_report is None:
+            # Nothing is reported until every shard has identified, one by one
+            return now - self.started_at > HEARTBEAT_TIMEOUT + IDENTIFY_INTERVAL * len(self.shard_ids)
+        return now - self.last_seen > HEARTBEAT_TIMEOUT
+
+    def status(self):
+        report = self.last_report or {}
+        return {
+            'worker': self.index,
+            'shards': [self.shard_ids[0], self.shard_ids[-1]],
+            'pid': self.process.pid if self.process else None,
+            'alive': bool(self.process and self.process.is_alive()),
+            'restarts': self.restarts,
+            'last_seen': round(time.time() - self.last_seen, 1),
+            **{k: report.get(k) for k in ('guilds', 'voice_clients', 'players', 'queued', 'shards') if k in report},
+        }
+
+
+def write_status(workers):
+    status = {'time': time.time(), 'workers': [worker.status() for worker in workers]}
+    tmp = STATUS_PATH + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(status, f)
+    os.replace(tmp, STATUS_PATH)
+
+    alive = sum(s['alive'] for s in status['workers'])
+    guilds = sum(s.get('guilds') or 0 for s in status['workers'])
+    voice = sum(s.get('voice_clients') or 0 for s in status['workers'])
+    print(f"[launcher] {alive}/{len(workers)} workers up, {guilds} guilds, {voice} voice connections")
+
+
+def supervise(workers, heartbeats, start_delay):
+    # Stagger the first start so the workers don't all IDENTIFY at once
+    for worker in workers:
+        worker.start()
+        time.sleep(start_delay * len(worker.shard_ids))
+
+    next_status = time.time()
+    while True:
+        try:
+            report = heartbeats.get(timeout=1)
+            while True:
+                workers[report['worker']].last_report = report
+                report = heartbeats.get_nowait()
+        except queue.Empty:
+            pass
+
+        now = time.time()
+        for worker in workers:
+            if worker.restart_at:
+                if now >= worker.restart_at:
+                    worker.restart_at = 0
+                    worker.start()
+                continue
+
+            dead = not worker.process.is_alive()
+            hung = worker.hung(now)
+            if not dead and not hung:
+                # Healthy for a while, forget about earlier crashes
+                if worker.restarts and now - worker.started_at > 300:
+                    worker.restarts = 0
+                continue
+
+            print(f"[launcher] worker {worker.index} (shards {worker.shard_ids[0]}-{worker.shard_ids[-1]}) "
+                  f"{'exited with ' + str(worker.process.exitcode) if dead else 'stopped reporting'}, restarting")
+            worker.stop()
+            worker.restarts += 1
+            worker.restart_at = now + min(MAX_RESTART_DELAY, 2 ** worker.restarts)
+
+        if now >= next_status:
+            write_status(workers)
+            next_status = now + HEARTBEAT_INTERVAL
+
+
+def main():
+    token = os.getenv('DISCORD_BOT_TOKEN')
+    if not token:
+        raise ValueError("No token found. Please set the DISCORD_BOT_TOKEN environment variable.")
+
+    gateway = asyncio.run(fetch_gateway(token))
+    shard_count = int(os.getenv('SHARD_COUNT', '0')) or gateway['shards']
+    max_concurrency = gateway.get('session_start_limit', {}).get('max_concurrency', 1)
+    processes = int(os.getenv('SHARD_PROCESSES', '0')) or os.cpu_count() or 1
+    ranges = shard_ranges(shard_count, processes)
+
+    # Each worker runs its own yt-dlp pool, split the cores between them
+    os.environ.setdefault('EXTRACT_WORKERS', str(max(2, (os.cpu_count() or 2) // len(ranges))))
+
+    partition_player_state(ranges, shard_count)
+
+    context = multiprocessing.get_context('spawn')
+    heartbeats = context.Queue()
+    workers = [Worker(context, i, shard_ids, shard_count, token, heartbeats) for i, shard_ids in enumerate(ranges)]
+    print(f"[launcher] {shard_count} shards over {len(workers)} processes")
+
+    try:
+        supervise(workers, heartbeats, IDENTIFY_INTERVAL / max_concurrency)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.stop()
+
+
+if __name__ == '__main__':
+    main()
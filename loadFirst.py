@@ -1,17 +1,18 @@
 import asyncio
 import discord
 from discord.ext import commands, tasks
-import yt_dlp
 from async_timeout import timeout
-from functools import partial
-from youtube_search import YoutubeSearch
 import os
 from dotenv import load_dotenv
 import concurrent.futures
+from messaging import NowPlaying, message_edits, messages, now_playing_text
+from extractpool import ExtractorPool
+from audiofx import VolumeTransformer
+from ytcache import SearchCache, video_id, youtube_search
+from audiocache import AudioCache
 import json
 import aiohttp
 from datetime import datetime, time, timezone
-from functools import partial
 # Load environment variables use python 3.10 please 
 load_dotenv()
 
@@ -22,7 +23,7 @@ ydl_opts = {
         'preferredcodec': 'mp3',
         'preferredquality': '192',
     }],
-    'outtmpl': 'downloads/%(title)s.%(ext)s',
+    'outtmpl': 'downloads/%(extractor)s-%(id)s.%(ext)s',
     'restrictfilenames': True,
     'noplaylist': True,
     'nocheckcertificate': True,
@@ -39,28 +40,86 @@ ffmpeg_options = {
     'executable': r'C:\ffmpeg\bin\ffmpeg.exe'
 }
 
-ytdl = yt_dlp.YoutubeDL(ydl_opts)
+ydl_playlist_opts = {
+    'extract_flat': 'in_playlist',
+    'skip_download': True,
+}
+
+# yt-dlp runs in worker processes, each with its own YoutubeDL per profile
+extract_pool = ExtractorPool({'default': ydl_opts, 'playlist': ydl_playlist_opts},
+                             workers=int(os.getenv('EXTRACT_WORKERS', '0')) or None)
 
 # Create a ThreadPoolExecutor
 thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
 
-class YTDLSource(discord.PCMVolumeTransformer):
-    def __init__(self, source, *, data, volume=0.5):
+# Finished downloads, played straight from disk next time
+audio_cache = None
+
+# How many playlist tracks get downloaded/transcoded at the same time
+PLAYLIST_DOWNLOAD_CONCURRENCY = int(os.getenv('PLAYLIST_DOWNLOAD_CONCURRENCY', '3'))
+
+search_cache = SearchCache(maxsize=int(os.getenv('SEARCH_CACHE_SIZE', '512')),
+                           ttl=int(os.getenv('SEARCH_CACHE_TTL', '600')))
+
+def setup():
+    # Creates the cache directory and reads its index once we're really starting
+    global audio_cache
+    audio_cache = AudioCache(os.getenv('AUDIO_CACHE_DIR', 'audio_cache'),
+                             max_bytes=int(os.getenv('AUDIO_CACHE_BYTES', 2 * 1024 ** 3)))
+
+class YTDLSource(VolumeTransformer):
+    def __init__(self, source, *, data, volume=0.5, cache_key=None):
         super().__init__(source, volume)
         self.data = data
         self.title = data.get('title')
         self.url = data.get('url')
+        # Keeps the cached file from being evicted while it is queued/playing
+        self.cache_key = cache_key
+        if cache_key:
+            audio_cache.pin(cache_key)
+        self._frames = 0
+
+    @property
+    def position(self):
+        # Always played from the start, every read() is 20ms
+        return self._frames * 0.02
+
+    def read(self):
+        data = super().read()
+        if data:
+            self._frames += 1
+        return data
 
     @classmethod
     async def from_url(cls, url, *, loop=None, stream=False):
         loop = loop or asyncio.get_event_loop()
-        data = await loop.run_in_executor(None, lambda: ytdl.extract_info(url, download=not stream))
-        
+        key = None
+        if not stream and video_id(url):
+            key = AudioCache.key_for('youtube', video_id(url))
+            cached = audio_cache.get(key)
+            if cached is not None:
+                filename, title = cached
+                data = {'id': video_id(url), 'title': title, 'url': filename}
+                return cls(discord.FFmpegPCMAudio(filename, **ffmpeg_options), data=data, cache_key=key)
+
+        data = await extract_pool.extract_info(url, download=not stream)
+
         if 'entries' in data:
             data = data['entries'][0]
 
-        filename = ytdl.prepare_filename(data)
-        return cls(discord.FFmpegPCMAudio(filename, **ffmpeg_options), data=data)
+        if stream:
+            return cls(discord.FFmpegPCMAudio(data['url'], **ffmpeg_options), data=data)
+
+        # The worker reports where the post-processed (mp3) file ended up
+        key = AudioCache.key_for(data.get('extractor_key') or data.get('extractor') or 'generic', data['id'])
+        filename = await loop.run_in_executor(thread_pool, audio_cache.put, key, data['filepath'], data.get('title'))
+        return cls(discord.FFmpegPCMAudio(filename, **ffmpeg_options), data=data, cache_key=key)
+
+    def cleanup(self):
+        super().cleanup()
+        if self.cache_key:
+            audio_cache.unpin(self.cache_key)
+            self.cache_key = None
 
 class Song:
     def __init__(self, url, title=None):
@@ -77,7 +136,7 @@ class MusicPlayer:
         self.queue = asyncio.Queue()
         self.next = asyncio.Event()
 
-        self.np = None
+        self.now_playing = NowPlaying(self._channel, message_edits, self.now_playing_text, dispatcher=messages)
         self.volume = .5
         self.current = None
 
@@ -99,8 +158,8 @@ class MusicPlayer:
                 try:
                     source = await YTDLSource.from_url(source, loop=self.bot.loop, stream=False)
                 except Exception as e:
-                    await self._channel.send(f'There was an error processing your song.\n'
-                                             f'```css\n[{e}]\n```')
+                    messages.send(self._channel, f'There was an error processing your song.\n'
+                                                 f'```css\n[{e}]\n```')
                     continue
 
             source.volume = self.volume
@@ -108,25 +167,29 @@ class MusicPlayer:
 
             try:
                 self._guild.voice_client.play(source, after=lambda e: self.bot.loop.call_soon_threadsafe(self.play_next_song, e))
-                self.np = await self._channel.send(f'**Now Playing:** `{source.title}`')
+                self.now_playing.set_playing(True)
                 await self.next.wait()
             except Exception as e:
-                await self._channel.send(f'An error occurred while playing the song: {str(e)}')
+                messages.send(self._channel, f'An error occurred while playing the song: {str(e)}')
             finally:
                 if source:
                     source.cleanup()
                 self.current = None
-
-                try:
-                    await self.np.delete()
-                except discord.HTTPException:
-                    pass
+                if self.queue.empty():
+                    self.now_playing.set_playing(False)
+
+    def now_playing_text(self):
+        source = self.current
+        if source is None:
+            return now_playing_text(None, queued=self.queue.qsize())
+        return now_playing_text(source.title, source.position, source.data.get('duration'), self.queue.qsize())
     def play_next_song(self, error=None):
         if error:
             print(f"An error occurred: {error}")  # You might want to log this or send to a logging channel
         self.next.set()
 
     def destroy(self, guild):
+        self.now_playing.close()
         return self.bot.loop.create_task(self._cog.cleanup(guild))
 
 class Music(commands.Cog):
@@ -140,16 +203,15 @@ class Music(commands.Cog):
             self.search_tasks[ctx.author.id].cancel()
 
         try:
-            results = await self.bot.loop.run_in_executor(thread_pool, YoutubeSearch, query, 5)
-            results = results.to_dict()
+            results = await youtube_search(query, 5, search_cache, thread_pool)
             if not results:
-                return await ctx.send('No videos found.')
+                return await messages.respond(ctx, 'No videos found.')
 
             embed = discord.Embed(title="Search Results", description="Choose a song by number:")
             for i, video in enumerate(results, start=1):
                 embed.add_field(name=f"{i}. {video['title']}", value=f"Duration: {video['duration']}", inline=False)
 
-            message = await ctx.send(embed=embed)
+            message = await messages.respond(ctx, embed=embed)
 
             def check(m):
                 return m.author == ctx.author and m.channel == ctx.channel and m.content.isdigit() and 1 <= int(m.content) <= 5
@@ -166,17 +228,19 @@ class Music(commands.Cog):
                 await ctx.invoke(self.play, url=url)
 
             except asyncio.TimeoutError:
-                await message.delete()
-                await ctx.send('Search timed out after 1 minute.')
+                if message:
+                    await message.delete()
+                await messages.respond(ctx, 'Search timed out after 1 minute.')
             except asyncio.CancelledError:
-                await message.delete()
-                await ctx.send('Last search cancelled due to a new search request.')
+                if message:
+                    await message.delete()
+                await messages.respond(ctx, 'Last search cancelled due to a new search request.')
             finally:
                 # Remove the task from the dictionary
                 self.search_tasks.pop(ctx.author.id, None)
 
         except Exception as e:
-            await ctx.send(f'An error occurred: {str(e)}')
+            await messages.respond(ctx, f'An error occurred: {str(e)}')
             print(f"Search error details: {e}")
     
     async def cleanup(self, guild):
@@ -204,7 +268,7 @@ class Music(commands.Cog):
         if ctx.author.voice:
             await ctx.author.voice.channel.connect()
         else:
-            await ctx.send("You are not connected to a voice channel.")
+            await messages.respond(ctx, "You are not connected to a voice channel.")
 
     @commands.command()
     async def play(self, ctx, *, url):
@@ -220,34 +284,61 @@ class Music(commands.Cog):
                 try:
                     source = await YTDLSource.from_url(url, loop=self.bot.loop, stream=False)
                     await player.queue.put(source)
-                    await ctx.send(f'Added to queue: {source.title}')
+                    await messages.respond(ctx, f'Added to queue: {source.title}')
                 except Exception as e:
-                    await ctx.send(f'An error occurred while processing your song: {str(e)}')
+                    await messages.respond(ctx, f'An error occurred while processing your song: {str(e)}')
     async def process_playlist(self, ctx, url, player):
-        await ctx.send("Processing playlist. This may take a moment...")
+        # Not awaited, it can go out together with whatever follows
+        messages.respond(ctx, "Processing playlist. This may take a moment...")
         try:
-            ydl_opts_playlist = {
-                'extract_flat': 'in_playlist',
-                'skip_download': True,
-            }
-            with yt_dlp.YoutubeDL(ydl_opts_playlist) as ydl:
-                result = await self.bot.loop.run_in_executor(thread_pool, ydl.extract_info, url, False)
+            result = await extract_pool.extract_info(url, False, 'playlist')
 
             if 'entries' not in result:
-                await ctx.send('Error: Could not find playlist entries.')
+                await messages.respond(ctx, 'Error: Could not find playlist entries.')
                 return
 
-            for entry in result['entries'][:10]:
-                video_url = f"https://www.youtube.com/watch?v={entry['id']}"
-                source = await YTDLSource.from_url(video_url, loop=self.bot.loop, stream=False)
+            entries = [entry for entry in result['entries'][:10] if entry]
+            semaphore = asyncio.Semaphore(PLAYLIST_DOWNLOAD_CONCURRENCY)
+
+            async def download(entry):
+                async with semaphore:
+                    video_url = f"https://www.youtube.com/watch?v={entry['id']}"
+                    return await YTDLSource.from_url(video_url, loop=self.bot.loop, stream=False)
+
+            tasks = [asyncio.ensure_future(download(entry)) for entry in entries]
+
+            # Whichever track finishes downloading first starts playing right away...
+            first = None
+            remaining = list(tasks)
+            while remaining and first is None:
+                done, _ = await asyncio.wait(remaining, return_when=asyncio.FIRST_COMPLETED)
+                finished = [task for task in remaining if task in done and task.exception() is None]
+                first = finished[0] if finished else None
+                remaining = [task for task in remaining if task not in done]
+
+            added = 0
+            if first is not None:
+                await player.queue.put(first.result())
+                added += 1
+
+            # ...and the rest are appended in playlist order as they complete
+            for task in tasks:
+                if task is first:
+                    continue
+                try:
+                    source = await task
+                except Exception as e:
+                    print(f"Playlist entry failed: {e}")
+                    continue
                 await player.queue.put(source)
-            
-            await ctx.send(f"Added {min(10, len(result['entries']))} songs from the playlist to the queue.")
+                added += 1
+
+            await messages.respond(ctx, f"Added {added} songs from the playlist to the queue.")
             
             if len(result['entries']) > 10:
-                await ctx.send("Note: Only the first 10 songs from the playlist were added to avoid overloading.")
+                await messages.respond(ctx, "Note: Only the first 10 songs from the playlist were added to avoid overloading.")
         except Exception as e:
-            await ctx.send(f'An error occurred while processing the playlist: {str(e)}')
+            await messages.respond(ctx, f'An error occurred while processing the playlist: {str(e)}')
             print(f"Playlist error details: {e}")
 
     @commands.command()
@@ -255,46 +346,46 @@ class Music(commands.Cog):
         vc = ctx.voice_client
         if vc and vc.is_playing():
             vc.pause()
-            await ctx.send("Paused ⏸️")
+            await messages.respond(ctx, "Paused ⏸️")
         else:
-            await ctx.send("Nothing is playing.")
+            await messages.respond(ctx, "Nothing is playing.")
 
     @commands.command()
     async def resume(self, ctx):
         vc = ctx.voice_client
         if vc and vc.is_paused():
             vc.resume()
-            await ctx.send("Resumed ▶️")
+            await messages.respond(ctx, "Resumed ▶️")
         else:
-            await ctx.send("The audio is not paused.")
+            await messages.respond(ctx, "The audio is not paused.")
 
     @commands.command()
     async def skip(self, ctx):
         vc = ctx.voice_client
         if vc and vc.is_playing():
             vc.stop()
-            await ctx.send("Skipped ⏭️")
+            await messages.respond(ctx, "Skipped ⏭️")
         else:
-            await ctx.send("Nothing is playing.")
+            await messages.respond(ctx, "Nothing is playing.")
 
     @commands.command()
     async def queue(self, ctx):
         player = self.get_player(ctx)
         if player.queue.empty():
-            return await ctx.send('There are currently no more queued songs.')
+            return await messages.respond(ctx, 'There are currently no more queued songs.')
 
         upcoming = list(player.queue._queue)
         fmt = '\n'.join(f'`{i+1}.` {song}' for i, song in enumerate(upcoming))
         embed = discord.Embed(title=f'Upcoming - Next {len(upcoming)}', description=fmt)
-        await ctx.send(embed=embed)
+        await messages.respond(ctx, embed=embed)
 
     @commands.command()
     async def now_playing(self, ctx):
         player = self.get_player(ctx)
         if player.current:
-            await ctx.send(f'Now playing: {player.current.title}')
+            await messages.respond(ctx, f'Now playing: {player.current.title}')
         else:
-            await ctx.send('Nothing is currently playing.')
+            await messages.respond(ctx, 'Nothing is currently playing.')
 
     @commands.command()
     async def volume(self, ctx, volume: int):
@@ -304,51 +395,54 @@ class Music(commands.Cog):
                 player = self.get_player(ctx)
                 player.volume = volume / 100
                 vc.source.volume = volume / 100
-                await ctx.send(f"Changed volume to {volume}%")
+                await messages.respond(ctx, f"Changed volume to {volume}%")
             else:
-                await ctx.send("Please use a value between 0 and 100")
+                await messages.respond(ctx, "Please use a value between 0 and 100")
         else:
-            await ctx.send("Not connected to a voice channel.")
+            await messages.respond(ctx, "Not connected to a voice channel.")
 
     @commands.command()
     async def stop(self, ctx):
         vc = ctx.voice_client
         if vc:
             await self.cleanup(ctx.guild)
-            await ctx.send("Stopped and disconnected.")
+            await messages.respond(ctx, "Stopped and disconnected.")
         else:
-            await ctx.send("Not connected to a voice channel.")
+            await messages.respond(ctx, "Not connected to a voice channel.")
 
     @commands.command()
     async def delete(self, ctx, number: int = None):
         if number is None:
-            return await ctx.send('Please provide a number to delete a song from the queue. Usage: `!delete <number>`')
+            return await messages.respond(ctx, 'Please provide a number to delete a song from the queue. Usage: `!delete <number>`')
 
         player = self.get_player(ctx)
         if player.queue.empty():
-            return await ctx.send('The queue is empty.')
+            return await messages.respond(ctx, 'The queue is empty.')
         
         if number < 1 or number > player.queue.qsize():
-            return await ctx.send(f'Please provide a valid number between 1 and {player.queue.qsize()}.')
+            return await messages.respond(ctx, f'Please provide a valid number between 1 and {player.queue.qsize()}.')
         
         # Convert queue to a list, remove the item, and recreate the queue
         queue_list = list(player.queue._queue)
         removed_song = queue_list.pop(number - 1)
+        removed_song.cleanup()
         player.queue._queue.clear()
         for song in queue_list:
             player.queue.put_nowait(song)
         
-        await ctx.send(f'Removed song: **{removed_song}**')
+        await messages.respond(ctx, f'Removed song: **{removed_song}**')
 
     @commands.command()
     async def clear_queue(self, ctx):
         player = self.get_player(ctx)
         if player.queue.empty():
-            await ctx.send("The queue is already empty.")
+            await messages.respond(ctx, "The queue is already empty.")
         else:
-            # Clear the queue
+            # Clear the queue, releasing the cached files the sources were holding
+            for source in player.queue._queue:
+                source.cleanup()
             player.queue._queue.clear()
-            await ctx.send("The queue has been cleared.")
+            await messages.respond(ctx, "The queue has been cleared.")
 
 
 
@@ -365,8 +459,10 @@ async def on_ready():
     await bot.add_cog(Music(bot))
 
 # Load the token from the environment variable
-TOKEN = os.getenv('DISCORD_BOT_TOKEN')
-if not TOKEN:
-    raise ValueError("No token found. Please set the DISCORD_BOT_TOKEN environment variable.")
+if __name__ == '__main__':
+    TOKEN = os.getenv('DISCORD_BOT_TOKEN')
+    if not TOKEN:
+        raise ValueError("No token found. Please set the DISCORD_BOT_TOKEN environment variable.")
 
-bot.run(TOKEN)
\ No newline at end of file
+    setup()
+    bot.run(TOKEN)
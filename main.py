@@ -2,13 +2,25 @@ import asyncio
 import discord
 from discord import app_commands
 from discord.ext import commands
-import yt_dlp
-from async_timeout import timeout
-from functools import partial
-from youtube_search import YoutubeSearch
 import os
 from dotenv import load_dotenv
 import concurrent.futures
+import threading
+import contextlib
+from extractpool import ExtractorPool
+from audiofx import VolumeTransformer
+from ytcache import SearchCache, StreamCache, youtube_search, video_id, playlist_id, watch_url
+from metastore import MetadataStore
+from resolver import StreamResolver
+from titleindex import TitleIndex
+from trackqueue import TrackQueue
+from playerstate import PlayerStateStore
+from scheduler import PlaybackScheduler
+import metrics
+from time import perf_counter
+from tracing import Tracer
+from messaging import CHATTER, NowPlaying, message_edits, messages, now_playing_text
+import atexit
 import json
 import aiohttp
 from datetime import datetime, time, timezone
@@ -44,12 +56,155 @@ ffmpeg_options = {
     'executable': r'C:\ffmpeg\bin\ffmpeg.exe'  # Adjust this path to where you installed ffmpeg
 }
 
-ytdl = yt_dlp.YoutubeDL(ydl_opts)
+ydl_playlist_opts = {
+    'extract_flat': 'in_playlist',
+    'skip_download': True,
+}
+
+# yt-dlp runs in worker processes, each with its own YoutubeDL per profile
+extract_pool = ExtractorPool({'default': ydl_opts, 'playlist': ydl_playlist_opts},
+                             workers=int(os.getenv('EXTRACT_WORKERS', '0')) or None)
 
 # Create a ThreadPoolExecutor
 thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=10)
 
-
+search_cache = SearchCache(maxsize=int(os.getenv('SEARCH_CACHE_SIZE', '512')),
+                           ttl=int(os.getenv('SEARCH_CACHE_TTL', '600')))
+
+# Resolved stream info keyed by youtube video id, shared by every guild
+stream_cache = StreamCache(max_bytes=int(os.getenv('STREAM_CACHE_BYTES', 8 * 1024 * 1024)))
+
+# Metadata survives restarts so only expired stream urls have to be re-extracted
+metadata_store = None
+
+# Prometheus metrics, served on 127.0.0.1:METRICS_PORT/metrics when it is set
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+EXTRACT_SECONDS = metrics.Histogram('music_extract_seconds', 'yt-dlp extract_info latency', ['kind'])
+SEARCH_SECONDS = metrics.Histogram('music_search_seconds', 'YouTube search latency (cache misses only)')
+FIRST_FRAME_SECONDS = metrics.Histogram('music_ffmpeg_first_frame_seconds', 'ffmpeg spawn to first audio frame', ['path'])
+COMMAND_SECONDS = metrics.Histogram('music_command_seconds', 'Slash command handling time', ['command'])
+COMMANDS = metrics.Counter('music_commands_total', 'Slash commands handled', ['command', 'status'])
+PLAYBACK_ERRORS = metrics.Counter('music_playback_errors_total', 'Playback failures', ['stage'])
+TRACKS_STARTED = metrics.Counter('music_tracks_started_total', 'Tracks that started playing', ['path'])
+metrics.Gauge('music_thread_pool_tasks', 'Blocking work on the shared thread pool', ['state'], function=lambda: {
+    ('active',): len(thread_pool._threads) - thread_pool._idle_semaphore._value,
+    ('pending',): thread_pool._work_queue.qsize(),
+})
+metrics.Gauge('music_extract_workers', 'yt-dlp worker processes', ['state'], function=lambda: {
+    ('busy',): extract_pool.busy,
+    ('waiting',): extract_pool.waiting,
+})
+# metadata_store joins these in setup()
+CACHES = {'search': search_cache, 'stream': stream_cache}
+metrics.Counter('music_cache_requests_total', 'Cache lookups', ['cache', 'result'], function=lambda: {
+    **{(name, 'hit'): cache.hits for name, cache in CACHES.items()},
+    **{(name, 'miss'): cache.misses for name, cache in CACHES.items()},
+})
+metrics.Gauge('music_cache_hit_ratio', 'Cache hit ratio since start', ['cache'], function=lambda: {
+    (name,): cache.hits / (cache.hits + cache.misses) for name, cache in CACHES.items() if cache.hits + cache.misses
+})
+# Filled in once the Music cog is loaded, see create_bot
+QUEUE_DEPTH = metrics.Gauge('music_queue_depth', 'Songs queued per guild', ['guild'])
+PLAYERS = metrics.Gauge('music_players', 'Guild players held by the scheduler', ['state'])
+VOICE_CLIENTS = metrics.Gauge('music_voice_clients', 'Connected voice clients')
+FFMPEG_PROCESSES = metrics.Gauge('music_ffmpeg_processes', 'Running ffmpeg child processes')
+
+async def extract_info(url, download=False, profile='default'):
+    with EXTRACT_SECONDS.time(kind='download' if download else 'stream'):
+        return await extract_pool.extract_info(url, download, profile)
+
+# stream cache -> metadata store -> yt-dlp, guilds asking for the same video
+# at the same time share one extraction
+resolver = None
+
+# Per-song timelines from /play (or being queued) to the first audio packet,
+# rotated JSONL; full span detail only for the slowest 1%
+tracer = None
+
+# Titles we've already seen (searches, plays, playlists) for /play autocomplete,
+# seeded from the metadata store in setup()
+title_index = TitleIndex(max_titles=int(os.getenv('TITLE_INDEX_SIZE', '20000')))
+
+# Queues, current track and volume survive restarts, restored per guild on first use
+player_state = None
+# Seconds of quiet before a changed player is snapshotted, and the longest a
+# stream of changes (a playlist being queued) can hold the snapshot back
+STATE_SAVE_DELAY = float(os.getenv('STATE_SAVE_DELAY', '2'))
+STATE_SAVE_MAX_DELAY = float(os.getenv('STATE_SAVE_MAX_DELAY', '10'))
+# While a track plays its position is snapshotted this often, so a crash
+# resumes close to where it was
+STATE_POSITION_INTERVAL = float(os.getenv('STATE_POSITION_INTERVAL', '15'))
+
+# How often a playing track's progress is refreshed in its message, 0 to only update on changes
+NP_PROGRESS_INTERVAL = float(os.getenv('NP_PROGRESS_INTERVAL', '30'))
+
+# Seconds a guild can sit with nothing to play before its player is dropped
+IDLE_TIMEOUT = int(os.getenv('IDLE_TIMEOUT', '300'))
+
+# How many upcoming songs to resolve in the background while the current one plays
+PREFETCH_COUNT = int(os.getenv('PREFETCH_COUNT', '2'))
+
+# Playlists change, so their cached entry list is only trusted for a while
+PLAYLIST_CACHE_TTL = int(os.getenv('PLAYLIST_CACHE_TTL', '3600'))
+
+# 'opus' hands discord.py the stream's own Opus packets (codec copy) whenever
+# it is already Opus at 100% volume and falls back to 'pcm' for anything else,
+# re-encoding in ffmpeg costs far more than scaling PCM in Python
+PLAYBACK_MODE = os.getenv('PLAYBACK_MODE', 'opus')
+
+# Players start at full volume in opus mode so the default is a plain copy
+DEFAULT_VOLUME = float(os.getenv('DEFAULT_VOLUME', '1.0' if PLAYBACK_MODE == 'opus' else '0.5'))
+
+# Per-guild cap on queued songs, playlists are ingested until they hit it
+MAX_QUEUE_LENGTH = int(os.getenv('MAX_QUEUE_LENGTH', '5000'))
+# /queue only lists the start of long queues
+QUEUE_DISPLAY_COUNT = 20
+# Playlist entries are pulled from yt-dlp this many at a time
+PLAYLIST_PAGE_SIZE = int(os.getenv('PLAYLIST_PAGE_SIZE', '25'))
+
+
+def setup():
+    # Opens the stores and starts their threads. Not done at import: the
+    # launcher and the benchmarks import this module before configuring it.
+    global metadata_store, resolver, tracer, player_state
+    if metadata_store is not None:
+        return
+    metadata_store = MetadataStore(os.getenv('METADATA_DB', 'metadata.db'))
+    CACHES['metadata'] = metadata_store
+    resolver = StreamResolver(extract_info, stream_cache, metadata_store)
+    tracer = Tracer(os.getenv('TRACE_PATH', 'traces.jsonl'),
+                    max_bytes=int(os.getenv('TRACE_MAX_BYTES', 10 * 1024 * 1024)))
+    atexit.register(tracer.close)
+    title_index.add_many((watch_url(vid), title) for vid, title in reversed(metadata_store.recent_titles(title_index.max_titles)))
+    player_state = PlayerStateStore(os.getenv('PLAYER_STATE_PATH', 'player_state.jsonl'))
+
+def searched(results, seconds):
+    SEARCH_SECONDS.observe(seconds)
+    metadata_store.put_search_results(results)
+    title_index.add_many((watch_url(r['id']), r['title']) for r in results)
+
+async def walk_playlist(url, pid):
+    seen = []
+    async with contextlib.aclosing(extract_pool.iter_entries(url, page_size=PLAYLIST_PAGE_SIZE)) as pages:
+        async for page in pages:
+            page = [entry for entry in page if entry.get('id')]
+            seen.extend(page)
+            title_index.add_many((watch_url(entry['id']), entry.get('title')) for entry in page)
+            yield page
+    # Only listings we walked to the end are worth caching
+    metadata_store.put_playlist(pid, seen)
+
+async def playlist_pages(url):
+    pid = playlist_id(url)
+    cached = metadata_store.get_playlist(pid, max_age=PLAYLIST_CACHE_TTL)
+    if cached is not None:
+        yield cached
+        return
+
+    # Guilds queuing the same playlist share one walk, joiners replay the pages so far
+    async with contextlib.aclosing(resolver.inflight.iterate(('playlist_pages', pid or url), walk_playlist, url, pid)) as pages:
+        async for page in pages:
+            yield page
 
 class VolumeControl(discord.ui.View):
     def __init__(self, initial_volume: int):
@@ -86,107 +241,363 @@ class SongSelect(discord.ui.View):
     def create_callback(self, song):
         async def callback(interaction: discord.Interaction):
             if interaction.user != self.author:
-                await interaction.response.send_message("You can't select this song.", ephemeral=True)
+                await messages.reply(interaction, "You can't select this song.", ephemeral=True)
                 return
             self.selected_song = song
             self.stop()
             await interaction.response.defer()
         return callback
-class YTDLSource(discord.PCMVolumeTransformer):
-    def __init__(self, source, *, data, volume=0.5):
+def first_frame(source):
+    # Called from the voice thread on the first packet after ffmpeg (re)starts
+    FIRST_FRAME_SECONDS.observe(perf_counter() - source._spawned_at, path=source.path)
+    source._spawned_at = None
+    trace, source.trace = source.trace, None
+    if trace is not None:
+        trace.since('spawned', 'ffmpeg_first_frame')
+        trace.finish(path=source.path)
+
+class YTDLSource(VolumeTransformer):
+    path = 'pcm'
+
+    def __init__(self, source, *, data, volume=0.5, start=0):
         super().__init__(source, volume)
         self.data = data
         self.title = data.get('title')
         self.url = data.get('url')
+        self.trace = None
+        self._start = start
+        self._frames = 0
+        self._spawned_at = perf_counter()
+
+    @property
+    def position(self):
+        return self._start + self._frames * 0.02
+
+    def read(self):
+        data = super().read()
+        if data:
+            self._frames += 1
+            if self._spawned_at is not None:
+                first_frame(self)
+        return data
 
     @classmethod
-    async def create(cls, url, *, loop=None, stream=False):
-        loop = loop or asyncio.get_event_loop()
-        partial_run = partial(ytdl.extract_info, url, download=not stream)
-        data = await loop.run_in_executor(thread_pool, partial_run)
-        
-        if 'entries' in data:
-            data = data['entries'][0]
-        
-        return cls(discord.FFmpegPCMAudio(data['url'], **ffmpeg_options), data=data)
+    async def extract(cls, url, *, loop=None, stream=False):
+        return await resolver.resolve(url, stream)
+
+    @classmethod
+    async def create(cls, url, *, loop=None, stream=False, data=None, volume=0.5, start=0):
+        # data can be handed in when it was already resolved (e.g. prefetched)
+        if data is None:
+            data = await cls.extract(url, loop=loop, stream=stream)
+
+        if PLAYBACK_MODE == 'opus' and YTDLOpusSource.copies(data, volume):
+            return YTDLOpusSource(data, volume=volume, start=start)
+        before_options = f'-ss {start:.2f}' if start else None
+        return cls(discord.FFmpegPCMAudio(data['url'], before_options=before_options, **ffmpeg_options),
+                   data=data, volume=volume, start=start)
+
+class YTDLOpusSource(discord.AudioSource):
+    # Hands discord.py Opus packets straight from ffmpeg, so there is no PCM
+    # scaling or libopus encoding in our process. Only started when the stream
+    # can be copied; a volume change mid-track respawns ffmpeg at the current
+    # position, re-encoding until the next track goes back through create().
+    def __init__(self, data, *, volume=0.5, start=0):
+        self.data = data
+        self.title = data.get('title')
+        self.url = data.get('url')
+        self._volume = volume
+        self._start = start
+        self.trace = None
+        self._frames = 0
+        self._lock = threading.Lock()
+        self.original = self._spawn(start)
+
+    @property
+    def path(self):
+        return 'opus-copy' if self._copy else 'opus-encode'
+
+    @staticmethod
+    def copies(data, volume):
+        return data.get('acodec') == 'opus' and volume == 1.0
+
+    @property
+    def _copy(self):
+        return self.copies(self.data, self._volume)
+
+    @property
+    def position(self):
+        # Every read() is one 20ms packet
+        return self._start + self._frames * 0.02
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        if value == self._volume:
+            return
+        self._volume = value
+        with self._lock:
+            old, self.original = self.original, self._spawn(self.position)
+        old.cleanup()
+
+    def _spawn(self, start):
+        before_options = f'-ss {start:.2f}' if start else None
+        options = ffmpeg_options['options']
+        if not self._copy:
+            options += f' -af volume={self._volume:.2f}'
+        self._spawned_at = perf_counter()
+        # discord.py copies the stream for 'opus'/'libopus'/'copy' and only
+        # encodes for anything else; a copy can't go through -af volume
+        return discord.FFmpegOpusAudio(self.url, codec='copy' if self._copy else None,
+                                       executable=ffmpeg_options['executable'],
+                                       before_options=before_options, options=options)
+
+    def read(self):
+        with self._lock:
+            packet = self.original.read()
+        if packet:
+            self._frames += 1
+            if self._spawned_at is not None:
+                first_frame(self)
+        return packet
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.original.cleanup()
 
 class Song:
-    def __init__(self, url, title=None):
+    def __init__(self, url, title=None, start=0, trace=None):
         self.url = url
         self.title = title
+        # Seconds into the track to start from (resuming after a restart)
+        self.start = start
+        # Songs from /play carry the command's trace, anything else starts one here
+        self.trace = trace or tracer.start('queued', url=url)
+        self.trace.mark('enqueued')
 
 class MusicPlayer:
-    def __init__(self, interaction: discord.Interaction):
-        self.bot = interaction.client
-        self._guild = interaction.guild
-        self._channel = interaction.channel
-        self.queue = asyncio.Queue()
-        self.next = asyncio.Event()
-        self.np = None
-        self.volume = .5
+    def __init__(self, bot, guild, channel):
+        self.bot = bot
+        self._guild = guild
+        self._channel = channel
+        self.queue = TrackQueue()
+        self.now_playing = NowPlaying(channel, message_edits, self.now_playing_text, NP_PROGRESS_INTERVAL,
+                                      dispatcher=messages)
+        self.volume = DEFAULT_VOLUME
         self.current = None
-        self.bot.loop.create_task(self.player_loop())
-
-    async def player_loop(self):
-        await self.bot.wait_until_ready()
-
-        while not self.bot.is_closed():
-            self.next.clear()
-
-            try:
-                async with timeout(300):
-                    song = await self.queue.get()
-            except asyncio.TimeoutError:
-                return self.destroy(self._guild)
-
-            if not self._guild.voice_client:
-                await self.ensure_voice_connected()
-                if not self._guild.voice_client:
-                    await self._channel.send("Failed to connect to voice channel. Skipping song.")
-                    continue
-
-            try:
-                source = await YTDLSource.create(song.url, loop=self.bot.loop, stream=True)
-            except Exception as e:
-                await self._channel.send(f'There was an error processing your song.\n'
-                                         f'```css\n[{e}]\n```')
-                continue
-
-            source.volume = self.volume
-            self.current = source
+        self.current_song = None
+        self.prefetched = {}
+        self._refresh_pending = False
+        self._save_handle = None
+        self._unsaved_since = None
+        self._position_handle = None
+        self.queue.watch(self.queue_changed)
+
+    # Driven by PlaybackScheduler, nothing here runs while the guild is idle
+
+    def ready(self):
+        # A restored queue waits here until we're back in voice
+        return bool(self.queue) and self._guild.voice_client is not None
+
+    async def play_next(self, finished):
+        song = self.queue.popleft()
+        self.current_song = song
+        self.current = None
+        trace = song.trace
+        trace.since('enqueued', 'queue_wait', idle=True)
 
-            try:
-                self._guild.voice_client.play(source, after=lambda e: self.bot.loop.call_soon_threadsafe(self.play_next_song, e))
-                self.np = await self._channel.send(f'**Now Playing:** `{source.title}`')
-                await self.next.wait()
-            except Exception as e:
-                logging.error(f"Error during playback: {e}")
-                await self._channel.send(f"An error occurred during playback. Attempting to continue.")
-                self.play_next_song(error=e)
+        try:
+            with trace.span('resolve', prefetched=song in self.prefetched):
+                data = await self.take_prefetched(song) or await YTDLSource.extract(song.url, loop=self.bot.loop, stream=True)
+            with trace.span('ffmpeg_spawn'):
+                source = await YTDLSource.create(song.url, loop=self.bot.loop, stream=True, data=data,
+                                                 volume=self.volume, start=song.start)
+            trace.mark('spawned')
+        except Exception as e:
+            self.current_song = None
+            trace.finish('error', error=str(e))
+            PLAYBACK_ERRORS.inc(stage='extract')
+            self.notify(f'There was an error processing your song.\n```css\n[{e}]\n```')
+            return False
+
+        source.volume = self.volume
+        self.current = source
+        if video_id(song.url):
+            title_index.add(watch_url(video_id(song.url)), source.title)
+
+        voice_client = self._guild.voice_client
+        if voice_client is None:
+            # Left voice while the song was resolving, keep it for when we're back
+            source.cleanup()
+            self.current_song = self.current = None
+            self.queue.appendleft(song)
+            return False
 
-    def play_next_song(self, error=None):
+        try:
+            source.trace = trace
+            voice_client.play(source, after=lambda e: self.bot.loop.call_soon_threadsafe(finished, e))
+        except Exception as e:
+            logging.error(f"Error during playback: {e}")
+            trace.finish('error', error=str(e))
+            PLAYBACK_ERRORS.inc(stage='play')
+            self.notify("An error occurred during playback. Attempting to continue.")
+            self.current_song = self.current = None
+            return False
+        TRACKS_STARTED.inc(path=source.path)
+        self.now_playing.set_playing(True)
+        self._arm_position_save()
+        return True
+
+    def notify(self, content):
+        # Restored players may not know a channel to talk in
+        if self._channel is not None:
+            messages.send(self._channel, content, lane=CHATTER)
+
+    def track_ended(self, error=None):
         if error:
             logging.error(f"Error in playback: {error}")
-        self.next.set()
+            PLAYBACK_ERRORS.inc(stage='stream')
+        self.current_song = None
+        self.current = None
+        self._cancel_position_save()
+        self.schedule_save()
+        if not self.queue:
+            self.now_playing.set_playing(False)
+
+    def now_playing_text(self):
+        source = self.current
+        if source is None:
+            return now_playing_text(None, queued=len(self.queue))
+        return now_playing_text(source.title, getattr(source, 'position', None),
+                                source.data.get('duration'), len(self.queue))
+
+    async def expire(self):
+        # Reaped after idling: forget prefetches and pending saves. An empty
+        # player is gone for good, a queue stuck without voice stays on disk.
+        self.queue.unwatch(self.queue_changed)
+        self.now_playing.close()
+        for task in self.prefetched.values():
+            task.cancel()
+        self.prefetched.clear()
+        self._cancel_position_save()
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+        if self.queue:
+            self.save_state()
+        else:
+            player_state.clear(self._guild.id)
+        if self._guild.voice_client:
+            await self._guild.voice_client.disconnect()
+
+    def queue_changed(self, queue):
+        # A playlist adds hundreds of songs in one go, react once after the batch
+        if not self._refresh_pending:
+            self._refresh_pending = True
+            self.bot.loop.call_soon(self.queue_settled)
+        self.schedule_save()
+
+    def queue_settled(self):
+        self._refresh_pending = False
+        self.refresh_prefetch()
+        if self.current is not None:
+            self.now_playing.update()
+
+    def schedule_save(self):
+        # Debounced: every change pushes the save back to STATE_SAVE_DELAY from
+        # now, up to STATE_SAVE_MAX_DELAY after the first unsaved change
+        now = self.bot.loop.time()
+        if self._save_handle is None:
+            self._unsaved_since = now
+        else:
+            self._save_handle.cancel()
+        at = min(now + STATE_SAVE_DELAY, self._unsaved_since + STATE_SAVE_MAX_DELAY)
+        self._save_handle = self.bot.loop.call_at(at, self.save_state)
+
+    def _arm_position_save(self):
+        self._cancel_position_save()
+        if STATE_POSITION_INTERVAL:
+            self._position_handle = self.bot.loop.call_later(STATE_POSITION_INTERVAL, self._save_position)
+
+    def _cancel_position_save(self):
+        if self._position_handle is not None:
+            self._position_handle.cancel()
+            self._position_handle = None
+
+    def _save_position(self):
+        self._position_handle = None
+        if self.current is not None:
+            self.save_state()
+            self._arm_position_save()
+
+    def save_state(self):
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+        if not self.queue and self.current_song is None:
+            return player_state.clear(self._guild.id)
+
+        current = None
+        if self.current_song is not None:
+            position = getattr(self.current, 'position', 0) if self.current else self.current_song.start
+            current = [self.current_song.url, self.current_song.title, round(position, 2)]
+        # Keep the saved voice channel while we're waiting to get back into it
+        voice = self._guild.voice_client
+        previous = player_state.get(self._guild.id) or {}
+        player_state.save(self._guild.id, {
+            'channel': self._channel.id if self._channel else previous.get('channel'),
+            'voice': voice.channel.id if voice else previous.get('voice'),
+            'volume': self.volume,
+            'current': current,
+            'queue': [[song.url, song.title] for song in self.queue],
+        })
+
+    def restore(self, state):
+        self.volume = state.get('volume', self.volume)
+        songs = [Song(url, title) for url, title in state.get('queue') or ()]
+        if state.get('current'):
+            url, title, position = state['current']
+            songs.insert(0, Song(url, title, start=position))
+        self.queue.extend(songs)
+
+    def refresh_prefetch(self):
+        # Resolve the next PREFETCH_COUNT songs in the background and drop
+        # anything that is no longer in that window (queue was reordered/cleared)
+        upcoming = self.queue[:PREFETCH_COUNT]
+
+        for song in list(self.prefetched):
+            if song not in upcoming:
+                self.prefetched.pop(song).cancel()
+
+        for song in upcoming:
+            if song not in self.prefetched:
+                task = self.bot.loop.create_task(YTDLSource.extract(song.url, loop=self.bot.loop, stream=True))
+                # Errors are retried by play_next, don't let them go unretrieved
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+                self.prefetched[song] = task
+
+    async def take_prefetched(self, song):
+        task = self.prefetched.pop(song, None)
+        if task is None:
+            return None
+        try:
+            return await task
+        except Exception as e:
+            logging.error(f"Prefetch failed for {song.url}, retrying: {e}")
+            return None
 
 
-    async def ensure_voice_connected(self):
-        if not self._guild.voice_client:
-            try:
-                await self._channel.send("Reconnecting to voice channel...")
-                if self._guild.me.voice:
-                    await self._guild.me.voice.channel.connect()
-                else:
-                    await self._channel.send("I'm not in a voice channel. Please use the join command first.")
-            except asyncio.TimeoutError:
-                await self._channel.send("Failed to reconnect to voice channel.")
-
-    def destroy(self, guild):
-        return self.bot.loop.create_task(self._guild.voice_client.disconnect() if self._guild.voice_client else None)
 class Music(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.players = {}
+        self.scheduler = PlaybackScheduler(idle_timeout=IDLE_TIMEOUT)
+        # Only guilds with a live player, reaped by the scheduler after IDLE_TIMEOUT
+        self.players = self.scheduler.players
 
     async def cleanup(self, guild):
         try:
@@ -194,62 +605,118 @@ class Music(commands.Cog):
         except AttributeError:
             pass
 
-        try:
-            del self.players[guild.id]
-        except KeyError:
-            pass
+        player = self.scheduler.remove(guild.id)
+        if player is not None:
+            player.now_playing.close()
+        player_state.clear(guild.id)
 
     def get_player(self, interaction: discord.Interaction):
         try:
             player = self.players[interaction.guild_id]
         except KeyError:
-            player = MusicPlayer(interaction)
-            self.players[interaction.guild_id] = player
+            player = self.restore_player(interaction.guild, interaction.channel)
 
         return player
 
+    def restore_player(self, guild, channel=None):
+        # Players are only rebuilt from the saved state when a guild is used
+        # again, so a restart doesn't rehydrate every guild at once
+        state = player_state.get(guild.id)
+        if channel is None and state:
+            channel = guild.get_channel(state['channel']) or guild.system_channel
+        player = MusicPlayer(self.bot, guild, channel)
+        if state:
+            player.restore(state)
+        self.scheduler.add(guild.id, player)
+        return player
+
+    @commands.Cog.listener()
+    async def on_app_command_completion(self, interaction, command):
+        COMMANDS.inc(command=command.qualified_name, status='ok')
+        COMMAND_SECONDS.observe((discord.utils.utcnow() - interaction.created_at).total_seconds(),
+                                command=command.qualified_name)
+
+    async def cog_app_command_error(self, interaction, error):
+        name = interaction.command.qualified_name if interaction.command else 'unknown'
+        COMMANDS.inc(command=name, status='error')
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        guild = member.guild
+        if after.channel is None or before.channel == after.channel:
+            return
+
+        if member.id == self.bot.user.id:
+            player = self.players.get(guild.id)
+            if player is None and player_state.get(guild.id):
+                player = self.restore_player(guild)
+            self.scheduler.wake(guild.id)
+            return
+
+        # Someone is back in the channel we were playing in before the restart
+        state = player_state.get(guild.id)
+        if (not member.bot and state and state.get('voice') == after.channel.id
+                and guild.id not in self.players and not guild.voice_client):
+            self.restore_player(guild)
+            try:
+                await after.channel.connect()
+            except Exception as e:
+                logging.error(f"Error rejoining voice channel: {e}")
+
     @app_commands.command(name="join", description="Join the voice channel")
     async def join(self, interaction: discord.Interaction):
         if interaction.user.voice:
             channel = interaction.user.voice.channel
             try:
                 await channel.connect()
-                await interaction.response.send_message("Joined the voice channel.")
+                await messages.reply(interaction, "Joined the voice channel.")
             except Exception as e:
                 logging.error(f"Error joining voice channel: {e}")
-                await interaction.response.send_message(f"An error occurred while joining the voice channel: {e}")
+                await messages.reply(interaction, f"An error occurred while joining the voice channel: {e}")
         else:
-            await interaction.response.send_message("You are not connected to a voice channel.")
+            await messages.reply(interaction, "You are not connected to a voice channel.")
 
     @app_commands.command(name="play", description="Play a song or playlist")
     @app_commands.describe(query="The song or playlist you want to play")
     async def play(self, interaction: discord.Interaction, query: str):
-        await interaction.response.defer()
+        # The clock starts when Discord created the interaction, not when we got it
+        trace = tracer.start('play', origin=interaction.created_at.timestamp(),
+                             guild=interaction.guild_id, query=query)
+        with trace.span('defer'):
+            await interaction.response.defer()
 
         if not interaction.guild.voice_client:
             if interaction.user.voice:
-                await interaction.user.voice.channel.connect()
+                with trace.span('voice_connect'):
+                    await interaction.user.voice.channel.connect()
             else:
-                await interaction.followup.send("You need to be in a voice channel to play music!")
+                trace.finish('no_voice')
+                await messages.reply(interaction, "You need to be in a voice channel to play music!")
                 return
 
         player = self.get_player(interaction)
 
+        if player.queue.qsize() >= MAX_QUEUE_LENGTH:
+            trace.finish('queue_full')
+            await messages.reply(interaction, f"The queue is full ({MAX_QUEUE_LENGTH} songs).")
+            return
+
         if 'list=' in query:
             # Playlist handling
-            await self.process_playlist(interaction, query, player)
+            await self.process_playlist(interaction, query, player, trace)
         elif query.startswith('http'):
             # Direct URL handling
-            song = Song(query)
-            await player.queue.put(song)
-            await interaction.followup.send(f'Song Added to queue: {query}')
+            song = Song(query, title=metadata_store.title(video_id(query)), trace=trace)
+            player.queue.append(song)
+            await messages.reply(interaction, f'Song Added to queue: {query}')
         else:
             # Search and present options
-            results = await self.bot.loop.run_in_executor(thread_pool, YoutubeSearch, query, 10)
-            results = results.to_dict()
+            with trace.span('search'):
+                results = await youtube_search(query, 10, search_cache, thread_pool, searched)
 
             if not results:
-                await interaction.followup.send('No videos found.')
+                trace.finish('no_results')
+                await messages.reply(interaction, 'No videos found.')
                 return
 
             # Create embed with search results
@@ -258,45 +725,69 @@ class Music(commands.Cog):
                 embed.add_field(name=f"{i}. {video['title']}", value=f"Duration: {video['duration']}", inline=False)
 
             view = SongSelect(results[:10], interaction.user)
-            message = await interaction.followup.send(embed=embed, view=view)
+            with trace.span('send_results'):
+                message = await messages.reply(interaction, embed=embed, view=view)
+            if message is None:
+                trace.finish('send_failed')
+                return
 
             # Wait for button selection
-            await view.wait()
+            with trace.span('select_wait', idle=True):
+                await view.wait()
 
             if view.selected_song:
                 song_url = f"https://youtube.com{view.selected_song['url_suffix']}"
-                song = Song(song_url, title=view.selected_song['title'])
-                await player.queue.put(song)
+                song = Song(song_url, title=view.selected_song['title'], trace=trace)
+                player.queue.append(song)
                 await message.edit(content=f"Added to queue: {view.selected_song['title']}", embed=None, view=None)
             else:
+                trace.finish('select_timeout')
                 await message.edit(content="Song selection timed out.", embed=None, view=None)
 
-    async def process_playlist(self, interaction: discord.Interaction, url, player):
-        await interaction.followup.send("Processing playlist. This may take a moment...")
+    @play.autocomplete('query')
+    async def play_autocomplete(self, interaction: discord.Interaction, current: str):
+        # Answered from the local title index only, Discord gives us 3 seconds
+        if len(current) < 2 or current.startswith('http'):
+            return []
+        return [app_commands.Choice(name=title[:100], value=url) for url, title in title_index.search(current, 25)]
+
+    async def process_playlist(self, interaction: discord.Interaction, url, player, trace=None):
+        # Not awaited: progress notes queued back to back go out as one message
+        messages.reply(interaction, "Processing playlist. Songs will start playing as they are added...")
+        added = 0
+        full = False
         try:
-            ydl_opts_playlist = {
-                'extract_flat': 'in_playlist',
-                'skip_download': True,
-            }
-            with yt_dlp.YoutubeDL(ydl_opts_playlist) as ydl:
-                result = await self.bot.loop.run_in_executor(thread_pool, ydl.extract_info, url, False)
-
-            if 'entries' not in result:
-                await interaction.followup.send('Error: Could not find playlist entries.')
+            # Songs are queued page by page so the first one starts before the playlist is fully listed
+            async with contextlib.aclosing(playlist_pages(url)) as pages:
+                async for page in pages:
+                    if trace is not None:
+                        trace.since('defer', 'playlist_first_page')
+                    for entry in page:
+                        if player.queue.qsize() >= MAX_QUEUE_LENGTH:
+                            full = True
+                            break
+                        # The first song carries the /play trace, the rest start their own
+                        song = Song(watch_url(entry['id']), title=entry.get('title') or 'Unknown Title', trace=trace)
+                        trace = None
+                        player.queue.append(song)
+                        added += 1
+                    if full:
+                        break
+
+            if not added and not full:
+                if trace is not None:
+                    trace.finish('empty_playlist')
+                messages.reply(interaction, 'Error: Could not find playlist entries.')
                 return
 
-            for entry in result['entries'][:10]:
-                video_url = f"https://www.youtube.com/watch?v={entry['id']}"
-                song = Song(video_url, title=entry.get('title', 'Unknown Title'))
-                await player.queue.put(song)
-            
-            await interaction.followup.send(f"Added {min(10, len(result['entries']))} songs from the playlist to the queue.")
-            
-            if len(result['entries']) > 10:
-                await interaction.followup.send("Note: Only the first 10 songs from the playlist were added to avoid overloading.")
+            messages.reply(interaction, f"Added {added} songs from the playlist to the queue.")
+
+            if full:
+                messages.reply(interaction, f"Note: The queue is limited to {MAX_QUEUE_LENGTH} songs, the rest of the playlist was skipped.")
         except Exception as e:
-            await interaction.followup.send(f'An error occurred while processing the playlist: {str(e)}')
+            messages.reply(interaction, f'An error occurred while processing the playlist: {str(e)}')
             print(f"Playlist error details: {e}")
+            PLAYBACK_ERRORS.inc(stage='playlist')
     @app_commands.command(name="playnext", description="Add a song to play next in the queue")
     @app_commands.describe(query="The song you want to play next")
     async def playnext(self, interaction: discord.Interaction, query: str):
@@ -306,23 +797,26 @@ class Music(commands.Cog):
             if interaction.user.voice:
                 await interaction.user.voice.channel.connect()
             else:
-                await interaction.followup.send("You need to be in a voice channel to play music!")
+                await messages.reply(interaction, "You need to be in a voice channel to play music!")
                 return
 
         player = self.get_player(interaction)
 
+        if player.queue.qsize() >= MAX_QUEUE_LENGTH:
+            await messages.reply(interaction, f"The queue is full ({MAX_QUEUE_LENGTH} songs).")
+            return
+
         if query.startswith('http'):
             # Direct URL handling
-            song = Song(query)
-            await self.add_to_front_of_queue(player, song)
-            await interaction.followup.send(f'Added to play next: {song.url}')
+            song = Song(query, title=metadata_store.title(video_id(query)))
+            player.queue.appendleft(song)
+            await messages.reply(interaction, f'Added to play next: {song.url}')
         else:
             # Search and present options
-            results = await self.bot.loop.run_in_executor(None, YoutubeSearch, query, 5)
-            results = results.to_dict()
+            results = await youtube_search(query, 5, search_cache, thread_pool, searched)
 
             if not results:
-                await interaction.followup.send('No videos found.')
+                await messages.reply(interaction, 'No videos found.')
                 return
 
             # Create embed with search results
@@ -331,7 +825,9 @@ class Music(commands.Cog):
                 embed.add_field(name=f"{i}. {video['title']}", value=f"Duration: {video['duration']}", inline=False)
 
             view = SongSelect(results, interaction.user)
-            message = await interaction.followup.send(embed=embed, view=view)
+            message = await messages.reply(interaction, embed=embed, view=view)
+            if message is None:
+                return
 
             # Wait for button selection
             await view.wait()
@@ -339,113 +835,131 @@ class Music(commands.Cog):
             if view.selected_song:
                 song_url = f"https://youtube.com{view.selected_song['url_suffix']}"
                 song = Song(song_url, title=view.selected_song['title'])
-                await self.add_to_front_of_queue(player, song)
+                player.queue.appendleft(song)
                 await message.edit(content=f"Added to play next: {view.selected_song['title']}", embed=None, view=None)
             else:
                 await message.edit(content="Song selection timed out.", embed=None, view=None)
 
-    async def add_to_front_of_queue(self, player, song):
-        # Get all items from the queue
-        items = []
-        while not player.queue.empty():
-            items.append(await player.queue.get())
-
-        # Add the new song at the front
-        await player.queue.put(song)
-
-        # Put all other items back in the queue
-        for item in items:
-            await player.queue.put(item)
     @app_commands.command(name="pause", description="Pause the current song")
     async def pause(self, interaction: discord.Interaction):
         vc = interaction.guild.voice_client
         if vc and vc.is_playing():
             vc.pause()
-            await interaction.response.send_message("Paused ⏸️")
+            await messages.reply(interaction, "Paused ⏸️")
         else:
-            await interaction.response.send_message("Nothing is playing.")
+            await messages.reply(interaction, "Nothing is playing.")
 
     @app_commands.command(name="resume", description="Resume the paused song")
     async def resume(self, interaction: discord.Interaction):
         vc = interaction.guild.voice_client
         if vc and vc.is_paused():
             vc.resume()
-            await interaction.response.send_message("Resumed ▶️")
+            await messages.reply(interaction, "Resumed ▶️")
         else:
-            await interaction.response.send_message("The audio is not paused.")
+            await messages.reply(interaction, "The audio is not paused.")
 
     @app_commands.command(name="skip", description="Skip the current song")
     async def skip(self, interaction: discord.Interaction):
         vc = interaction.guild.voice_client
         if vc and vc.is_playing():
             vc.stop()
-            await interaction.response.send_message("Skipped ⏭️")
+            await messages.reply(interaction, "Skipped ⏭️")
         else:
-            await interaction.response.send_message("Nothing is playing.")
+            await messages.reply(interaction, "Nothing is playing.")
 
     @app_commands.command(name="queue", description="Show the current queue")
     async def queue(self, interaction: discord.Interaction):
         player = self.get_player(interaction)
         if player.queue.empty():
-            return await interaction.response.send_message('There are currently no more queued songs.')
+            return await messages.reply(interaction, 'There are currently no more queued songs.')
 
-        upcoming = list(player.queue._queue)
+        upcoming = player.queue[:QUEUE_DISPLAY_COUNT]
         fmt = '\n'.join(f'`{i+1}.` **{song.title}**' for i, song in enumerate(upcoming))
-        embed = discord.Embed(title=f'Upcoming - Next {len(upcoming)}', description=fmt)
-        await interaction.response.send_message(embed=embed)
+        embed = discord.Embed(title=f'Upcoming - Next {len(upcoming)} of {len(player.queue)}', description=fmt)
+        await messages.reply(interaction, embed=embed)
+
+    @app_commands.command(name="move", description="Move a song to another position in the queue")
+    @app_commands.describe(number="The number of the song to move", position="Where it should end up")
+    async def move(self, interaction: discord.Interaction, number: int, position: int):
+        player = self.get_player(interaction)
+        queue_size = len(player.queue)
+
+        if queue_size == 0:
+            return await messages.reply(interaction, 'The queue is empty.')
+
+        if not 1 <= number <= queue_size or not 1 <= position <= queue_size:
+            return await messages.reply(interaction, f'Please provide numbers between 1 and {queue_size}.')
+
+        song = player.queue.move(number - 1, position - 1)
+        await messages.reply(interaction, f'Moved **{song.title}** to position {position}.')
+
+    @app_commands.command(name="shuffle", description="Shuffle the queue")
+    async def shuffle(self, interaction: discord.Interaction):
+        player = self.get_player(interaction)
+        if player.queue.empty():
+            return await messages.reply(interaction, 'The queue is empty.')
+        player.queue.shuffle()
+        await messages.reply(interaction, f'Shuffled {len(player.queue)} songs 🔀')
 
     @app_commands.command(name="delete", description="Delete a song from the queue")
     @app_commands.describe(number="The number of the song to delete")
     async def delete(self, interaction: discord.Interaction, number: int):
         player = self.get_player(interaction)
         
-        # Convert queue to a list
-        queue_list = list(player.queue._queue)
-        queue_size = len(queue_list)
+        queue_size = len(player.queue)
 
         if queue_size == 0:
-            return await interaction.response.send_message('The queue is empty.')
+            return await messages.reply(interaction, 'The queue is empty.')
         
         if number < 1 or number > queue_size:
-            return await interaction.response.send_message(f'Please provide a valid number between 1 and {queue_size}.')
-        
-        removed_song = queue_list.pop(number - 1)
+            return await messages.reply(interaction, f'Please provide a valid number between 1 and {queue_size}.')
         
-        # Clear the queue and add back the songs
-        player.queue._queue.clear()
-        for song in queue_list:
-            await player.queue.put(song)
-        
-        await interaction.response.send_message(f'Removed song: **{removed_song.title}**')
+        removed_song = player.queue.pop(number - 1)
+
+        await messages.reply(interaction, f'Removed song: **{removed_song.title}**')
     @app_commands.command(name="now_playing", description="Show the currently playing song")
     async def now_playing(self, interaction: discord.Interaction):
         vc = interaction.guild.voice_client
         if vc and vc.is_playing():
-            await interaction.response.send_message(f'Now playing: {vc.source.title}')
+            await messages.reply(interaction, f'Now playing: {vc.source.title}')
         else:
-            await interaction.response.send_message('Nothing is currently playing.')
+            await messages.reply(interaction, 'Nothing is currently playing.')
+
+    @app_commands.command(name="playback_info", description="Show which audio path the bot is using")
+    async def playback_info(self, interaction: discord.Interaction):
+        paths = {}
+        for vc in self.bot.voice_clients:
+            if vc.source is not None:
+                path = getattr(vc.source, 'path', 'other')
+                paths[path] = paths.get(path, 0) + 1
+
+        vc = interaction.guild.voice_client
+        here = getattr(vc.source, 'path', 'other') if vc and vc.source else 'nothing playing'
+        overall = ', '.join(f'{path}: {count}' for path, count in sorted(paths.items())) or 'none'
+        await messages.reply(interaction, f"This server: `{here}`\nAll active servers: {overall}")
 
     @app_commands.command(name="volume", description="Adjust the volume of the music")
     async def volume(self, interaction: discord.Interaction):
         vc = interaction.guild.voice_client
         if not vc:
-            return await interaction.response.send_message("I'm not currently in a voice channel.")
+            return await messages.reply(interaction, "I'm not currently in a voice channel.")
 
         player = self.get_player(interaction)
         
         # Check if audio is currently playing
         if not vc.is_playing():
-            return await interaction.response.send_message("No audio is currently playing.")
+            return await messages.reply(interaction, "No audio is currently playing.")
 
         current_volume = int(player.volume * 100)
 
         view = VolumeControl(current_volume)
-        await interaction.response.send_message(f"Current volume: {current_volume}%\nUse the dropdown to adjust:", view=view)
+        await messages.reply(interaction, f"Current volume: {current_volume}%\nUse the dropdown to adjust:", view=view)
 
         await view.wait()
 
         if view.value is not None:
             player.volume = view.value / 100
+            player.schedule_save()
             if vc.source:
                 vc.source.volume = player.volume
             await interaction.edit_original_response(content=f"Volume set to {view.value}%", view=None)
@@ -455,27 +969,29 @@ class Music(commands.Cog):
         try:
             player = self.players[interaction.guild_id]
         except KeyError:
-            player = MusicPlayer(interaction)
-            self.players[interaction.guild_id] = player
+            player = self.restore_player(interaction.guild, interaction.channel)
         return player
 
     @app_commands.command(name="clear_queue", description="Clear the current queue")
     async def clear_queue(self, interaction: discord.Interaction):
         player = self.get_player(interaction)
         if player.queue.empty():
-            await interaction.response.send_message("The queue is already empty.")
+            await messages.reply(interaction, "The queue is already empty.")
         else:
-            player.queue._queue.clear()
-            await interaction.response.send_message("The queue has been cleared.")
+            player.queue.clear()
+            await messages.reply(interaction, "The queue has been cleared.")
 
     @app_commands.command(name="stop", description="Stop playing and clear the queue")
     async def stop(self, interaction: discord.Interaction):
         player = self.get_player(interaction)
-        player.queue._queue.clear()
+        player.queue.clear()
+        player.current_song = None
+        player_state.clear(interaction.guild_id)
         if interaction.guild.voice_client:
             await interaction.guild.voice_client.disconnect()
-        del self.players[interaction.guild_id]
-        await interaction.response.send_message("Stopped, cleared the queue, and disconnected.")
+        self.scheduler.remove(interaction.guild_id)
+        player.now_playing.close()
+        await messages.reply(interaction, "Stopped, cleared the queue, and disconnected.")
 
 # Setup logging
 logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -483,21 +999,61 @@ logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %
 intents = discord.Intents.default()
 intents.message_content = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
-
-@bot.event
-async def on_ready():
-    print(f'Logged in as {bot.user} (ID: {bot.user.id})')
-    print('------')
-    await bot.add_cog(Music(bot))
-    try:
-        synced = await bot.tree.sync()
-        print(f"Synced {len(synced)} command(s)")
-    except Exception as e:
-        print(f"An error occurred while syncing commands: {e}")
+def ffmpeg_processes(bot):
+    count = 0
+    for vc in bot.voice_clients:
+        # Walk the wrappers (volume, opus source) down to the FFmpeg*Audio
+        source = vc.source
+        while source is not None:
+            process = getattr(source, '_process', None)
+            if process is not None:
+                count += process.poll() is None
+                break
+            source = getattr(source, 'original', None)
+    return count
+
+def create_bot(shard_ids=None, shard_count=None, sync_commands=True):
+    # launcher.py runs several of these per machine, each with its own range of shards
+    setup()
+    if shard_count:
+        bot = commands.AutoShardedBot(command_prefix='!', intents=intents, shard_ids=shard_ids, shard_count=shard_count)
+    else:
+        bot = commands.Bot(command_prefix='!', intents=intents)
+
+    @bot.event
+    async def on_ready():
+        print(f'Logged in as {bot.user} (ID: {bot.user.id})')
+        if shard_ids:
+            print(f'Shards {shard_ids[0]}-{shard_ids[-1]} of {shard_count}, {len(bot.guilds)} guilds')
+        print('------')
+        if bot.get_cog('Music') is None:
+            music = Music(bot)
+            await bot.add_cog(music)
+            QUEUE_DEPTH.function = lambda: {(str(gid),): len(p.queue) for gid, p in music.players.items()}
+            PLAYERS.function = lambda: {('active',): music.scheduler.active,
+                                        ('idle',): len(music.players) - music.scheduler.active}
+            VOICE_CLIENTS.function = lambda: len(bot.voice_clients)
+            FFMPEG_PROCESSES.function = lambda: ffmpeg_processes(bot)
+            if METRICS_PORT:
+                await metrics.start_server(METRICS_PORT)
+                print(f"Metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
+        if len(player_state):
+            print(f"{len(player_state)} guild queue(s) will be restored when next used")
+        if not sync_commands:
+            return
+        try:
+            synced = await bot.tree.sync()
+            print(f"Synced {len(synced)} command(s)")
+        except Exception as e:
+            print(f"An error occurred while syncing commands: {e}")
+
+    return bot
+
 # Load the token from the environment variable
-TOKEN = os.getenv('DISCORD_BOT_TOKEN')
-if not TOKEN:
-    raise ValueError("No token found. Please set the DISCORD_BOT_TOKEN environment variable.")
+if __name__ == '__main__':
+    TOKEN = os.getenv('DISCORD_BOT_TOKEN')
+    if not TOKEN:
+        raise ValueError("No token found. Please set the DISCORD_BOT_TOKEN environment variable.")
 
-bot.run(TOKEN)
\ No newline at end of file
+    bot = create_bot()
+    bot.run(TOKEN)
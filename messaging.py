@@ -0,0 +1,375 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+import discord
+
+# Discord lets a bot send (and separately edit) about 5 messages per 5 seconds
+# in one channel, and make 50 requests a second overall
+EDIT_RATE = 1.0
+EDIT_BURST = 5
+SEND_RATE = 1.0
+SEND_BURST = 5
+GLOBAL_RATE = 50
+MAX_LENGTH = 2000
+
+# Dispatcher lanes, lower goes first
+RESPONSE, NOTICE, CHATTER = 0, 1, 2
+
+
+def clock(seconds):
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    return f'{hours}:{rest // 60:02d}:{rest % 60:02d}' if hours else f'{rest // 60}:{rest % 60:02d}'
+
+
+def now_playing_text(title, elapsed=None, duration=None, queued=0, width=14):
+    if title is None:
+        text = '**Now Playing:** nothing'
+    else:
+        text = f'**Now Playing:** `{title}`'
+        if elapsed is not None and duration:
+            done = min(width - 1, int(elapsed / duration * width))
+            bar = '▬' * done + '🔘' + '▬' * (width - 1 - done)
+            text += f'\n`{clock(min(elapsed, duration))} / {clock(duration)}` {bar}'
+        elif duration:
+            text += f'\n`{clock(duration)}`'
+        elif elapsed is not None:
+            text += f'\n`{clock(elapsed)}`'
+    if queued:
+        text += f"\n{queued} song{'s' if queued != 1 else ''} queued"
+    return text
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        # 0 if a token was taken, otherwise how long until there is one
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def until_full(self):
+        self._refill()
+        return (self.capacity - self.tokens) / self.rate
+
+
+class _ChannelEdits:
+    def __init__(self, bucket):
+        self.bucket = bucket
+        # message id -> (message, fields, failed), oldest first
+        self.pending = {}
+        self.task = None
+        # Set when an edit comes in while the drain task waits for the bucket to refill
+        self.wake = asyncio.Event()
+
+
+class EditScheduler:
+    # Message edits go out per channel through a token bucket. Editing a
+    # message that already has an edit waiting just replaces the fields, so a
+    # burst of updates to one message costs one request. A channel's state is
+    # dropped once its bucket has refilled with nothing left to send.
+    def __init__(self, rate=EDIT_RATE, burst=EDIT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._channels = {}
+        self.sent = 0
+        self.coalesced = 0
+
+    def edit(self, message, failed=None, **fields):
+        # failed() is called if the message is gone (deleted, no access)
+        channel = self._channels.get(message.channel.id)
+        if channel is None:
+            channel = self._channels[message.channel.id] = _ChannelEdits(TokenBucket(self.rate, self.burst))
+        if message.id in channel.pending:
+            self.coalesced += 1
+        channel.pending[message.id] = (message, fields, failed)
+        channel.wake.set()
+        if channel.task is None:
+            channel.task = asyncio.get_running_loop().create_task(self._drain(message.channel.id, channel))
+
+    def cancel(self, message):
+        channel = self._channels.get(message.channel.id)
+        if channel is not None:
+            channel.pending.pop(message.id, None)
+
+    async def _drain(self, channel_id, channel):
+        try:
+            while True:
+                while channel.pending:
+                    wait = channel.bucket.take()
+                    if wait:
+                        await asyncio.sleep(wait)
+                        continue
+                    message, fields, failed = channel.pending.pop(next(iter(channel.pending)))
+                    try:
+                        await message.edit(**fields)
+                        self.sent += 1
+                    except (discord.NotFound, discord.Forbidden):
+                        if failed is not None:
+                            failed()
+                    except discord.HTTPException as e:
+                        logging.error(f"Could not edit message: {e}")
+                # Keep the bucket around until it is full again, or the next edit could
+                # burst past the limit; an edit coming in meanwhile goes out right away
+                channel.wake.clear()
+                try:
+                    await asyncio.wait_for(channel.wake.wait(), channel.bucket.until_full())
+                except asyncio.TimeoutError:
+                    pass
+                if not channel.pending:
+                    break
+        finally:
+            channel.task = None
+            if self._channels.get(channel_id) is channel and not channel.pending:
+                del self._channels[channel_id]
+
+
+class _Outgoing:
+    def __init__(self, target, lane, content, kwargs, merge, reply=False, initial=False):
+        self.target = target
+        self.reply = reply
+        self.initial = initial
+        self.lane = lane
+        # [text, repeats] per line once merged
+        self.lines = [[content, 1]]
+        self.kwargs = kwargs
+        self.merge = merge and not kwargs and isinstance(content, str)
+        self.futures = [asyncio.get_running_loop().create_future()]
+
+    @property
+    def content(self):
+        if self.lines[0][0] is None:
+            return None
+        return '\n'.join(text if repeats == 1 else f'{text} (x{repeats})' for text, repeats in self.lines)
+
+    def absorb(self, other):
+        # Take a plain text message queued right behind us for the same destination
+        if not (self.merge and other.merge and other.target is self.target):
+            return False
+        text = other.lines[0][0]
+        if text == self.lines[-1][0]:
+            self.lines[-1][1] += 1
+        elif len(self.content) + 1 + len(text) <= MAX_LENGTH:
+            self.lines.append([text, 1])
+        else:
+            return False
+        self.futures.extend(other.futures)
+        return True
+
+    async def deliver(self):
+        target = self.target
+        if not self.reply:
+            return await target.send(self.content, **self.kwargs)
+        if self.initial:
+            return await target.response.send_message(self.content, **self.kwargs)
+        return await target.followup.send(self.content, **self.kwargs)
+
+
+class _ChannelSends:
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.lanes = (deque(), deque(), deque())
+        self.task = None
+        # Set when something is queued while the drain task waits for the bucket to refill
+        self.wake = asyncio.Event()
+
+    def __bool__(self):
+        return any(self.lanes)
+
+    def pop(self):
+        lane = next(lane for lane in self.lanes if lane)
+        item = lane.popleft()
+        while lane and item.absorb(lane[0]):
+            lane.popleft()
+        return item
+
+
+class MessageDispatcher:
+    # Every message the bot sends goes through here. Each channel has a token
+    # bucket and three lanes: interaction replies, then notices, then chatter
+    # (playlist progress, playback errors). Plain text messages queued back
+    # to back for the same destination go out as one, repeated lines counted
+    # instead of repeated. The first reply to an interaction (due within 3
+    # seconds, and not counted against the channel or global limits by
+    # Discord) skips the queue; later replies to it wait until it is sent.
+    #
+    # send() and reply() return a future for the sent message (None if it
+    # couldn't be sent); fire and forget is fine, errors are logged here.
+    def __init__(self, rate=SEND_RATE, burst=SEND_BURST, global_rate=GLOBAL_RATE):
+        self.rate = rate
+        self.burst = burst
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self._channels = {}
+        # interaction id -> future of its first reply, while that is being sent
+        self._answering = {}
+        self.sent = 0
+        self.merged = 0
+
+    def send(self, channel, content=None, *, lane=CHATTER, merge=True, **kwargs):
+        return self._queue(channel.id, _Outgoing(channel, lane, content, kwargs, merge))
+
+    def respond(self, ctx, content=None, *, merge=True, **kwargs):
+        # Prefix commands: the answer goes to the command's channel, ahead of chatter
+        return self.send(ctx.channel, content, lane=RESPONSE, merge=merge, **kwargs)
+
+    def reply(self, interaction, content=None, *, merge=True, **kwargs):
+        if interaction.response.is_done() or interaction.id in self._answering:
+            return self._queue(interaction.channel_id, _Outgoing(interaction, RESPONSE, content, kwargs, merge, reply=True))
+        item = _Outgoing(interaction, RESPONSE, content, kwargs, merge, reply=True, initial=True)
+        self._answering[interaction.id] = item.futures[0]
+        asyncio.get_running_loop().create_task(self._answer(item))
+        return item.futures[0]
+
+    def _queue(self, channel_id, item):
+        channel = self._channels.get(channel_id)
+        if channel is None:
+            channel = self._channels[channel_id] = _ChannelSends(TokenBucket(self.rate, self.burst))
+        channel.lanes[item.lane].append(item)
+        channel.wake.set()
+        if channel.task is None:
+            channel.task = asyncio.get_running_loop().create_task(self._drain(channel_id, channel))
+        return item.futures[0]
+
+    async def _deliver(self, item):
+        try:
+            message = await item.deliver()
+            self.sent += 1
+        except Exception as e:
+            logging.error(f"Could not send message: {e}")
+            message = None
+        for future in item.futures:
+            if not future.done():
+                future.set_result(message)
+
+    async def _answer(self, item):
+        try:
+            await self._deliver(item)
+        finally:
+            del self._answering[item.target.id]
+
+    async def _wait(self, bucket):
+        wait = bucket.take()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = bucket.take()
+
+    async def _drain(self, channel_id, channel):
+        try:
+            while True:
+                while channel:
+                    # Waiting here also gives more messages a chance to queue up behind this one
+                    await self._wait(channel.bucket)
+                    await self._wait(self.global_bucket)
+                    item = channel.pop()
+                    self.merged += len(item.futures) - 1
+                    if item.reply and item.target.id in self._answering:
+                        await self._answering[item.target.id]
+                    await self._deliver(item)
+                # Keep the bucket around until it is full again, or the next message could
+                # burst past the limit; anything queued meanwhile goes out right away
+                channel.wake.clear()
+                try:
+                    await asyncio.wait_for(channel.wake.wait(), channel.bucket.until_full())
+                except asyncio.TimeoutError:
+                    pass
+                if not channel:
+                    break
+        finally:
+            channel.task = None
+            if self._channels.get(channel_id) is channel and not channel:
+                del self._channels[channel_id]
+
+
+class NowPlaying:
+    # A guild's one "Now Playing" message, sent once and then edited in place.
+    # render() builds the text; update() is cheap to call on every change since
+    # only changed text is sent and edits are coalesced by the EditScheduler.
+    # While a track plays, its progress is refreshed every progress_interval
+    # seconds (0 turns that off).
+    def __init__(self, channel, editor, render, progress_interval=30, dispatcher=None):
+        self.channel = channel
+        self.editor = editor
+        self.dispatcher = dispatcher
+        self.render = render
+        self.progress_interval = progress_interval
+        self.message = None
+        self._shown = None
+        self._sending = False
+        self._tick = None
+
+    def update(self):
+        if self.channel is None:
+            return
+        content = self.render()
+        if content == self._shown:
+            return
+        self._shown = content
+        if self.message is not None:
+            self.editor.edit(self.message, self._lost, content=content)
+        elif not self._sending:
+            self._sending = True
+            asyncio.get_running_loop().create_task(self._send(content))
+
+    async def _send(self, content):
+        try:
+            if self.dispatcher is not None:
+                # Never merged with other chatter, it gets edited later
+                self.message = await self.dispatcher.send(self.channel, content, merge=False)
+            else:
+                self.message = await self.channel.send(content)
+        except discord.HTTPException as e:
+            logging.error(f"Could not send now playing message: {e}")
+        finally:
+            self._sending = False
+        if self.message is None:
+            self._shown = None
+        elif self._shown != content:
+            # Whatever changed while we were sending goes out as an edit
+            self._shown = None
+            self.update()
+
+    def _lost(self):
+        # Someone deleted it, the next update sends a fresh one
+        self.message = None
+        self._shown = None
+
+    def set_playing(self, playing):
+        if self._tick is not None:
+            self._tick.cancel()
+            self._tick = None
+        self.update()
+        if playing and self.progress_interval:
+            self._tick = asyncio.get_running_loop().call_later(self.progress_interval, self._progress)
+
+    def _progress(self):
+        self._tick = None
+        self.set_playing(True)
+
+    def close(self):
+        # The player is going away, leave the message as it is
+        self.channel = None
+        if self._tick is not None:
+            self._tick.cancel()
+            self._tick = None
+        if self.message is not None:
+            self.editor.cancel(self.message)
+
+
+# The bots' shared instances: everything they say goes through the dispatcher
+# and now playing messages are edited in place through the edit scheduler
+messages = MessageDispatcher()
+message_edits = EditScheduler()
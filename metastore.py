@@ -0,0 +1,259 @@
+import atexit
+import json
+import pathlib
+import sqlite3
+import threading
+import time
+
+from ytcache import stream_expiry, watch_url
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+    id INTEGER PRIMARY KEY,
+    video_id TEXT NOT NULL,
+    title TEXT,
+    duration REAL,
+    uploader TEXT,
+    formats TEXT,
+    stream_url TEXT,
+    stream_format TEXT,
+    stream_acodec TEXT,
+    expires_at REAL,
+    updated_at REAL NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_videos_video_id ON videos (video_id);
+
+CREATE TABLE IF NOT EXISTS playlists (
+    playlist_id TEXT PRIMARY KEY,
+    entries TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+# Stable metadata always wins the latest value, the stream columns are only
+# replaced when the new row actually carries a stream url (flat playlist
+# entries and search results don't)
+_UPSERT_VIDEO = """
+INSERT INTO videos (video_id, title, duration, uploader, formats, stream_url, stream_format, stream_acodec, expires_at, updated_at)
+VALUES (:video_id, :title, :duration, :uploader, :formats, :stream_url, :stream_format, :stream_acodec, :expires_at, :updated_at)
+ON CONFLICT (video_id) DO UPDATE SET
+    title = COALESCE(excluded.title, title),
+    duration = COALESCE(excluded.duration, duration),
+    uploader = COALESCE(excluded.uploader, uploader),
+    formats = COALESCE(excluded.formats, formats),
+    stream_url = COALESCE(excluded.stream_url, stream_url),
+    stream_format = COALESCE(excluded.stream_format, stream_format),
+    stream_acodec = COALESCE(excluded.stream_acodec, stream_acodec),
+    expires_at = COALESCE(excluded.expires_at, expires_at),
+    updated_at = excluded.updated_at
+"""
+
+
+def _merge(row, newer):
+    # Same rule as the upsert: a None in the newer row keeps the older value
+    if row is None:
+        return newer
+    return {k: newer[k] if newer.get(k) is not None else row.get(k) for k in newer}
+
+
+def parse_duration(value):
+    # youtube_search gives "1:02:03" style strings, yt-dlp gives seconds
+    if value is None or isinstance(value, (int, float)):
+        return value
+    try:
+        seconds = 0
+        for part in str(value).split(':'):
+            seconds = seconds * 60 + int(part)
+        return seconds
+    except ValueError:
+        return None
+
+
+class MetadataStore:
+    def __init__(self, path='metadata.db', flush_interval=2.0, batch_size=200, safety_margin=60):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.safety_margin = safety_margin
+        self.hits = 0
+        self.misses = 0
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+        # Lookups run on the event loop, they get their own read-only connection
+        # so they never wait for the writer thread's batch (WAL allows both)
+        self._reader = sqlite3.connect(pathlib.Path(path).absolute().as_uri() + '?mode=ro', uri=True,
+                                       check_same_thread=False)
+        self._reader.row_factory = sqlite3.Row
+
+        # Only guards the pending dicts, never held while sqlite works
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._pending_playlists = {}
+        # What the writer is committing right now, still visible to lookups
+        self._flushing = {}
+        self._flushing_playlists = {}
+        self._wake = threading.Event()
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_loop, name='metastore-writer', daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _read(self, sql, args):
+        # fetchall so the statement is done and the next read sees new commits
+        return self._reader.execute(sql, args).fetchall()
+
+    def get(self, video_id):
+        if not video_id:
+            return None
+        with self._lock:
+            flushing = self._flushing.get(video_id)
+            pending = self._pending.get(video_id)
+        found = self._read('SELECT * FROM videos WHERE video_id = ?', (video_id,))
+        # Queued rows are laid over the stored one, a search result with no
+        # stream url must not hide the stream url already on disk
+        row = dict(found[0]) if found else None
+        for newer in (flushing, pending):
+            if newer is not None:
+                row = _merge(row, newer)
+        if row is None:
+            return None
+        row = dict(row)
+        row['formats'] = json.loads(row['formats']) if row['formats'] else []
+        return row
+
+    def title(self, video_id):
+        row = self.get(video_id)
+        return row['title'] if row else None
+
+    def recent_titles(self, limit):
+        return [tuple(row) for row in self._read(
+            'SELECT video_id, title FROM videos WHERE title IS NOT NULL ORDER BY updated_at DESC LIMIT ?', (limit,))]
+
+    def get_stream(self, video_id):
+        # Returns a playback ready info dict only while the stored url is still valid
+        row = self.get(video_id)
+        if row is None or not row['stream_url'] or not row['expires_at']:
+            self.misses += 1
+            return None
+        if time.time() + (row['duration'] or 0) + self.safety_margin >= row['expires_at']:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return {
+            'id': video_id,
+            'url': row['stream_url'],
+            'title': row['title'],
+            'duration': row['duration'],
+            'format_id': row['stream_format'],
+            'acodec': row['stream_acodec'],
+            'webpage_url': watch_url(video_id),
+        }
+
+    def put(self, info, video_id=None):
+        video_id = video_id or info.get('id')
+        if not video_id:
+            return
+
+        formats = [
+            {k: f.get(k) for k in ('format_id', 'ext', 'acodec', 'abr', 'asr')}
+            for f in info.get('formats') or ()
+            if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')
+        ]
+        stream_url = info.get('url')
+        self._queue_row(video_id, {
+            'video_id': video_id,
+            'title': info.get('title'),
+            'duration': parse_duration(info.get('duration')),
+            'uploader': info.get('uploader') or info.get('channel'),
+            'formats': json.dumps(formats) if formats else None,
+            'stream_url': stream_url,
+            'stream_format': info.get('format_id') if stream_url else None,
+            'stream_acodec': info.get('acodec') if stream_url else None,
+            'expires_at': stream_expiry(stream_url) if stream_url else None,
+            'updated_at': time.time(),
+        })
+
+    def put_search_results(self, results):
+        for result in results:
+            self.put({'title': result.get('title'), 'duration': result.get('duration'),
+                      'channel': result.get('channel')}, video_id=result.get('id'))
+
+    def get_playlist(self, playlist_id, max_age):
+        if not playlist_id:
+            return None
+        with self._lock:
+            pending = self._pending_playlists.get(playlist_id) or self._flushing_playlists.get(playlist_id)
+        if pending is None:
+            rows = self._read('SELECT entries, updated_at FROM playlists WHERE playlist_id = ?', (playlist_id,))
+            found = tuple(rows[0]) if rows else None
+        else:
+            found = (pending['entries'], pending['updated_at'])
+        if found is None or time.time() - found[1] > max_age:
+            return None
+        return json.loads(found[0])
+
+    def put_playlist(self, playlist_id, entries):
+        entries = [{'id': e['id'], 'title': e.get('title'), 'duration': e.get('duration')} for e in entries if e and e.get('id')]
+        for entry in entries:
+            self.put(entry)
+        if not playlist_id:
+            return
+        with self._lock:
+            self._pending_playlists[playlist_id] = {
+                'playlist_id': playlist_id,
+                'entries': json.dumps(entries),
+                'updated_at': time.time(),
+            }
+
+    def _queue_row(self, video_id, row):
+        with self._lock:
+            self._pending[video_id] = _merge(self._pending.get(video_id), row)
+            if len(self._pending) >= self.batch_size:
+                self._wake.set()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                self._flushing, self._pending = self._pending, {}
+                self._flushing_playlists, self._pending_playlists = self._pending_playlists, {}
+            try:
+                if self._flushing or self._flushing_playlists:
+                    with self._conn:
+                        self._conn.executemany(_UPSERT_VIDEO, list(self._flushing.values()))
+                        self._conn.executemany(
+                            'INSERT OR REPLACE INTO playlists (playlist_id, entries, updated_at) '
+                            'VALUES (:playlist_id, :entries, :updated_at)', list(self._flushing_playlists.values()))
+            except sqlite3.Error:
+                # Keep the batch for the next flush, anything queued meanwhile is newer
+                with self._lock:
+                    for video_id, row in self._pending.items():
+                        self._flushing[video_id] = _merge(self._flushing.get(video_id), row)
+                    self._flushing_playlists.update(self._pending_playlists)
+                    self._pending, self._pending_playlists = self._flushing, self._flushing_playlists
+                    self._flushing, self._flushing_playlists = {}, {}
+                raise
+            finally:
+                with self._lock:
+                    self._flushing, self._flushing_playlists = {}, {}
+
+    def _write_loop(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print(f"Metadata store flush failed: {e}")
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._writer.join(timeout=5)
+        self.flush()
+        self._reader.close()
+        self._conn.close()
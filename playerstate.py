@@ -0,0 +1,119 @@
+import atexit
+import json
+import os
+import threading
+
+
+def load_states(path):
+    # guild id -> last state in a log (cleared guilds dropped), and how many lines it had
+    states, lines = {}, 0
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Torn last line from a crash mid-write, everything before it is intact
+                    continue
+                lines += 1
+                guild_id = record.pop('guild')
+                if record.get('cleared'):
+                    states.pop(guild_id, None)
+                else:
+                    states[guild_id] = record
+    except FileNotFoundError:
+        pass
+    return states, lines
+
+
+def write_states(path, states):
+    # One line per guild, swapped in with an atomic rename
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        for guild_id, state in states.items():
+            f.write(PlayerStateStore._encode(guild_id, state))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class PlayerStateStore:
+    # Per-guild player state (queue, current track + position, volume, channels)
+    # kept as an append-only JSONL log: one compact line per snapshot, the last
+    # line for a guild wins and a {"cleared": true} line forgets it. Lines are
+    # written and fsynced in batches by a writer thread; once the log holds many
+    # stale snapshots it is compacted to one line per guild with an atomic rename.
+    def __init__(self, path='player_state.jsonl', flush_interval=1.0, compact_ratio=4):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.compact_ratio = compact_ratio
+
+        self._lock = threading.Lock()
+        self._states, self._lines = load_states(path)
+
+        self._pending = {}
+        self._wake = threading.Event()
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_loop, name='player-state-writer', daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def __len__(self):
+        return len(self._states)
+
+    def get(self, guild_id):
+        return self._states.get(guild_id)
+
+    def save(self, guild_id, state):
+        with self._lock:
+            self._states[guild_id] = state
+            self._pending[guild_id] = state
+
+    def clear(self, guild_id):
+        with self._lock:
+            if self._states.pop(guild_id, None) is not None or guild_id in self._pending:
+                self._pending[guild_id] = None
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            states = dict(self._states)
+
+        if self._lines + len(pending) > self.compact_ratio * max(len(states), 16):
+            self._compact(states)
+            return
+
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for guild_id, state in pending.items():
+                f.write(self._encode(guild_id, state))
+            f.flush()
+            os.fsync(f.fileno())
+        self._lines += len(pending)
+
+    def _compact(self, states):
+        write_states(self.path, states)
+        self._lines = len(states)
+
+    @staticmethod
+    def _encode(guild_id, state):
+        record = {'guild': guild_id, **state} if state is not None else {'guild': guild_id, 'cleared': True}
+        return json.dumps(record, separators=(',', ':'), ensure_ascii=False) + '\n'
+
+    def _write_loop(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"Player state flush failed: {e}")
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._writer.join(timeout=5)
+        self.flush()
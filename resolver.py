@@ -0,0 +1,39 @@
+from singleflight import SingleFlight
+from ytcache import playlist_id, video_id
+
+
+class StreamResolver:
+    # Info for a url, cheapest source first: the in-memory stream cache, the
+    # sqlite metadata store (while its stream url is still valid), then yt-dlp.
+    # Concurrent requests for the same video or playlist share one extraction.
+    # extract(url, download, profile) is ExtractorPool.extract_info or a wrapper.
+    def __init__(self, extract, stream_cache, metadata_store):
+        self._extract = extract
+        self.stream_cache = stream_cache
+        self.metadata_store = metadata_store
+        self.inflight = SingleFlight()
+
+    async def resolve(self, url, stream=False):
+        key = video_id(url) if stream else None
+        data = self.stream_cache.get(key)
+        if data is not None:
+            return data
+
+        data = self.metadata_store.get_stream(key) if key else None
+        if data is not None:
+            self.stream_cache.put(key, data)
+            return data
+
+        data = await self.inflight.do(('video', key or url, stream), self._extract, url, not stream)
+        if 'entries' in data:
+            data = data['entries'][0]
+
+        if stream:
+            key = key or video_id(data.get('webpage_url'))
+            self.stream_cache.put(key, data)
+            self.metadata_store.put(data, video_id=key)
+        return data
+
+    async def playlist(self, url):
+        # Flat listing of a whole playlist in one go
+        return await self.inflight.do(('playlist', playlist_id(url) or url), self._extract, url, False, 'playlist')
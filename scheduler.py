@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import math
+import time
+
+
+class TimerWheel:
+    # Hashed timing wheel: schedule/cancel are O(1) and each tick only looks at
+    # one slot, so thousands of idle guilds cost nothing until they expire
+    def __init__(self, tick=1.0, slots=256):
+        self.tick = tick
+        self._slots = [set() for _ in range(slots)]
+        self._where = {}
+        self._current = 0
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def __len__(self):
+        return len(self._where)
+
+    def schedule(self, key, delay):
+        self.cancel(key)
+        ticks = max(1, math.ceil(delay / self.tick))
+        slot = (self._current + ticks) % len(self._slots)
+        # How many more times the wheel passes this slot before the key is due
+        rounds = (ticks - 1) // len(self._slots)
+        self._slots[slot].add(key)
+        self._where[key] = [slot, rounds]
+
+    def cancel(self, key):
+        where = self._where.pop(key, None)
+        if where is not None:
+            self._slots[where[0]].discard(key)
+
+    def advance(self, ticks=1):
+        expired = []
+        for _ in range(ticks):
+            self._current = (self._current + 1) % len(self._slots)
+            slot = self._slots[self._current]
+            for key in list(slot):
+                where = self._where[key]
+                if where[1]:
+                    where[1] -= 1
+                    continue
+                slot.discard(key)
+                del self._where[key]
+                expired.append(key)
+        return expired
+
+
+class PlaybackScheduler:
+    # Owns every guild's player. Nothing runs per guild while it is idle: track
+    # ends, queue changes and voice joins call wake(), which starts the next
+    # track in a short lived task, and players left idle are reaped off a
+    # timer wheel by the one background task.
+    #
+    # Players provide ready() (can start a track now), play_next(finished)
+    # (start one, True if it is playing; call finished(error) when it ends),
+    # track_ended(error) and expire() (dropped after idling).
+    def __init__(self, idle_timeout=300, tick=1.0):
+        self.idle_timeout = idle_timeout
+        self.players = {}
+        self.wheel = TimerWheel(tick)
+        self._playing = set()
+        self._starting = {}
+        self._reaper = None
+
+    @property
+    def active(self):
+        return len(self._playing) + len(self._starting)
+
+    def add(self, guild_id, player):
+        if self._reaper is None:
+            self._reaper = asyncio.get_running_loop().create_task(self._reap())
+        self.players[guild_id] = player
+        player.queue.watch(lambda queue: self.wake(guild_id))
+        self.wake(guild_id)
+
+    def remove(self, guild_id):
+        self.wheel.cancel(guild_id)
+        self._playing.discard(guild_id)
+        task = self._starting.pop(guild_id, None)
+        if task is not None:
+            task.cancel()
+        return self.players.pop(guild_id, None)
+
+    def wake(self, guild_id):
+        player = self.players.get(guild_id)
+        if player is None or guild_id in self._playing or guild_id in self._starting:
+            return
+        if player.ready():
+            self.wheel.cancel(guild_id)
+            self._starting[guild_id] = asyncio.get_running_loop().create_task(self._start(guild_id, player))
+        elif guild_id not in self.wheel:
+            self.wheel.schedule(guild_id, self.idle_timeout)
+
+    async def _start(self, guild_id, player):
+        ended = False
+
+        def finished(error=None):
+            nonlocal ended
+            ended = True
+            if self.players.get(guild_id) is not player:
+                return
+            player.track_ended(error)
+            if guild_id in self._playing:
+                self._playing.discard(guild_id)
+                self.wake(guild_id)
+
+        started = False
+        try:
+            started = await player.play_next(finished)
+        except Exception as e:
+            logging.error(f"Error starting playback: {e}")
+        finally:
+            if self._starting.get(guild_id) is asyncio.current_task():
+                del self._starting[guild_id]
+
+        if self.players.get(guild_id) is not player:
+            return
+        if started and not ended:
+            self._playing.add(guild_id)
+        else:
+            # Failed, or over before we even got here: move on to the next song
+            self.wake(guild_id)
+
+    async def _reap(self):
+        last = time.monotonic()
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            now = time.monotonic()
+            ticks = int((now - last) / self.wheel.tick)
+            last += ticks * self.wheel.tick
+            for guild_id in self.wheel.advance(ticks):
+                player = self.players.get(guild_id)
+                if player is None or guild_id in self._playing or guild_id in self._starting:
+                    continue
+                if player.ready():
+                    self.wake(guild_id)
+                    continue
+                self.remove(guild_id)
+                try:
+                    await player.expire()
+                except Exception as e:
+                    logging.error(f"Error expiring idle player: {e}")
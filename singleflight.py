@@ -0,0 +1,93 @@
+import asyncio
+
+
+class _Walk:
+    # One shared async generator, with every page it produced so far
+    def __init__(self, pages):
+        self.source = pages
+        self.pages = []
+        self.done = False
+        self.error = None
+        self.readers = 0
+        self._pull = None
+
+    async def more(self):
+        # Only one pull at a time; shielded so a reader leaving doesn't cancel it for the rest
+        if self._pull is None:
+            self._pull = asyncio.ensure_future(self._next())
+        await asyncio.shield(self._pull)
+
+    async def _next(self):
+        try:
+            self.pages.append(await self.source.__anext__())
+        except StopAsyncIteration:
+            self.done = True
+        except Exception as e:
+            self.done = True
+            self.error = e
+        finally:
+            self._pull = None
+
+    async def close(self):
+        if self._pull is not None:
+            self._pull.cancel()
+            await asyncio.wait([self._pull])
+        await self.source.aclose()
+
+
+class SingleFlight:
+    # Concurrent callers asking for the same key share one in-flight call
+    def __init__(self):
+        self._inflight = {}
+        self.shared = 0
+
+    def __len__(self):
+        return len(self._inflight)
+
+    async def do(self, key, func, *args):
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func(*args))
+            self._inflight[key] = future
+            future.add_done_callback(lambda f: self._forget(key, f))
+        else:
+            self.shared += 1
+        # shield so one caller giving up doesn't cancel the work for everyone else
+        return await asyncio.shield(future)
+
+    async def iterate(self, key, func, *args):
+        # do() for async generators: callers share one walk of func(*args) and
+        # late joiners replay the pages it already produced. The next page is
+        # only pulled when the furthest reader asks for it, and the walk is
+        # closed once nobody is reading.
+        walk = self._inflight.get(key)
+        if walk is None:
+            walk = self._inflight[key] = _Walk(func(*args))
+        else:
+            self.shared += 1
+        walk.readers += 1
+        try:
+            index = 0
+            while True:
+                if index < len(walk.pages):
+                    yield walk.pages[index]
+                    index += 1
+                elif walk.done:
+                    if walk.error is not None:
+                        raise walk.error
+                    return
+                else:
+                    await walk.more()
+        finally:
+            walk.readers -= 1
+            if walk.done or not walk.readers:
+                if self._inflight.get(key) is walk:
+                    del self._inflight[key]
+            if not walk.readers and not walk.done:
+                await walk.close()
+
+    def _forget(self, key, future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        if not future.cancelled():
+            future.exception()
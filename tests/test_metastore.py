@@ -0,0 +1,57 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from metastore import MetadataStore
+
+
+class MetadataStoreTest(unittest.TestCase):
+    # Flushes by hand, the writer thread's interval is set far out of the way
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.store = MetadataStore(os.path.join(self.dir.name, 'metadata.db'), flush_interval=3600)
+
+    def tearDown(self):
+        self.store.close()
+        self.dir.cleanup()
+
+    def put_stream(self, video_id='abc'):
+        expire = int(time.time()) + 6 * 3600
+        self.store.put({'title': 'Song', 'duration': 200, 'url': f'https://example.com/audio?expire={expire}',
+                        'format_id': '251', 'acodec': 'opus'}, video_id=video_id)
+
+    def test_search_result_keeps_stored_stream(self):
+        self.put_stream()
+        self.store.flush()
+        self.store.put_search_results([{'id': 'abc', 'title': 'Song (Official)', 'duration': '3:20'}])
+        data = self.store.get_stream('abc')
+        self.assertIsNotNone(data)
+        self.assertEqual(data['title'], 'Song (Official)')
+        self.store.flush()
+        self.assertIsNotNone(self.store.get_stream('abc'))
+
+    def test_search_result_keeps_queued_stream(self):
+        self.put_stream()
+        self.store.put_search_results([{'id': 'abc', 'title': 'Song', 'duration': '3:20'}])
+        self.assertIsNotNone(self.store.get_stream('abc'))
+
+    def test_failed_flush_keeps_batch(self):
+        self.put_stream()
+        conn = self.store._conn
+        self.store._conn = sqlite3.connect(':memory:')
+        with self.assertRaises(sqlite3.Error):
+            self.store.flush()
+        self.store._conn.close()
+        self.store._conn = conn
+        self.assertIsNotNone(self.store.get_stream('abc'))
+        self.store.flush()
+        self.assertEqual(self.store._read('SELECT COUNT(*) FROM videos', ())[0][0], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import asyncio
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import main
+
+
+class OpusSourceArgsTest(unittest.TestCase):
+    # Builds YTDLOpusSource with Popen patched out and checks the ffmpeg argv
+
+    def argv(self, acodec, volume, start=0):
+        with mock.patch('discord.player.subprocess.Popen') as popen:
+            source = main.YTDLOpusSource({'url': 'https://example.com/audio', 'acodec': acodec},
+                                         volume=volume, start=start)
+            args = popen.call_args[0][0]
+            source.cleanup()
+        return args
+
+    def option(self, args, name):
+        return args[args.index(name) + 1] if name in args else None
+
+    def test_opus_at_full_volume_is_copied(self):
+        args = self.argv('opus', 1.0)
+        self.assertEqual(self.option(args, '-c:a'), 'copy')
+        self.assertNotIn('-af', args)
+
+    def test_volume_change_encodes(self):
+        args = self.argv('opus', 0.5)
+        self.assertEqual(self.option(args, '-c:a'), 'libopus')
+        self.assertEqual(self.option(args, '-af'), 'volume=0.50')
+
+    def test_other_codecs_encode(self):
+        args = self.argv('mp4a.40.2', 1.0)
+        self.assertEqual(self.option(args, '-c:a'), 'libopus')
+
+    def test_start_seeks_the_input(self):
+        args = self.argv('opus', 1.0, start=42)
+        self.assertEqual(args[args.index('-ss') + 1], '42.00')
+        self.assertLess(args.index('-ss'), args.index('-i'))
+
+
+class PlaybackPathTest(unittest.TestCase):
+    # create() only takes the Opus path when the stream can be copied
+
+    def create(self, acodec, volume):
+        data = {'url': 'https://example.com/audio', 'acodec': acodec}
+        with mock.patch.object(main, 'PLAYBACK_MODE', 'opus'), mock.patch('discord.player.subprocess.Popen'):
+            source = asyncio.run(main.YTDLSource.create(data['url'], stream=True, data=data, volume=volume))
+            source.cleanup()
+        return source.path
+
+    def test_default_volume_copies(self):
+        self.assertEqual(self.create('opus', main.DEFAULT_VOLUME), 'opus-copy')
+
+    def test_anything_else_is_pcm(self):
+        self.assertEqual(self.create('opus', 0.5), 'pcm')
+        self.assertEqual(self.create('mp4a.40.2', 1.0), 'pcm')
+
+
+if __name__ == '__main__':
+    unittest.main()
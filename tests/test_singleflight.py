@@ -0,0 +1,78 @@
+import asyncio
+import contextlib
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from singleflight import SingleFlight
+
+
+class SharedWalkTest(unittest.TestCase):
+    # iterate() with a counting page generator standing in for a playlist walk
+
+    def setUp(self):
+        self.walks = 0
+        self.pulled = 0
+        self.closed = 0
+
+    async def pages(self, count, fail=False):
+        self.walks += 1
+        try:
+            for n in range(count):
+                await asyncio.sleep(0.05)
+                self.pulled += 1
+                yield [n]
+            if fail:
+                raise RuntimeError('walk failed')
+        finally:
+            self.closed += 1
+
+    async def read(self, flight, count, stop=None, fail=False, delay=0):
+        await asyncio.sleep(delay)
+        got = []
+        async with contextlib.aclosing(flight.iterate('key', self.pages, count, fail)) as pages:
+            async for page in pages:
+                got.extend(page)
+                if stop is not None and len(got) >= stop:
+                    break
+        return got
+
+    def test_callers_share_one_walk(self):
+        async def run():
+            flight = SingleFlight()
+            results = await asyncio.gather(*(self.read(flight, 5, delay=i * 0.01) for i in range(4)))
+            return flight, results
+
+        flight, results = asyncio.run(run())
+        self.assertEqual(results, [list(range(5))] * 4)
+        self.assertEqual(self.walks, 1)
+        self.assertEqual(self.pulled, 5)
+        self.assertEqual(flight.shared, 3)
+        self.assertEqual(len(flight), 0)
+
+    def test_walk_stops_when_everyone_stops(self):
+        async def run():
+            flight = SingleFlight()
+            results = await asyncio.gather(self.read(flight, 100, stop=2), self.read(flight, 100, stop=3))
+            return flight, results
+
+        flight, results = asyncio.run(run())
+        self.assertEqual(results, [[0, 1], [0, 1, 2]])
+        self.assertEqual(self.pulled, 3)
+        self.assertEqual(self.closed, 1)
+        self.assertEqual(len(flight), 0)
+
+    def test_error_reaches_every_reader(self):
+        async def run():
+            flight = SingleFlight()
+            return await asyncio.gather(self.read(flight, 2, fail=True), self.read(flight, 2, fail=True),
+                                        return_exceptions=True)
+
+        for result in asyncio.run(run()):
+            self.assertIsInstance(result, RuntimeError)
+        self.assertEqual(self.walks, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
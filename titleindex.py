@@ -0,0 +1,91 @@
+import re
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+
+def _normalize(text):
+    # Punctuation is dropped so "(Live)" or "Astley -" still match on the word
+    return ' '.join(re.sub(r'[^\w]+', ' ', text.lower()).split())
+
+
+class TitleIndex:
+    # Sorted array of every word-start suffix of every title, so a prefix
+    # lookup is one bisect plus a short scan and never touches the network.
+    def __init__(self, max_titles=20000):
+        self.max_titles = max_titles
+        self._titles = OrderedDict()
+        self._keys = []
+
+    def __len__(self):
+        return len(self._titles)
+
+    @staticmethod
+    def _suffixes(title):
+        words = _normalize(title).split(' ')
+        return [' '.join(words[i:]) for i in range(len(words)) if words[i]]
+
+    def add(self, url, title):
+        if not url or not title:
+            return
+        if url in self._titles:
+            if self._titles[url] == title:
+                self._titles.move_to_end(url)
+                return
+            self._remove(url)
+        self._titles[url] = title
+        for suffix in self._suffixes(title):
+            index = bisect_left(self._keys, (suffix, url))
+            self._keys.insert(index, (suffix, url))
+        self._evict()
+
+    def add_many(self, items):
+        keys = []
+        for url, title in items:
+            if not url or not title:
+                continue
+            if url in self._titles:
+                if self._titles[url] == title:
+                    self._titles.move_to_end(url)
+                    continue
+                self._remove(url)
+            self._titles[url] = title
+            keys.extend((suffix, url) for suffix in self._suffixes(title))
+        if len(keys) * 8 < len(self._keys):
+            # A search page or playlist page: a few bisect inserts, re-sorting
+            # the whole index here held up the event loop for tens of ms
+            for key in keys:
+                insort(self._keys, key)
+        else:
+            # Bulk load (the startup seed): append everything and sort once
+            self._keys.extend(keys)
+            self._keys.sort()
+        self._evict()
+
+    def search(self, prefix, limit=25):
+        prefix = _normalize(prefix)
+        if not prefix:
+            return []
+
+        matches = {}
+        index = bisect_left(self._keys, (prefix,))
+        while index < len(self._keys) and len(matches) < limit * 3:
+            suffix, url = self._keys[index]
+            if not suffix.startswith(prefix):
+                break
+            matches.setdefault(url, self._titles[url])
+            index += 1
+
+        # Titles that start with the query beat ones that only contain it later on
+        ranked = sorted(matches.items(), key=lambda item: not _normalize(item[1]).startswith(prefix))
+        return ranked[:limit]
+
+    def _remove(self, url):
+        title = self._titles.pop(url)
+        for suffix in self._suffixes(title):
+            index = bisect_left(self._keys, (suffix, url))
+            if index < len(self._keys) and self._keys[index] == (suffix, url):
+                del self._keys[index]
+
+    def _evict(self):
+        while len(self._titles) > self.max_titles:
+            self._remove(next(iter(self._titles)))
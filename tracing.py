@@ -0,0 +1,135 @@
+import contextlib
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+
+
+class Trace:
+    # One timeline, e.g. /play -> first audio packet. Spans are (name, start,
+    # end) offsets from the trace start; idle spans (waiting in the queue, a
+    # user picking a search result) are shown but don't count as latency.
+    def __init__(self, tracer, name, origin=None, **attrs):
+        self.tracer = tracer
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attrs = attrs
+        self.started_at = time.time()
+        self._t0 = time.perf_counter()
+        if origin is not None:
+            # Start the clock earlier, e.g. when Discord created the interaction
+            self._t0 -= max(0.0, self.started_at - origin)
+            self.started_at = origin
+        self.spans = []
+        self.finished = False
+        self._lock = threading.Lock()
+
+    def now(self):
+        return time.perf_counter() - self._t0
+
+    def add_span(self, name, start, end, idle=False, **attrs):
+        with self._lock:
+            self.spans.append({'name': name, 'start': start, 'end': end, 'idle': idle, **attrs})
+
+    @contextlib.contextmanager
+    def span(self, name, idle=False, **attrs):
+        start = self.now()
+        try:
+            yield
+        except BaseException as e:
+            attrs['error'] = type(e).__name__
+            raise
+        finally:
+            self.add_span(name, start, self.now(), idle, **attrs)
+
+    def mark(self, name, **attrs):
+        at = self.now()
+        self.add_span(name, at, at, **attrs)
+
+    def since(self, mark, name, idle=False, **attrs):
+        # Span from the last `mark` until now, for stages that start and end in different places
+        with self._lock:
+            start = next((span['end'] for span in reversed(self.spans) if span['name'] == mark), None)
+        if start is not None:
+            self.add_span(name, start, self.now(), idle, **attrs)
+
+    def finish(self, status='ok', **attrs):
+        with self._lock:
+            if self.finished:
+                return
+            self.finished = True
+            self.attrs.update(attrs)
+            duration = self.now()
+        self.tracer.export(self, status, duration)
+
+
+class Tracer:
+    # Completed traces go to a rotating JSONL file through a background
+    # thread. Every trace gets a one line summary of its stage durations;
+    # full span detail is only kept for the slowest ones (latency at or above
+    # the running p99 of the last `window` traces).
+    def __init__(self, path='traces.jsonl', max_bytes=10 * 1024 * 1024, backups=5,
+                 window=1000, quantile=0.99, min_samples=100):
+        self.window = deque(maxlen=window)
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self._threshold = None
+        self._since_threshold = 0
+        self._lock = threading.Lock()
+
+        self._logger = logging.getLogger(f'{__name__}.{id(self)}')
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        self._listener = None
+        if path:
+            handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups,
+                                                           encoding='utf-8', delay=True)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            records = queue.SimpleQueue()
+            self._logger.addHandler(logging.handlers.QueueHandler(records))
+            self._listener = logging.handlers.QueueListener(records, handler)
+            self._listener.start()
+
+    def start(self, name, origin=None, **attrs):
+        return Trace(self, name, origin, **attrs)
+
+    def _is_slow(self, latency):
+        with self._lock:
+            self.window.append(latency)
+            if len(self.window) < self.min_samples:
+                return True
+            self._since_threshold += 1
+            if self._threshold is None or self._since_threshold >= self.window.maxlen // 10:
+                ordered = sorted(self.window)
+                self._threshold = ordered[min(len(ordered) - 1, int(len(ordered) * self.quantile))]
+                self._since_threshold = 0
+            return latency >= self._threshold
+
+    def export(self, trace, status, duration):
+        idle = sum(span['end'] - span['start'] for span in trace.spans if span['idle'])
+        latency = duration - idle
+        record = {
+            'trace': trace.trace_id,
+            'name': trace.name,
+            'start': round(trace.started_at, 3),
+            'status': status,
+            'duration_ms': round(duration * 1000, 1),
+            'latency_ms': round(latency * 1000, 1),
+            'stages': {span['name']: round((span['end'] - span['start']) * 1000, 1)
+                       for span in trace.spans if span['end'] > span['start']},
+        }
+        if self._is_slow(latency):
+            record['sampled'] = 'slow'
+            record['attrs'] = trace.attrs
+            record['spans'] = [{**span, 'start': round(span['start'] * 1000, 1), 'end': round(span['end'] * 1000, 1)}
+                               for span in trace.spans]
+        self._logger.info(json.dumps(record, separators=(',', ':'), default=str))
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
@@ -0,0 +1,250 @@
+import asyncio
+import random
+from collections import deque
+from itertools import islice
+
+BLOCK_SIZE = 64
+
+
+class TrackQueue:
+    # Stands in for the asyncio.Queue the players used (get/put/qsize/empty) but
+    # also allows positional edits. Items live in deques of up to 2 * BLOCK_SIZE
+    # with a Fenwick tree over the block lengths, so finding the i-th item is
+    # O(log n), pushing at either end is O(1) and insert/delete/move only ever
+    # shift items inside one small block (block splits are amortised).
+    def __init__(self, items=()):
+        self.version = 0
+        self._blocks = []
+        self._tree = [0]
+        self._len = 0
+        self._getters = deque()
+        self._listeners = []
+        self._load(list(items))
+
+    def __len__(self):
+        return self._len
+
+    def __bool__(self):
+        return self._len > 0
+
+    def __iter__(self):
+        for block in self._blocks:
+            yield from block
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._len)
+            if step != 1:
+                return list(self)[index]
+            return self._slice(start, stop)
+        block, offset = self._locate(self._index(index))
+        return self._blocks[block][offset]
+
+    def qsize(self):
+        return self._len
+
+    def empty(self):
+        return self._len == 0
+
+    # Anything that caches a view of the queue (prefetching, the persisted
+    # state) registers here and is called with the queue after every change
+
+    def watch(self, callback):
+        self._listeners.append(callback)
+
+    def unwatch(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def append(self, item):
+        if not self._blocks or len(self._blocks[-1]) >= 2 * BLOCK_SIZE:
+            self._blocks.append(deque())
+            self._tree.append(0)
+            self._rebuild_tree()
+        self._blocks[-1].append(item)
+        self._add(len(self._blocks) - 1, 1)
+        self._len += 1
+        self._changed(added=True)
+
+    def appendleft(self, item):
+        if not self._blocks or len(self._blocks[0]) >= 2 * BLOCK_SIZE:
+            self._blocks.insert(0, deque())
+            self._tree.append(0)
+            self._rebuild_tree()
+        self._blocks[0].appendleft(item)
+        self._add(0, 1)
+        self._len += 1
+        self._changed(added=True)
+
+    def extend(self, items):
+        items = list(items)
+        if items:
+            self._load(list(self) + items)
+            self._changed(added=True)
+
+    def put_nowait(self, item):
+        self.append(item)
+
+    async def put(self, item):
+        self.append(item)
+
+    def insert(self, index, item):
+        # Same clamping as list.insert
+        if index < 0:
+            index = max(0, index + self._len)
+        if index >= self._len:
+            return self.append(item)
+        self._insert(index, item)
+        self._changed(added=True)
+
+    def pop(self, index=0):
+        item = self._pop(self._index(index))
+        self._changed()
+        return item
+
+    def popleft(self):
+        return self.pop(0)
+
+    def move(self, src, dst):
+        src, dst = self._index(src), self._index(dst)
+        item = self._pop(src)
+        self._insert(dst, item)
+        self._changed()
+        return item
+
+    def shuffle(self):
+        items = list(self)
+        random.shuffle(items)
+        self._load(items)
+        self._changed()
+
+    def clear(self):
+        self._load([])
+        self._changed()
+
+    async def get(self):
+        while not self._len:
+            waiter = asyncio.get_running_loop().create_future()
+            self._getters.append(waiter)
+            try:
+                await waiter
+            except BaseException:
+                waiter.cancel()
+                try:
+                    self._getters.remove(waiter)
+                except ValueError:
+                    pass
+                # We were woken but cancelled, pass the item on to the next getter
+                if self._len and not waiter.cancelled():
+                    self._wakeup_next()
+                raise
+        return self.popleft()
+
+    def get_nowait(self):
+        if not self._len:
+            raise asyncio.QueueEmpty
+        return self.popleft()
+
+    def _index(self, index):
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError('track queue index out of range')
+        return index
+
+    def _slice(self, start, stop):
+        items = []
+        if start >= stop:
+            return items
+        block, offset = self._locate(start)
+        while len(items) < stop - start:
+            current = self._blocks[block]
+            take = min(len(current) - offset, stop - start - len(items))
+            items.extend(islice(current, offset, offset + take))
+            block += 1
+            offset = 0
+        return items
+
+    def _locate(self, index):
+        # Fenwick descent: block holding the index-th item and the offset inside it
+        position, remaining = 0, index
+        step = 1 << len(self._blocks).bit_length()
+        while step:
+            candidate = position + step
+            if candidate <= len(self._blocks) and self._tree[candidate] <= remaining:
+                position = candidate
+                remaining -= self._tree[candidate]
+            step >>= 1
+        return position, remaining
+
+    def _add(self, block, delta):
+        i = block + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _rebuild_tree(self):
+        size = len(self._blocks)
+        self._tree = [0] * (size + 1)
+        for i, block in enumerate(self._blocks, start=1):
+            self._tree[i] += len(block)
+            parent = i + (i & -i)
+            if parent <= size:
+                self._tree[parent] += self._tree[i]
+
+    def _load(self, items):
+        self._blocks = [deque(items[i:i + BLOCK_SIZE]) for i in range(0, len(items), BLOCK_SIZE)]
+        self._len = len(items)
+        self._rebuild_tree()
+
+    def _insert(self, index, item):
+        if index >= self._len:
+            if not self._blocks:
+                self._blocks.append(deque())
+                self._tree.append(0)
+            block, offset = len(self._blocks) - 1, len(self._blocks[-1])
+        else:
+            block, offset = self._locate(index)
+        current = self._blocks[block]
+        current.insert(offset, item)
+        self._len += 1
+        if len(current) > 2 * BLOCK_SIZE:
+            # Split an overgrown block in two, only now does the tree need rebuilding
+            items = list(current)
+            self._blocks[block:block + 1] = [deque(items[:BLOCK_SIZE]), deque(items[BLOCK_SIZE:])]
+            self._rebuild_tree()
+        else:
+            self._add(block, 1)
+
+    def _pop(self, index):
+        block, offset = self._locate(index)
+        current = self._blocks[block]
+        if offset == 0:
+            item = current.popleft()
+        else:
+            item = current[offset]
+            del current[offset]
+        self._len -= 1
+        if not current:
+            del self._blocks[block]
+            self._rebuild_tree()
+        elif len(self._blocks) > 4 * (self._len // BLOCK_SIZE + 1):
+            # Lots of deletes left many tiny blocks behind, pack them again
+            self._load(list(self))
+        else:
+            self._add(block, -1)
+        return item
+
+    def _wakeup_next(self):
+        while self._getters:
+            waiter = self._getters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def _changed(self, added=False):
+        self.version += 1
+        if added:
+            self._wakeup_next()
+        for callback in list(self._listeners):
+            callback(self)
@@ -0,0 +1,147 @@
+import asyncio
+import re
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+
+from youtube_search import YoutubeSearch
+
+# Matches the 11 character video id in the usual youtube url shapes
+# (watch?v=, youtu.be/, shorts/, embed/, music.youtube.com)
+_VIDEO_ID_RE = re.compile(r'(?:v=|youtu\.be/|shorts/|embed/|live/)([A-Za-z0-9_-]{11})')
+
+# Only keep what we need to start playback, the full info dict is huge
+_KEEP_FIELDS = ('id', 'url', 'title', 'duration', 'format_id', 'ext', 'acodec', 'abr', 'webpage_url', 'extractor_key')
+
+
+def video_id(url):
+    if not url or 'youtu' not in url:
+        return None
+    match = _VIDEO_ID_RE.search(url)
+    return match.group(1) if match else None
+
+
+def watch_url(video_id):
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+
+def playlist_id(url):
+    if not url:
+        return None
+    ids = parse_qs(urlparse(url).query).get('list')
+    return ids[0] if ids else None
+
+
+def stream_expiry(stream_url):
+    # googlevideo urls carry their expiry either as ?expire=<unix> or /expire/<unix>/
+    parsed = urlparse(stream_url)
+    expire = parse_qs(parsed.query).get('expire')
+    if expire:
+        return float(expire[0])
+    match = re.search(r'/expire/(\d+)', parsed.path)
+    if match:
+        return float(match.group(1))
+    return None
+
+
+class StreamCache:
+    def __init__(self, max_bytes=8 * 1024 * 1024, default_ttl=1800, safety_margin=60):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.safety_margin = safety_margin
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key) if key else None
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, data, size = entry
+        # The url has to outlive the whole track, not just the start of it
+        if time.time() + (data.get('duration') or 0) + self.safety_margin >= expires_at:
+            self._remove(key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return dict(data)
+
+    def put(self, key, data):
+        if not key or not data.get('url'):
+            return
+
+        data = {k: data[k] for k in _KEEP_FIELDS if k in data}
+        expires_at = stream_expiry(data['url']) or time.time() + self.default_ttl
+        size = sum(len(str(v)) for v in data.values()) + 64 * len(data)
+
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (expires_at, data, size)
+        self._size += size
+
+        while self._size > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._size -= size
+
+
+class SearchCache:
+    def __init__(self, maxsize=512, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def normalize(query):
+        return ' '.join(query.lower().split())
+
+    def get(self, query, max_results):
+        key = self.normalize(query)
+        entry = self._entries.get(key)
+        if entry is not None:
+            stored_at, stored_max, results = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+            # A bigger earlier search (or one that ran out of results) covers this one
+            elif stored_max >= max_results or len(results) < stored_max:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return results[:max_results]
+        self.misses += 1
+        return None
+
+    def put(self, query, max_results, results):
+        key = self.normalize(query)
+        self._entries[key] = (time.monotonic(), max_results, list(results))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+async def youtube_search(query, max_results, cache, executor, on_results=None):
+    # Normalised free-text queries -> YoutubeSearch results. The scrape blocks,
+    # so it runs on executor; on_results(results, seconds) sees fresh results.
+    results = cache.get(query, max_results)
+    if results is None:
+        started = time.perf_counter()
+        results = await asyncio.get_running_loop().run_in_executor(executor, YoutubeSearch, query, max_results)
+        results = results.to_dict()
+        cache.put(query, max_results, results)
+        if on_results is not None:
+            on_results(results, time.perf_counter() - started)
+    return results